@@ -0,0 +1,139 @@
+import itertools
+import logging
+import multiprocessing
+import queue
+import time
+from multiprocessing import shared_memory
+import numpy as np
+from PySide6.QtCore import QObject, QTimer, Signal
+
+'''
+AnalysisWorker class
+Runs beat detection for trial windows in a separate process, so heavy detectors never freeze the UI.
+Trial windows are passed through shared memory, results come back on a queue that is polled from the
+GUI thread while jobs are pending, and analysisFinished is emitted for each completed job.
+If the process dies (out of memory, a native crash) or a job takes longer than JOB_TIMEOUT_S, every pending
+job finishes with an error, so the trial is detected in the GUI process instead, and a new process is started.
+After MAX_RESTARTS of those the worker is given up on, see is_available()
+'''
+logger = logging.getLogger(__name__)
+
+def analysis_process_main(requests, results):
+    from BeatDetectors import create_detector # Imported in the worker so the parent's startup isn't slowed down
+    detectors = {}
+    while True:
+        request = requests.get()
+        if request is None:
+            return
+        job_id, shm_name, n_samples, detector_name, sampling_rate = request
+        try:
+            shm = shared_memory.SharedMemory(name=shm_name)
+            try:
+                wind = np.ndarray((2, n_samples), dtype=np.float64, buffer=shm.buf)
+                if detector_name not in detectors:
+                    detectors[detector_name] = create_detector(detector_name)
+                t0 = time.perf_counter()
+                r_peak_ids = detectors[detector_name].find_peaks(wind[1], wind[0], sampling_rate)
+                elapsed_s = time.perf_counter() - t0
+                del wind
+            finally:
+                shm.close()
+            results.put((job_id, np.asarray(r_peak_ids, dtype=int), elapsed_s, None))
+        except Exception as e:
+            results.put((job_id, None, 0.0, repr(e)))
+
+class AnalysisWorker(QObject):
+    analysisFinished = Signal(int, object, float, object) # job id, R peak indices, detection time (s), error
+    POLL_PERIOD = 20 # ms
+    JOB_TIMEOUT_S = 60
+    MAX_RESTARTS = 3
+
+    def __init__(self):
+        super().__init__()
+        self.context = multiprocessing.get_context("spawn") # Never fork a process that has Qt running
+        self.process = None
+        self.n_restarts = 0
+        self.start_process()
+        self.job_ids = itertools.count()
+        self.pending = {} # job id -> (shared memory block, time submitted)
+
+        self.poll_timer = QTimer(self)
+        self.poll_timer.timeout.connect(self.poll_results)
+        self.poll_timer.setInterval(self.POLL_PERIOD)
+
+    def start_process(self):
+        # New queues too, a process that died holding a queue's lock leaves it unusable
+        self.requests = self.context.Queue()
+        self.results = self.context.Queue()
+        self.process = self.context.Process(target=analysis_process_main, args=(self.requests, self.results), name="analysis-worker", daemon=True)
+        self.process.start()
+
+    def is_available(self):
+        return self.process is not None
+
+    def submit(self, wind_times, wind_values, detector_name, sampling_rate):
+        '''Queues a trial window for detection, returns the job id'''
+        job_id = next(self.job_ids)
+        n_samples = len(wind_values)
+        shm = shared_memory.SharedMemory(create=True, size=max(1, 2*n_samples*np.dtype(np.float64).itemsize))
+        wind = np.ndarray((2, n_samples), dtype=np.float64, buffer=shm.buf)
+        wind[0] = wind_times
+        wind[1] = wind_values
+        del wind
+        self.pending[job_id] = (shm, time.monotonic())
+        self.requests.put((job_id, shm.name, n_samples, detector_name, sampling_rate))
+        if not self.poll_timer.isActive():
+            self.poll_timer.start()
+        return job_id
+
+    def has_pending(self):
+        return len(self.pending) > 0
+
+    def poll_results(self):
+        while True:
+            try:
+                job_id, r_peak_ids, elapsed_s, error = self.results.get_nowait()
+            except queue.Empty:
+                break
+            self.finish_job(job_id, r_peak_ids, elapsed_s, error)
+        if self.pending:
+            oldest = min(submitted for _, submitted in self.pending.values())
+            if not self.process.is_alive():
+                self.restart(f"Analysis worker exited with code {self.process.exitcode}")
+            elif time.monotonic() - oldest > self.JOB_TIMEOUT_S:
+                self.restart(f"Analysis worker took longer than {self.JOB_TIMEOUT_S} s")
+        if not self.pending:
+            self.poll_timer.stop()
+
+    def finish_job(self, job_id, r_peak_ids, elapsed_s, error):
+        shm, _ = self.pending.pop(job_id, (None, None))
+        if shm is not None:
+            shm.close()
+            shm.unlink()
+        if error is not None:
+            logger.error("Trial analysis failed", extra={"job_id": job_id, "error": error})
+        self.analysisFinished.emit(job_id, r_peak_ids, elapsed_s, error)
+
+    def restart(self, error):
+        '''Fails every pending job, then starts a new process, or gives up after MAX_RESTARTS'''
+        if self.process.is_alive():
+            self.process.kill()
+        self.process.join(timeout=5)
+        for job_id in list(self.pending):
+            self.finish_job(job_id, None, 0.0, error)
+        self.n_restarts += 1
+        if self.n_restarts > self.MAX_RESTARTS:
+            logger.error("Analysis worker disabled, trials are detected in the GUI process", extra={"restarts": self.MAX_RESTARTS})
+            self.process = None
+            return
+        logger.warning("Analysis worker restarted", extra={"reason": error, "restarts": self.n_restarts})
+        self.start_process()
+
+    def stop(self):
+        if self.process is not None:
+            self.requests.put(None)
+            self.process.join(timeout=5)
+        for shm, _ in self.pending.values():
+            shm.close()
+            shm.unlink()
+        self.pending.clear()
@@ -0,0 +1,193 @@
+from collections import deque
+import numpy as np
+import neurokit2 as nk
+
+'''
+BeatDetector classes
+Common interface for R-peak detectors, so the detector used to count beats can be selected per session.
+Detectors are created by name from the DETECTORS registry with create_detector()
+'''
+class BeatDetector:
+    name = None
+    requires_ibi = False # True if the detector uses the inter-beat-intervals from the strap instead of the ECG
+
+    def find_peaks(self, wind_values, wind_times, sampling_rate):
+        '''Returns the indices of the R peaks in the window'''
+        raise NotImplementedError
+
+    def add_ibi(self, t, ibi):
+        pass
+
+class NeurokitDetector(BeatDetector):
+
+    def __init__(self, method="neurokit", clean=False):
+        self.method = method
+        self.clean = clean
+        self.name = method if not clean else f"{method}_clean"
+
+    def find_peaks(self, wind_values, wind_times, sampling_rate):
+        if self.clean:
+            wind_values = nk.ecg_clean(wind_values, sampling_rate=sampling_rate, method=self.method)
+        ecg_peaks = nk.ecg_findpeaks(wind_values, sampling_rate=sampling_rate, method=self.method)
+        return np.asarray(ecg_peaks['ECG_R_Peaks'], dtype=int)
+
+class StreamingDetector(BeatDetector):
+    '''
+    Native Pan-Tompkins style detector, processing one sample at a time in O(1).
+    Baseline removal -> derivative -> squaring -> moving window integration -> adaptive threshold
+    '''
+    name = "streaming"
+
+    def __init__(self, sampling_rate=130):
+        self.sampling_rate = sampling_rate
+        self.integration_len = max(1, int(0.15*sampling_rate))
+        self.refractory_len = int(0.25*sampling_rate)
+        self.learning_len = int(2*sampling_rate)
+        self.baseline_alpha = 1.0 - np.exp(-2*np.pi*0.5/sampling_rate) # ~0.5 Hz baseline tracker
+        self.reset()
+
+    def reset(self):
+        self.sample_id = 0
+        self.baseline = None
+        self.hp_hist = deque([0.0, 0.0], maxlen=2)
+        self.integration_buffer = deque(maxlen=self.integration_len)
+        self.integration_sum = 0.0
+        self.lookback = deque(maxlen=self.integration_len) # (sample_id, hp) before the threshold crossing
+        self.signal_level = None
+        self.noise_level = None
+        self.threshold = np.inf
+        self.learning_max = 0.0
+        self.learning_sum = 0.0
+        self.noise_peak = 0.0
+        self.in_qrs = False
+        self.qrs_peak_id = None
+        self.qrs_peak_hp = -np.inf
+        self.qrs_peak_mwi = 0.0
+        self.last_peak_id = -self.refractory_len
+
+    def process(self, values):
+        '''Feeds new samples to the detector, returns the sample ids of the R peaks completed by them'''
+        peak_ids = []
+        for x in values:
+            peak_id = self.process_sample(float(x))
+            if peak_id is not None:
+                peak_ids.append(peak_id)
+        return peak_ids
+
+    def process_sample(self, x):
+        if self.baseline is None:
+            self.baseline = x
+        self.baseline += self.baseline_alpha*(x - self.baseline)
+        hp = x - self.baseline
+        derivative = hp - self.hp_hist[0]
+        self.hp_hist.append(hp)
+
+        if len(self.integration_buffer) == self.integration_len:
+            self.integration_sum -= self.integration_buffer[0]
+        self.integration_buffer.append(derivative*derivative)
+        self.integration_sum += derivative*derivative
+        mwi = self.integration_sum/self.integration_len
+
+        sample_id = self.sample_id
+        self.sample_id += 1
+        peak_id = None
+
+        if self.signal_level is None:
+            self.learning_max = max(self.learning_max, mwi)
+            self.learning_sum += mwi
+            if self.sample_id >= self.learning_len:
+                self.set_levels(self.learning_max/3.0, 0.5*self.learning_sum/self.sample_id)
+        elif self.in_qrs:
+            if hp > self.qrs_peak_hp:
+                self.qrs_peak_hp, self.qrs_peak_id = hp, sample_id
+            self.qrs_peak_mwi = max(self.qrs_peak_mwi, mwi)
+            if mwi < self.threshold:
+                self.in_qrs = False
+                peak_id = self.qrs_peak_id
+                self.last_peak_id = peak_id
+                self.set_levels(0.125*self.qrs_peak_mwi + 0.875*self.signal_level, \
+                                0.125*self.noise_peak + 0.875*self.noise_level)
+                self.noise_peak = 0.0
+        elif mwi >= self.threshold and sample_id - self.last_peak_id > self.refractory_len:
+            self.in_qrs = True
+            self.qrs_peak_id, self.qrs_peak_hp = max(self.lookback, key=lambda s: s[1], default=(sample_id, hp))
+            if hp > self.qrs_peak_hp or self.qrs_peak_id <= self.last_peak_id:
+                self.qrs_peak_hp, self.qrs_peak_id = hp, sample_id
+            self.qrs_peak_mwi = mwi
+        else:
+            self.noise_peak = max(self.noise_peak, mwi)
+
+        self.lookback.append((sample_id, hp))
+        return peak_id
+
+    def set_levels(self, signal_level, noise_level):
+        self.signal_level = signal_level
+        self.noise_level = noise_level
+        self.threshold = noise_level + 0.25*(signal_level - noise_level)
+
+    def find_peaks(self, wind_values, wind_times, sampling_rate):
+        if sampling_rate != self.sampling_rate:
+            self.__init__(sampling_rate)
+        # Learn the thresholds from the start of the window, then detect over the whole window
+        self.reset()
+        self.process(wind_values[:self.learning_len])
+        signal_level, noise_level = self.signal_level, self.noise_level
+        self.reset()
+        if signal_level is not None:
+            self.set_levels(signal_level, noise_level)
+        peak_ids = self.process(wind_values)
+        self.reset()
+        return np.asarray(peak_ids, dtype=int)
+
+class IbiDetector(BeatDetector):
+    '''
+    Uses the inter-beat-intervals computed on the strap (0x2A37 Heart Rate Measurement) rather than the ECG.
+    Beat times are reconstructed from the intervals and mapped onto the nearest ECG sample in the window
+    '''
+    name = "ibi"
+    requires_ibi = True
+    MAX_BEAT_DRIFT_S = 1.0 # Re-anchor the beat times to the arrival time if they drift further than this
+
+    def __init__(self, hist_size=2000):
+        self.beat_times = deque(maxlen=hist_size)
+        self.last_beat_time = None
+
+    def add_ibi(self, t, ibi):
+        t = float(np.squeeze(t))
+        ibi_s = float(np.squeeze(ibi))/1000.0
+        if self.last_beat_time is None or abs(self.last_beat_time + ibi_s - t) > self.MAX_BEAT_DRIFT_S:
+            self.last_beat_time = t
+        else:
+            self.last_beat_time += ibi_s
+        self.beat_times.append(self.last_beat_time)
+
+    def find_peaks(self, wind_values, wind_times, sampling_rate):
+        if len(wind_times) == 0:
+            return np.array([], dtype=int)
+        beat_times = np.array(self.beat_times)
+        beat_times = beat_times[(beat_times >= wind_times[0]) & (beat_times <= wind_times[-1])]
+        ids = np.clip(np.searchsorted(wind_times, beat_times), 1, len(wind_times)-1)
+        nearer_left = (beat_times - wind_times[ids-1]) < (wind_times[ids] - beat_times)
+        return np.where(nearer_left, ids-1, ids).astype(int)
+
+
+DETECTORS = {
+    "neurokit": lambda: NeurokitDetector("neurokit"),
+    "pantompkins1985": lambda: NeurokitDetector("pantompkins1985", clean=True),
+    "hamilton2002": lambda: NeurokitDetector("hamilton2002", clean=True),
+    "elgendi2010": lambda: NeurokitDetector("elgendi2010", clean=True),
+    "engzeemod2012": lambda: NeurokitDetector("engzeemod2012", clean=True),
+    "christov2004": lambda: NeurokitDetector("christov2004"),
+    "nabian2018": lambda: NeurokitDetector("nabian2018"),
+    "rodrigues2021": lambda: NeurokitDetector("rodrigues2021"),
+    "streaming": lambda: StreamingDetector(),
+    "ibi": lambda: IbiDetector(),
+}
+
+def register_detector(name, factory):
+    DETECTORS[name] = factory
+
+def create_detector(name):
+    if name not in DETECTORS:
+        raise ValueError(f"Unknown beat detector '{name}', available detectors: {', '.join(DETECTORS)}")
+    return DETECTORS[name]()
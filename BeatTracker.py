@@ -3,45 +3,167 @@ matplotlib.use('Qt5Agg')
 
 import matplotlib.pyplot as plt
 import numpy as np
-import neurokit2 as nk
 from PySide6.QtCore import QObject
+from collections import deque
+import logging
+import time
+from BeatDetectors import create_detector, StreamingDetector
+from EcgFilter import EcgFilter, RobustRange
+from EcgHistory import TieredEcgHistory
+from EcgPyramid import MinMaxPyramid
+from HrvMetrics import HrvMetrics
+from Instrumentation import REGISTRY
+from Profiler import PROFILER
+from SharedEcgHistory import SharedEcgHistoryWriter
 import vars
+
+logger = logging.getLogger(__name__)
 ''' 
 BeatTracker class
-Tracks a rolling ecg signal history and calculate number of beats in a time window
+Tracks the ecg signal history of the whole session and calculate number of beats in a time window
+Incoming samples are also filtered as they arrive (EcgFilter), into a second history that the live display
+and the beat detectors read. The raw history is kept for export and review
 '''
 class BeatTracker(QObject):
 
     def __init__(self):
         super().__init__()
-        self.ECG_HIST_SIZE = 24000 # 3 minutes of history at 130 Hz
-        self.ecg_hist = np.full(self.ECG_HIST_SIZE, np.nan)
-        self.ecg_times = np.full(self.ECG_HIST_SIZE, np.nan)
+        self.history = TieredEcgHistory(vars.ECG_SAMPLING_RATE, vars.ECG_HOT_SAMPLES, vars.ECG_CHUNK_SAMPLES, \
+                                        vars.ECG_TIMEBASE_MAX_ERROR_S, vars.ECG_HISTORY_MAX_S, pyramid=MinMaxPyramid())
+        REGISTRY.gauge("ecg_history_bytes", "Memory held by the ECG history", callback=self.history.get_memory_bytes)
+        REGISTRY.gauge("ecg_history_samples", "Samples in the ECG history", callback=lambda: len(self.history))
+
+        # Filtered copy of the history, for the display and beat detection
+        self.ecg_filter = EcgFilter(vars.ECG_SAMPLING_RATE, vars.ECG_FILTER_HIGHPASS_HZ, vars.ECG_FILTER_NOTCH_HZ, \
+                                    vars.ECG_FILTER_NOTCH_Q, vars.ECG_FILTER_LOWPASS_HZ)
+        self.filtered_history = TieredEcgHistory(vars.ECG_SAMPLING_RATE, vars.ECG_HOT_SAMPLES, vars.ECG_CHUNK_SAMPLES, \
+                                                 vars.ECG_TIMEBASE_MAX_ERROR_S, vars.ECG_HISTORY_MAX_S)
+        self.display_range = RobustRange(vars.ECG_SAMPLING_RATE, window_s=vars.ECG_AUTORANGE_WINDOW_S) if vars.ECG_AUTORANGE else None
+        self.new_display_range = None # (min, max) not yet taken by pop_display_range()
         
         self.beat_count_measured = None
         self.beat_count_entered = None
+        self.analysis_cache = {} # (start_time, end_time, detector name) -> trial window analysis
+
+        # Live beat detection for the rolling heart rate and HRV metrics
+        self.live_detector = StreamingDetector(vars.ECG_SAMPLING_RATE)
+        self.live_times = deque(maxlen=vars.ECG_SAMPLING_RATE) # Times of the latest samples, for the detector lookback
+        self.hrv_metrics = HrvMetrics(vars.HRV_WINDOWS_S)
+        self.new_peak_times = deque(maxlen=vars.LIVE_PEAKS_MAX) # Live beats not yet taken by pop_new_peak_times()
+        self.detector_time = REGISTRY.histogram("detector_seconds", "Beat detection time per trial window")
+
+        # Copy of the history other processes can attach to, see SharedEcgHistory
+        self.shared_history = None
+        if vars.SHARED_ECG_HISTORY_NAME:
+            self.shared_history = SharedEcgHistoryWriter(vars.SHARED_ECG_HISTORY_NAME, vars.ECG_HOT_SAMPLES)
+
+        self.set_detector(vars.BEAT_DETECTOR)
+
+    def set_detector(self, name):
+        self.detector = create_detector(name)
+        self.invalidate_analysis()
+
+    def invalidate_analysis(self, start_time=None, end_time=None):
+        '''Drops the cached analysis of one window, or of all windows if no window is given'''
+        if start_time is None and end_time is None:
+            self.analysis_cache.clear()
+        else:
+            for key in [key for key in self.analysis_cache if key[:2] == (start_time, end_time)]:
+                del self.analysis_cache[key]
         
+    @PROFILER.profile("update_ecg_history")
     def update_ecg_history(self, t, ecg):
-        self.ecg_hist = np.roll(self.ecg_hist, -1)
-        self.ecg_hist[-1] = ecg
-        self.ecg_times = np.roll(self.ecg_times, -1)
-        self.ecg_times[-1] = t
+        self.history.append(t, ecg)
+        if self.shared_history is not None:
+            self.shared_history.write(t, ecg)
+        filtered = self.update_filtered_history(t, ecg)
+        self.update_live_metrics(t, filtered[0])
+
+    @PROFILER.profile("update_ecg_history")
+    def update_ecg_history_batch(self, times, values):
+        if len(values) == 0:
+            return
+        self.history.append(times, values)
+        if self.shared_history is not None:
+            self.shared_history.write(times, values)
+        filtered = self.update_filtered_history(times, values)
+        for t, ecg in zip(times, filtered):
+            self.update_live_metrics(t, ecg)
+
+    def update_filtered_history(self, times, values):
+        filtered = self.ecg_filter.process(values)
+        self.filtered_history.append(times, filtered)
+        if self.display_range is not None:
+            display_range = self.display_range.update(filtered)
+            if display_range is not None:
+                self.new_display_range = display_range
+        return filtered
+
+    def pop_display_range(self):
+        '''New y range for the live display, None if it hasn't changed enough to redraw'''
+        display_range, self.new_display_range = self.new_display_range, None
+        return display_range
+
+    def update_live_metrics(self, t, ecg):
+        self.live_times.append(float(np.squeeze(t)))
+        peak_id = self.live_detector.process_sample(float(np.squeeze(ecg)))
+        if peak_id is not None:
+            samples_ago = self.live_detector.sample_id - 1 - peak_id
+            if samples_ago < len(self.live_times):
+                peak_time = self.live_times[-1 - samples_ago]
+                self.hrv_metrics.add_beat(peak_time)
+                self.new_peak_times.append(peak_time)
+
+    def pop_new_peak_times(self):
+        peak_times = list(self.new_peak_times)
+        self.new_peak_times.clear()
+        return peak_times
+
+    def close(self):
+        if self.shared_history is not None:
+            self.shared_history.close()
+            self.shared_history = None
+
+    def update_ibi_history(self, t, ibi):
+        self.detector.add_ibi(t, ibi)
 
     def get_beat_count_from_wind(self, start_time, end_time):
-        wind_values, wind_times = self.get_ecg_wind(start_time, end_time)
-        ecg_peaks = nk.ecg_findpeaks(wind_values, sampling_rate=130) 
-        r_peak_ids = ecg_peaks['ECG_R_Peaks']
-        self.beat_count_measured = len(r_peak_ids)
-        print(f"R peaks: {r_peak_ids}")
-        # Show the start time error to 3 dp
-        print(f"Start time error: {start_time-wind_times[0]:.3f} s")
-        print(f"End time error: {end_time-wind_times[-1]:.3f} s")
-        print(f"Number of R peaks: {self.beat_count_measured:.0f}")
+        self.beat_count_measured = self.get_wind_analysis(start_time, end_time)["count"]
+        return self.beat_count_measured
+
+    def get_wind_analysis(self, start_time, end_time):
+        '''Peaks, RR intervals and beat count of a trial window, detected once per window and detector'''
+        key = (start_time, end_time, self.detector.name)
+        if key in self.analysis_cache:
+            return self.analysis_cache[key]
+
+        wind_values, wind_times = self.get_detection_wind(start_time, end_time)
+        t0 = time.perf_counter()
+        with PROFILER.span(f"find_peaks:{self.detector.name}"):
+            r_peak_ids = self.detector.find_peaks(wind_values, wind_times, vars.ECG_SAMPLING_RATE)
+        return self.store_wind_analysis(start_time, end_time, self.detector.name, wind_values, wind_times, r_peak_ids, time.perf_counter() - t0)
+
+    def store_wind_analysis(self, start_time, end_time, detector_name, wind_values, wind_times, r_peak_ids, detector_time_s):
+        '''Caches the analysis of a window from its detected peaks, which may have been found in another process'''
+        self.detector_time.observe(detector_time_s)
+        analysis = {"peak_ids": r_peak_ids, \
+                    "peak_times": wind_times[r_peak_ids], \
+                    "rr_intervals": np.diff(wind_times[r_peak_ids]), \
+                    "count": len(r_peak_ids), \
+                    "start_time_error": start_time-wind_times[0] if len(wind_times) else np.nan, \
+                    "end_time_error": end_time-wind_times[-1] if len(wind_times) else np.nan}
+        self.analysis_cache[(start_time, end_time, detector_name)] = analysis
+
+        logger.debug("R peaks", extra={"peak_ids": r_peak_ids.tolist()})
+        logger.info("Trial window analysed", extra={"detector": detector_name, "count": analysis["count"], \
+                                                    "detector_time_s": round(detector_time_s, 4), \
+                                                    "start_time_error_s": round(analysis["start_time_error"], 3), \
+                                                    "end_time_error_s": round(analysis["end_time_error"], 3)})
 
         if vars.SHOW_DEBUG_GRAPHS:
             self.plot_graph(wind_values, wind_times, r_peak_ids)
 
-        return self.beat_count_measured
+        return analysis
 
     def plot_graph(self, wind_values, wind_times, r_peak_ids):
         plt.figure()
@@ -52,6 +174,37 @@ class BeatTracker(QObject):
         plt.title('ECG Plot')
         plt.show()
 
+    def get_trial_window(self, start_time, length_s):
+        '''
+        (start time, end time) of a trial of exactly length_s of samples, starting with the first sample at or after
+        start_time. The times are those of the first and last samples, so the window holds that many samples
+        whatever the frame boundaries, and samples still on their way from the sensor are predicted by the timebase.
+        Without any ECG yet there's no timebase, and the start marker and length are used as they are
+        '''
+        if len(self.history) == 0:
+            logger.warning("Trial window without any ECG", extra={"start_time": start_time, "length_s": length_s})
+            return start_time, start_time + length_s
+        seq_lo = self.history.time_to_seq(start_time)
+        seq_lo += int(self.history.get_times(seq_lo, seq_lo+1)[0] < start_time)
+        seq_hi = seq_lo + int(round(length_s*vars.ECG_SAMPLING_RATE))
+        wind_start, wind_end = self.history.get_times(seq_lo, seq_lo+1)[0], self.history.get_times(seq_hi-1, seq_hi)[0]
+        logger.info("Trial window", extra={"start_seq": seq_lo, "end_seq": seq_hi, "n_samples": seq_hi - seq_lo, \
+                                           "start_marker_offset_s": round(wind_start - start_time, 4)})
+        return wind_start, wind_end
+
     def get_ecg_wind(self, start_time, end_time):
-        indices = np.where((self.ecg_times >= start_time) & (self.ecg_times <= end_time))
-        return self.ecg_hist[indices], self.ecg_times[indices]
\ No newline at end of file
+        return self.history.get_ecg_wind(start_time, end_time)
+
+    def get_detection_wind(self, start_time, end_time):
+        '''The trial window the beat detectors see: filtered, unless ECG_FILTER_DETECTION is off'''
+        if vars.ECG_FILTER_DETECTION:
+            return self.filtered_history.get_ecg_wind(start_time, end_time)
+        return self.history.get_ecg_wind(start_time, end_time)
+
+    def get_latest_ecg(self, n_samples):
+        '''(times, values) of the latest filtered samples, for the live display'''
+        return self.filtered_history.get_latest(n_samples)
+
+    def get_ecg_since(self, seq, max_samples):
+        '''Filtered samples added since seq was returned by the last call, for incremental displays'''
+        return self.filtered_history.get_since(seq, max_samples)
\ No newline at end of file
@@ -1,16 +1,23 @@
 import asyncio
 from enum import Enum
+import logging
 import time
-from PySide6.QtCore import Signal, Slot, QTimer, QTime, QObject
+from PySide6.QtCore import Qt, Signal, Slot, QTimer, QTime, QObject
 from Model import Model
-from View import View
+import Protocol
+from View import View, OperatorPanel
+from EcgReview import EcgReviewWindow
+from PowerManager import PowerManager
 import numpy as np
+from Instrumentation import REGISTRY
+from Profiler import PROFILER
 import vars
 
+logger = logging.getLogger(__name__)
+
 '''
 TODO:
 - Write README.md
-- Show Accuracy and Awareness scores over time
 '''
 class ControlState(Enum):
     SCANNING = 1
@@ -21,37 +28,89 @@ class ControlState(Enum):
     RECORDING_INPUT = 6
     RECORDING_CONFIDENCE = 7
     RESULTS = 8
+    SCORING = 9
+    FEEDBACK = 10
+    SENSOR_ERROR = 11
 
 class Controller:
     
-    def __init__(self):
+    def __init__(self, beat_detector=None):
         self.model = Model()
+        self.beat_detector = beat_detector if beat_detector is not None else vars.BEAT_DETECTOR
         self.view = View()
 
         self.view.setWindowTitle("Beat Tracker")
         self.view.resize(800, 500)
         self.view.show()
+        if vars.SHOW_PROGRESS:
+            self.view.update_progress(self.model.getProgress(), show=True)
+
+        self.operator_panel = None
+        if vars.SHOW_OPERATOR_PANEL:
+            self.operator_panel = OperatorPanel(vars.HRV_WINDOWS_S)
+            self.operator_panel.show()
 
         self.state = ControlState.SCANNING
         self.initialising_timer = QTimer()
         self.recording_timer = CountdownTimer()
 
         self.model.sensorConnected.connect(self.sensorConnectedHandler)
+        self.model.sensorError.connect(self.sensorErrorHandler)
+        self.model.trialAnalysed.connect(self.trialAnalysedHandler)
         self.initialising_timer.timeout.connect(self.initialisingTimerFinishedHandler)
         self.recording_timer.timerFinished.connect(self.recordingTimerFinishedHandler)
         self.view.controls_widget.start_button.clicked.connect(self.buttonPressedHandler)
+        self.view.profiler_shortcut.activated.connect(PROFILER.toggle)
+        self.view.review_shortcut.activated.connect(self.openReviewWindow)
+        self.view.controls_widget.user_selector.userSelected.connect(self.userSelectedHandler)
         
+        self.ecg_display_seq = 0 # Next ECG sample for the sweep display
+        self.render_time = REGISTRY.histogram("render_seconds", "Time to update the live ECG series")
+        self.cue_latency = REGISTRY.histogram("cue_latency_seconds", "Time from the start button to the start cue being painted")
         self.configureSeriesTimer()
 
-        self.trials_per_session = len(vars.TRIAL_LENGTHS_S)
+        self.power = PowerManager(vars.AWAY_TIMEOUT_S, vars.POWER_SAVING)
+        self.power.powerModeChanged.connect(self.powerModeChangedHandler)
+        self.view.visibilityChanged.connect(self.power.set_visible)
+        self.power.set_visible(self.view.isShown())
+        self.power.set_state(self.state.name)
+
+        self.protocol = Protocol.load_protocol(vars.PROTOCOL)
+        self.schedule = None
+        self.trials_per_session = 0
         self.trial_id = -1
-        self.trial_lengths_s = np.array(vars.TRIAL_LENGTHS_S, copy=True)
-        np.random.shuffle(self.trial_lengths_s)
+        self.sensor_error = None # Why the ingest thread stopped, until the sensor is reconnected
+        self.state_before_error = None
 
     @Slot()
     def sensorConnectedHandler(self):
         if self.state == ControlState.SCANNING:
-            self.changeState(ControlState.INITIALISING)
+            self.changeState(self.stateAfterReconnect())
+
+    @Slot(str)
+    def sensorErrorHandler(self, message):
+        logger.error("Sensor lost", extra={"error": message, "state": self.state.name})
+        if self.state == ControlState.SENSOR_ERROR:
+            return
+        self.sensor_error = message
+        self.state_before_error = self.state
+        self.changeState(ControlState.SENSOR_ERROR)
+
+    def stateAfterReconnect(self):
+        '''Picks the session up where the sensor was lost. A trial it was lost during is done again'''
+        resume_state, self.state_before_error = self.state_before_error, None
+        self.sensor_error = None
+        if resume_state in (ControlState.READY_TO_START, ControlState.RECORDING_BEATS, ControlState.RECORDING_INPUT, \
+                            ControlState.RECORDING_CONFIDENCE):
+            self.trial_id -= 1 # Entering READY_TO_START moves on to it again
+            return ControlState.READY_TO_START
+        if resume_state == ControlState.SCORING:
+            return ControlState.SCORING if self.model.analysisPending() else self.nextStateAfterScoring()
+        if resume_state == ControlState.FEEDBACK:
+            return ControlState.FEEDBACK
+        if resume_state in (ControlState.SESSION_INTRO, ControlState.RESULTS):
+            return ControlState.SESSION_INTRO # The results were saved when they were shown
+        return ControlState.INITIALISING
 
     @Slot()
     def initialisingTimerFinishedHandler(self):
@@ -63,15 +122,55 @@ class Controller:
         if self.state == ControlState.RECORDING_BEATS:
             self.changeState(ControlState.RECORDING_INPUT)
 
+    @Slot()
+    def trialAnalysedHandler(self):
+        if self.state == ControlState.SCORING and not self.model.analysisPending():
+            self.changeState(self.nextStateAfterScoring())
+
+    @Slot(str)
+    def userSelectedHandler(self, name):
+        self.power.user_activity()
+        if self.state != ControlState.SESSION_INTRO:
+            return
+        if self.trial_id >= 0:
+            # A resumed session belongs to the user who started it
+            self.view.controls_widget.user_selector.setUsers(self.model.getUsers(), self.model.getUserName())
+            return
+        self.model.setUser(name)
+        self.view.controls_widget.user_selector.setUsers(self.model.getUsers(), self.model.getUserName())
+        if vars.SHOW_PROGRESS:
+            self.view.update_progress(self.model.getProgress(), show=True)
+
+    @Slot(str)
+    def powerModeChangedHandler(self, mode):
+        self.model.setIngestPollPeriod(self.power.ingest_period_s)
+        if self.power.render_period_ms is None:
+            self.update_ecg_series_timer.stop()
+            return
+        if not self.update_ecg_series_timer.isActive():
+            self.updateViewWithModelData() # Catch up on what was missed straight away
+        self.update_ecg_series_timer.start(self.power.render_period_ms)
+
     @Slot()
     def buttonPressedHandler(self):
-        if self.state == ControlState.READY_TO_START:
+        self.power.user_activity()
+        if self.state == ControlState.SENSOR_ERROR:
+            self.model.reconnectSensor()
+            self.changeState(ControlState.SCANNING)
+        elif self.state == ControlState.READY_TO_START:
             self.changeState(ControlState.RECORDING_BEATS)
         elif self.state == ControlState.SESSION_INTRO:
             self.changeState(ControlState.READY_TO_START)
         elif self.state == ControlState.RECORDING_INPUT:
             self.changeState(ControlState.RECORDING_CONFIDENCE)
         elif self.state == ControlState.RECORDING_CONFIDENCE:
+            if self.currentTrial()["feedback"] or self.trial_id == self.trials_per_session-1:
+                self.changeState(ControlState.SCORING)
+                if not self.model.analysisPending():
+                    self.changeState(self.nextStateAfterScoring())
+            else:
+                self.changeState(ControlState.READY_TO_START)
+        elif self.state == ControlState.FEEDBACK:
             if self.trial_id < self.trials_per_session-1:
                 self.changeState(ControlState.READY_TO_START)
             else:
@@ -79,6 +178,12 @@ class Controller:
         elif self.state == ControlState.RESULTS:
             self.changeState(ControlState.SESSION_INTRO)
 
+    def currentTrial(self):
+        return self.schedule["trials"][self.trial_id]
+
+    def nextStateAfterScoring(self):
+        return ControlState.FEEDBACK if self.currentTrial()["feedback"] else ControlState.RESULTS
+
     def changeState(self, newState):
         exitStateHandler = {
             ControlState.SCANNING: None,
@@ -88,49 +193,77 @@ class Controller:
             ControlState.RECORDING_BEATS: None,
             ControlState.RECORDING_INPUT: None,
             ControlState.RECORDING_CONFIDENCE: self.exitRecordingConfidenceState,
-            ControlState.RESULTS: None
+            ControlState.RESULTS: None,
+            ControlState.SCORING: None,
+            ControlState.FEEDBACK: None,
+            ControlState.SENSOR_ERROR: None
         }
         if exitStateHandler[self.state] is not None:
             exitStateHandler[self.state]()
         
         enterStateHandler = {
-            ControlState.SCANNING: None,
+            ControlState.SCANNING: self.enterScanningState,
             ControlState.INITIALISING: self.enterInitialisingState,
             ControlState.SESSION_INTRO: self.enterSessionIntroState,
             ControlState.READY_TO_START: self.enterReadyToStartState,
             ControlState.RECORDING_BEATS: self.enterRecordingBeatsState,
             ControlState.RECORDING_INPUT: self.enterRecordingInputState,
             ControlState.RECORDING_CONFIDENCE: self.enterRecordingConfidenceState,
-            ControlState.RESULTS: self.enterResultsState
+            ControlState.RESULTS: self.enterResultsState,
+            ControlState.SCORING: self.enterScoringState,
+            ControlState.FEEDBACK: self.enterFeedbackState,
+            ControlState.SENSOR_ERROR: self.enterSensorErrorState
         }
         if enterStateHandler[newState] is not None:
             enterStateHandler[newState]()
         self.state = newState
+        self.power.set_state(newState.name, recording=newState == ControlState.RECORDING_BEATS)
+        if self.operator_panel is not None:
+            self.operator_panel.update_state(newState.name)
+
+    def enterScanningState(self):
+        self.view.control_scanning()
 
     def enterInitialisingState(self):
         self.initialising_timer.setSingleShot(True)
         self.initialising_timer.start(4000)
     
     def enterSessionIntroState(self):
-        self.view.control_session_intro(self.trial_lengths_s)
-        self.model.resetSession()
-        self.trial_id = -1
+        resumed = self.model.resumeInterruptedSession()
+        if resumed is not None:
+            self.schedule, n_trials_done = resumed # Carries on from the trial after the last one logged
+        else:
+            self.schedule = Protocol.compile_schedule(self.protocol, vars.PROTOCOL_SEED) # A new order each session unless seeded
+            self.model.resetSession(self.beat_detector, self.schedule)
+            n_trials_done = 0
+        self.trials_per_session = len(self.schedule["trials"])
+        n_training = self.trials_per_session - len(Protocol.get_scored_lengths(self.schedule))
+        self.view.control_session_intro(Protocol.get_scored_lengths(self.schedule), self.model.getUsers(), self.model.getUserName(), n_training)
+        self.trial_id = n_trials_done - 1
+        logger.info("Session schedule", extra={"protocol": self.schedule["protocol"], "seed": self.schedule["seed"], \
+                                               "trial_lengths": [trial["length_s"] for trial in self.schedule["trials"]]})
 
     def enterReadyToStartState(self):
         self.trial_id += 1
-        self.recording_timer.initTimer(self.trial_lengths_s[self.trial_id])
-        self.view.control_ready_to_start(self.trial_id+1, self.trials_per_session)
+        self.recording_timer.initTimer(self.currentTrial()["length_s"])
+        self.view.control_ready_to_start(self.trial_id+1, self.trials_per_session, self.currentTrial()["training"])
         self.record_start_time = None
         self.record_end_time = None
         self.beat_count_estimate = None
 
     def enterRecordingBeatsState(self):
+        pressed = time.monotonic()
         self.view.control_recording_beats()
-        self.recording_timer.startTimer()
-        self.record_start_time = time.time_ns()/1.0e9
+        self.view.repaint() # Paint the start cue now, not whenever the event loop gets round to it
+        painted = time.monotonic()
+        self.cue_latency.observe(painted - pressed)
+        # The trial starts when the cue is on the screen, in the sensor's time. The countdown runs from the paint,
+        # so the end cue is on the screen one display latency after the deadline too
+        self.recording_timer.startTimer(painted)
+        self.record_start_time = self.model.getSensorTime(painted + vars.DISPLAY_LATENCY_S)
 
     def enterRecordingInputState(self):
-        self.record_end_time = time.time_ns()/1.0e9
+        self.record_end_time = self.model.getSensorTime(time.monotonic() + vars.DISPLAY_LATENCY_S)
         self.view.control_recording_input()
 
     def enterRecordingConfidenceState(self):
@@ -138,20 +271,60 @@ class Controller:
         self.view.control_recording_confidence()
 
     def exitRecordingConfidenceState(self):
-        self.model.calculateTrialResults(self.trial_lengths_s[self.trial_id], self.record_start_time, self.record_end_time, \
-                                         self.beat_count_estimate, self.view.controls_widget.confidence_scale.value())
+        if self.sensor_error is not None:
+            return # The trial is done again once the sensor is back
+        # The scored window is exactly the trial length of samples from the start marker, the end cue is only logged
+        start_time, end_time = self.model.getTrialWindow(self.record_start_time, self.currentTrial()["length_s"])
+        logger.info("Trial markers", extra={"start_time": start_time, "end_time": end_time, \
+                                            "end_cue_error_s": round(self.record_end_time - end_time, 4)})
+        self.model.submitTrialResults(self.currentTrial()["length_s"], start_time, end_time, \
+                                         self.beat_count_estimate, self.view.controls_widget.confidence_scale.value(), \
+                                         self.currentTrial()["training"])
+
+    def enterSensorErrorState(self):
+        self.view.control_sensor_error(self.sensor_error)
+
+    def enterScoringState(self):
+        self.view.control_scoring()
+
+    def enterFeedbackState(self):
+        trial = self.model.getLastTrial()
+        self.view.control_feedback(trial["count_measured"], trial["count_entered"], trial["accuracy"], \
+                                   last_trial=self.trial_id == self.trials_per_session-1)
 
     def enterResultsState(self):
         session_results = self.model.calculateSessionResults()
         self.view.control_results(session_results["accuracy_score"], session_results["accuracy_percentile"], \
                                   session_results["awareness_score"], session_results["awareness_percentile"], \
-                                  session_results["awareness_p_value"])
+                                  session_results["awareness_p_value"], session_results["accuracy_ci"], \
+                                  session_results["awareness_ci"], session_results["awareness_permutation_p"])
         self.model.viewResults()
+        if vars.SHOW_PROGRESS:
+            self.view.update_progress(self.model.getProgress(), show=True)
         
+    def openReviewWindow(self):
+        regions, beat_times = self.model.getReviewMarkers()
+        self.review_window = EcgReviewWindow(self.model.beat_tracker.history, regions, beat_times, "ECG review - this session")
+        self.review_window.show()
+
     # View update functions
     def updateViewWithModelData(self):
-        ecg_times_rel_s = self.model.beat_tracker.ecg_times - time.time_ns()/1.0e9
-        self.view.update_ecg_series(ecg_times_rel_s, self.model.beat_tracker.ecg_hist)
+        with self.render_time.time(), PROFILER.span("update_ecg_series"):
+            n_display_samples = int(vars.ECG_TIME_RANGE*vars.ECG_SAMPLING_RATE)
+            if self.view.sweep_ecg is not None:
+                ecg_times, ecg_values, self.ecg_display_seq = self.model.beat_tracker.get_ecg_since(self.ecg_display_seq, n_display_samples)
+                self.view.append_ecg_samples(ecg_times, ecg_values)
+            else:
+                ecg_times, ecg_values = self.model.beat_tracker.get_latest_ecg(n_display_samples)
+                self.view.update_ecg_series(ecg_times - time.time_ns()/1.0e9, ecg_values)
+            display_range = self.model.beat_tracker.pop_display_range()
+            if display_range is not None:
+                self.view.set_ecg_y_range(*display_range)
+
+    def updateOperatorPanel(self):
+        now = time.time_ns()/1.0e9
+        hrv_metrics = self.model.beat_tracker.hrv_metrics
+        self.operator_panel.update_metrics({window_s: hrv_metrics.get_metrics(window_s, now) for window_s in vars.HRV_WINDOWS_S})
 
     def configureSeriesTimer(self):
             self.update_ecg_series_timer = QTimer()
@@ -159,32 +332,54 @@ class Controller:
             self.update_ecg_series_timer.setInterval(vars.UPDATE_ECG_SERIES_PERIOD)
             self.update_ecg_series_timer.start()
 
+            if self.operator_panel is not None:
+                self.update_operator_panel_timer = QTimer()
+                self.update_operator_panel_timer.timeout.connect(self.updateOperatorPanel)
+                self.update_operator_panel_timer.setInterval(vars.UPDATE_OPERATOR_PANEL_PERIOD)
+                self.update_operator_panel_timer.start()
+
     async def main(self):
-        await self.model.connect_polar()
-        await asyncio.gather(self.model.update_ecg())
+        if vars.INGEST_MODE == "thread":
+            self.model.start_ingest_thread()
+            await self.model.pump_ingest()
+        else:
+            await self.model.connect_polar()
+            await asyncio.gather(self.model.update_ecg())
 
 class CountdownTimer(QObject):
+    '''
+    Counts down to a deadline on the monotonic clock. Each tick is scheduled from the time left, so late ticks
+    don't add up, and the last one fires at the deadline rather than on a whole second
+    '''
     timerFinished = Signal()
 
     def __init__(self):
         super().__init__()
 
         self.timer = QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.setTimerType(Qt.PreciseTimer)
         self.timer.timeout.connect(self.updateTimer)
+        self.duration_s = 0
+        self.deadline = None
 
     def initTimer(self, duration_s):
-        self.countdown_time = QTime(0, 0, duration_s)
+        self.timer.stop()
+        self.duration_s = duration_s
+        self.deadline = None
 
     def updateTimer(self):
-        self.countdown_time = self.countdown_time.addSecs(-1)
-        print(f"Countdown: {self.countdown_time.toString('mm:ss')}")
-
-        # Stop the timer if the countdown has finished
-        if self.countdown_time == QTime(0, 0, 0):
-            self.timer.stop()
+        remaining = self.deadline - time.monotonic()
+        if remaining <= 0.0005:
+            self.deadline = None
             self.timerFinished.emit()
+            return
+        logger.debug("Countdown", extra={"remaining": QTime(0, 0, 0).addSecs(int(np.ceil(remaining))).toString('mm:ss')})
+        # Next whole second of the countdown, or the deadline
+        self.timer.start(int(np.ceil((remaining % 1.0 or 1.0)*1000)))
 
-    def startTimer(self):
-        if not self.timer.isActive():
-            self.timer.start(1000)
-    
+    def startTimer(self, start_time=None):
+        '''Starts counting down from start_time, a time.monotonic() reading (now if not given)'''
+        if self.deadline is None:
+            self.deadline = (time.monotonic() if start_time is None else start_time) + self.duration_s
+            self.updateTimer()
@@ -0,0 +1,157 @@
+import argparse
+import glob
+import os
+import time
+import numpy as np
+from BeatDetectors import DETECTORS, create_detector
+import vars
+
+'''
+Beat detector benchmark
+Runs every registered detector over a set of labelled recordings and reports sensitivity/PPV,
+the beat count error per trial, and the detection time in µs per second of signal.
+
+Each recording is a .npz file containing:
+- ecg: ECG samples in microvolts
+- r_peaks: labelled R peak sample indices
+- sampling_rate (optional): defaults to vars.ECG_SAMPLING_RATE
+- times (optional): sample times in seconds, defaults to the sample index over the sampling rate
+- trials (optional): (n, 2) array of trial start and end times in seconds, defaults to the whole recording
+- ibi_times, ibi (optional): arrival times (s) and inter-beat-intervals (ms) from the strap, needed by the "ibi" detector
+
+Usage:
+    python DetectorBenchmark.py recordings/ [--detectors neurokit streaming] [--tolerance 0.05] [--min-accuracy 0.99]
+'''
+
+class Recording:
+
+    def __init__(self, filepath):
+        data = np.load(filepath)
+        self.name = os.path.basename(filepath)
+        self.ecg = np.asarray(data["ecg"], dtype=float)
+        self.r_peaks = np.sort(np.asarray(data["r_peaks"], dtype=int))
+        self.sampling_rate = float(data["sampling_rate"]) if "sampling_rate" in data else vars.ECG_SAMPLING_RATE
+        self.times = np.asarray(data["times"], dtype=float) if "times" in data else np.arange(len(self.ecg))/self.sampling_rate
+        self.trials = np.asarray(data["trials"], dtype=float).reshape(-1, 2) if "trials" in data else np.array([[self.times[0], self.times[-1]]])
+        self.ibi_times = np.asarray(data["ibi_times"], dtype=float) if "ibi_times" in data else None
+        self.ibi = np.asarray(data["ibi"], dtype=float) if "ibi" in data else None
+
+    def duration(self):
+        return len(self.ecg)/self.sampling_rate
+
+    def has_ibi(self):
+        return self.ibi_times is not None and self.ibi is not None
+
+def load_recordings(path):
+    filepaths = sorted(glob.glob(os.path.join(path, "*.npz"))) if os.path.isdir(path) else [path]
+    return [Recording(filepath) for filepath in filepaths]
+
+def match_peaks(detected, labelled, tolerance_samples):
+    '''Greedy one-to-one matching of sorted peak indices, returns (true positives, false positives, false negatives)'''
+    detected = np.sort(detected)
+    true_positives = 0
+    i = j = 0
+    while i < len(detected) and j < len(labelled):
+        if abs(detected[i] - labelled[j]) <= tolerance_samples:
+            true_positives += 1
+            i += 1
+            j += 1
+        elif detected[i] < labelled[j]:
+            i += 1
+        else:
+            j += 1
+    return true_positives, len(detected) - true_positives, len(labelled) - true_positives
+
+def make_detector(name, recording):
+    detector = create_detector(name)
+    if detector.requires_ibi:
+        for t, ibi in zip(recording.ibi_times, recording.ibi):
+            detector.add_ibi(t, ibi)
+    return detector
+
+def benchmark_detector(name, recordings, tolerance_s=0.05, repeats=3):
+    true_positives = false_positives = false_negatives = 0
+    count_errors = []
+    elapsed_s = 0.0
+    signal_s = 0.0
+
+    for recording in recordings:
+        detector = make_detector(name, recording)
+
+        # Accuracy and speed over the whole recording, keeping the fastest of the repeats
+        best_s = np.inf
+        for _ in range(repeats):
+            t0 = time.perf_counter()
+            detected = detector.find_peaks(recording.ecg, recording.times, recording.sampling_rate)
+            best_s = min(best_s, time.perf_counter() - t0)
+        elapsed_s += best_s
+        signal_s += recording.duration()
+
+        tp, fp, fn = match_peaks(detected, recording.r_peaks, tolerance_s*recording.sampling_rate)
+        true_positives += tp
+        false_positives += fp
+        false_negatives += fn
+
+        # Beat count error per trial, detecting over the trial window only, as in the app
+        for start_time, end_time in recording.trials:
+            in_wind = (recording.times >= start_time) & (recording.times <= end_time)
+            wind_ids = np.flatnonzero(in_wind)
+            count_detected = len(detector.find_peaks(recording.ecg[in_wind], recording.times[in_wind], recording.sampling_rate))
+            count_labelled = np.count_nonzero(np.isin(recording.r_peaks, wind_ids))
+            count_errors.append(count_detected - count_labelled)
+
+    count_errors = np.array(count_errors)
+    return {"detector": name, \
+            "sensitivity": true_positives/max(true_positives + false_negatives, 1), \
+            "ppv": true_positives/max(true_positives + false_positives, 1), \
+            "count_errors": count_errors, \
+            "mean_abs_count_error": float(np.mean(np.abs(count_errors))) if len(count_errors) else np.nan, \
+            "us_per_s": 1.0e6*elapsed_s/signal_s if signal_s > 0 else np.nan}
+
+def run_benchmark(recordings, detector_names=None, tolerance_s=0.05, repeats=3):
+    if detector_names is None:
+        detector_names = list(DETECTORS)
+    results = []
+    for name in detector_names:
+        usable_recordings = recordings
+        if create_detector(name).requires_ibi:
+            usable_recordings = [recording for recording in recordings if recording.has_ibi()]
+        if not usable_recordings:
+            print(f"Skipping {name}: no recordings with inter-beat-intervals")
+            continue
+        try:
+            results.append(benchmark_detector(name, usable_recordings, tolerance_s, repeats))
+        except Exception as e:
+            print(f"Skipping {name}: {e}")
+    return results
+
+def select_detector(results, min_accuracy):
+    '''Fastest detector whose sensitivity and PPV both reach min_accuracy'''
+    accurate = [result for result in results if result["sensitivity"] >= min_accuracy and result["ppv"] >= min_accuracy]
+    return min(accurate, key=lambda result: result["us_per_s"]) if accurate else None
+
+def print_results(results):
+    print(f"{'Detector':<20}{'Sensitivity':>12}{'PPV':>8}{'|Count err|':>13}{'µs/s signal':>14}  Count error per trial")
+    for result in sorted(results, key=lambda result: result["us_per_s"]):
+        print(f"{result['detector']:<20}{result['sensitivity']:>12.4f}{result['ppv']:>8.4f}{result['mean_abs_count_error']:>13.2f}" \
+              f"{result['us_per_s']:>14.1f}  {result['count_errors'].tolist()}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the beat detectors on labelled recordings")
+    parser.add_argument("recordings", help="Directory of .npz recordings, or a single .npz file")
+    parser.add_argument("--detectors", nargs="+", choices=list(DETECTORS), default=None)
+    parser.add_argument("--tolerance", type=float, default=0.05, help="Matching tolerance for R peaks in seconds")
+    parser.add_argument("--repeats", type=int, default=3, help="Timing repeats per recording, the fastest is kept")
+    parser.add_argument("--min-accuracy", type=float, default=0.99, help="Minimum sensitivity and PPV of the selected detector")
+    args = parser.parse_args()
+
+    recordings = load_recordings(args.recordings)
+    print(f"Loaded {len(recordings)} recordings, {sum(recording.duration() for recording in recordings):.0f} s of signal")
+    results = run_benchmark(recordings, args.detectors, args.tolerance, args.repeats)
+    print_results(results)
+
+    best = select_detector(results, args.min_accuracy)
+    if best is None:
+        print(f"No detector reached a sensitivity and PPV of {args.min_accuracy}")
+    else:
+        print(f"Fastest detector with sensitivity and PPV >= {args.min_accuracy}: {best['detector']} ({best['us_per_s']:.1f} µs/s)")
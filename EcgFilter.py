@@ -0,0 +1,80 @@
+from collections import deque
+import numpy as np
+import scipy.signal
+
+'''
+EcgFilter class
+Streaming ECG filter: high-pass for baseline wander, a mains notch and an optional low-pass, cascaded as
+second-order sections. The filter state is carried from one frame to the next, so each frame is filtered in
+O(frame length) and the output is the same as filtering the whole recording at once.
+
+RobustRange class
+Display range from running robust statistics: the median of the per-second minima and maxima over the last
+few seconds, so one artefact doesn't squash the trace and baseline wander doesn't push it off-screen.
+A new range is only reported when it moves by more than a fraction of the span, so the display isn't rescaled
+every frame
+'''
+def design_ecg_sos(sampling_rate, highpass_hz=0.5, notch_hz=50.0, notch_q=30.0, lowpass_hz=None, order=2):
+    nyquist = 0.5*sampling_rate
+    sections = []
+    if highpass_hz:
+        sections.append(scipy.signal.butter(order, highpass_hz, btype="highpass", fs=sampling_rate, output="sos"))
+    if notch_hz and notch_hz < nyquist:
+        b, a = scipy.signal.iirnotch(notch_hz, notch_q, fs=sampling_rate)
+        sections.append(scipy.signal.tf2sos(b, a))
+    if lowpass_hz and lowpass_hz < nyquist:
+        sections.append(scipy.signal.butter(order, lowpass_hz, btype="lowpass", fs=sampling_rate, output="sos"))
+    return np.vstack(sections) if sections else None
+
+class EcgFilter:
+
+    def __init__(self, sampling_rate, highpass_hz=0.5, notch_hz=50.0, notch_q=30.0, lowpass_hz=None):
+        self.sos = design_ecg_sos(sampling_rate, highpass_hz, notch_hz, notch_q, lowpass_hz)
+        self.zi = None
+
+    def reset(self):
+        self.zi = None
+
+    def process(self, values):
+        '''Filters the next frame of samples, continuing from the state left by the previous frame'''
+        values = np.atleast_1d(np.asarray(values, dtype=np.float64)).ravel()
+        if self.sos is None or len(values) == 0:
+            return values
+        if self.zi is None:
+            # Start in the steady state for the first sample, so there's no step transient
+            self.zi = scipy.signal.sosfilt_zi(self.sos)*values[0]
+        filtered, self.zi = scipy.signal.sosfilt(self.sos, values, zi=self.zi)
+        return filtered
+
+class RobustRange:
+
+    def __init__(self, sampling_rate, block_s=1.0, window_s=10.0, padding=0.15, hysteresis=0.1):
+        self.block_len = max(int(block_s*sampling_rate), 1)
+        self.block_mins = deque(maxlen=max(int(window_s/block_s), 1))
+        self.block_maxs = deque(maxlen=max(int(window_s/block_s), 1))
+        self.block = []
+        self.padding = padding
+        self.hysteresis = hysteresis
+        self.range = None
+
+    def update(self, values):
+        '''Adds samples, returns the new (min, max) if the range should change, otherwise None'''
+        self.block.extend(np.asarray(values, dtype=np.float64).ravel().tolist())
+        completed = False
+        while len(self.block) >= self.block_len:
+            block, self.block = self.block[:self.block_len], self.block[self.block_len:]
+            self.block_mins.append(min(block))
+            self.block_maxs.append(max(block))
+            completed = True
+        if not completed:
+            return None
+
+        low, high = float(np.median(self.block_mins)), float(np.median(self.block_maxs))
+        span = max(high - low, 1.0)
+        new_range = (low - self.padding*span, high + self.padding*span)
+        if self.range is not None:
+            current_span = self.range[1] - self.range[0]
+            if abs(new_range[0] - self.range[0]) < self.hysteresis*current_span and abs(new_range[1] - self.range[1]) < self.hysteresis*current_span:
+                return None
+        self.range = new_range
+        return self.range
@@ -0,0 +1,199 @@
+import zlib
+from collections import OrderedDict
+import numpy as np
+
+'''
+TieredEcgHistory class
+Whole-session ECG history in a few MB.
+
+Samples are numbered by a running sequence number and their times aren't stored. A timebase of segments
+(first sequence number, t0, rate) gives the time of any sample as t0 + (seq - first)/rate. A new segment starts
+whenever an incoming time is more than max_time_error from the timebase's prediction (dropped frames, clock
+corrections), so reconstructed times are always within max_time_error of the received ones.
+
+Values are kept as int32 (the sensor's samples are 24 bit µV) in two tiers:
+- hot: a ring of the latest hot_capacity samples, for the live display and recent windows
+- cold: sealed chunks of chunk_size samples, delta encoded and zlib compressed, for everything older
+get_ecg_wind() and get_latest() return float64 values and times whichever tiers the samples come from.
+An optional MinMaxPyramid is kept up to date alongside, for drawing long stretches of the history quickly
+'''
+class TieredEcgHistory:
+
+    def __init__(self, sampling_rate, hot_capacity=8192, chunk_size=4096, max_time_error=0.001, max_duration_s=None, n_cached_chunks=4, pyramid=None):
+        if 2*chunk_size > hot_capacity:
+            raise ValueError("hot_capacity must hold at least two chunks")
+        self.sampling_rate = sampling_rate
+        self.hot_capacity = hot_capacity
+        self.chunk_size = chunk_size
+        self.max_time_error = max_time_error
+        self.max_chunks = int(np.ceil(max_duration_s*sampling_rate/chunk_size)) if max_duration_s else None
+
+        self.hot = np.zeros(hot_capacity, dtype=np.int32)
+        self.seq = 0 # Sequence number of the next sample
+        self.first_seq = 0 # Oldest sample still held (older chunks are dropped after max_duration_s)
+        self.sealed_seq = 0 # Samples before this are in cold chunks
+
+        # Timebase segments as parallel lists, searched with np.searchsorted
+        self.segment_seqs = []
+        self.segment_t0s = []
+        self.segment_rates = []
+        self.last_time = None
+
+        # Cold chunks: first sequence number -> (dtype, first value, compressed deltas)
+        self.chunk_seqs = []
+        self.chunks = []
+        self.chunk_cache = OrderedDict() # Recently decompressed chunks, for repeated window queries
+        self.n_cached_chunks = n_cached_chunks
+        self.compressed_bytes = 0
+        self.pyramid = pyramid
+
+    def __len__(self):
+        return self.seq - self.first_seq
+
+    def append(self, times, values):
+        times = np.atleast_1d(np.asarray(times, dtype=np.float64)).ravel()
+        values = np.rint(np.atleast_1d(np.asarray(values, dtype=np.float64)).ravel()).astype(np.int32)
+        if len(values) == 0:
+            return
+        self.update_timebase(times)
+        if self.pyramid is not None:
+            self.pyramid.append(values)
+
+        # Into the hot ring, which always has room for the samples not yet sealed
+        for start in range(0, len(values), self.chunk_size):
+            block = values[start:start+self.chunk_size]
+            ids = (self.seq + np.arange(len(block))) % self.hot_capacity
+            self.hot[ids] = block
+            self.seq += len(block)
+            while self.seq - self.sealed_seq >= self.chunk_size:
+                self.seal_chunk()
+
+    def update_timebase(self, times):
+        seqs = self.seq + np.arange(len(times))
+        start = 0
+        while start < len(times):
+            if self.segment_seqs:
+                predicted = self.segment_t0s[-1] + (seqs[start:] - self.segment_seqs[-1])/self.segment_rates[-1]
+                off = np.flatnonzero(np.abs(times[start:] - predicted) > self.max_time_error)
+                if len(off) == 0:
+                    break
+                start += off[0]
+            previous_time = float(times[start-1]) if start > 0 else self.last_time
+            self.start_segment(int(seqs[start]), float(times[start]), previous_time)
+            start += 1
+        self.last_time = float(times[-1])
+
+    def start_segment(self, seq, t0, previous_time):
+        rate = self.sampling_rate
+        if self.segment_seqs and seq - self.segment_seqs[-1] > 1:
+            # Carry on at the rate the sensor actually ran at in the last segment, unless that was a gap
+            measured = (seq - 1 - self.segment_seqs[-1])/(previous_time - self.segment_t0s[-1]) if previous_time > self.segment_t0s[-1] else 0
+            if abs(measured/self.sampling_rate - 1) < 0.01:
+                rate = measured
+        self.segment_seqs.append(seq)
+        self.segment_t0s.append(t0)
+        self.segment_rates.append(rate)
+
+    def seal_chunk(self):
+        ids = (self.sealed_seq + np.arange(self.chunk_size)) % self.hot_capacity
+        values = self.hot[ids]
+        deltas = np.diff(values)
+        # Successive ECG samples rarely differ by more than 16 bits, which halves the data before zlib
+        dtype = np.int16 if len(deltas) == 0 or np.abs(deltas).max() < 2**15 else np.int32
+        compressed = zlib.compress(deltas.astype(dtype).tobytes(), 1)
+        self.chunk_seqs.append(self.sealed_seq)
+        self.chunks.append((dtype, int(values[0]), compressed))
+        self.compressed_bytes += len(compressed)
+        self.sealed_seq += self.chunk_size
+
+        if self.max_chunks is not None and len(self.chunks) > self.max_chunks:
+            self.drop_oldest_chunk()
+
+    def drop_oldest_chunk(self):
+        first = self.chunk_seqs.pop(0)
+        _, _, compressed = self.chunks.pop(0)
+        self.chunk_cache.pop(first, None)
+        self.compressed_bytes -= len(compressed)
+        self.first_seq = first + self.chunk_size
+        # Segments wholly before the oldest sample aren't needed any more
+        while len(self.segment_seqs) > 1 and self.segment_seqs[1] <= self.first_seq:
+            del self.segment_seqs[0], self.segment_t0s[0], self.segment_rates[0]
+
+    def get_chunk(self, chunk_id):
+        first = self.chunk_seqs[chunk_id]
+        if first in self.chunk_cache:
+            self.chunk_cache.move_to_end(first)
+            return self.chunk_cache[first]
+        dtype, first_value, compressed = self.chunks[chunk_id]
+        deltas = np.frombuffer(zlib.decompress(compressed), dtype=dtype).astype(np.int32)
+        values = np.empty(self.chunk_size, dtype=np.int32)
+        values[0] = first_value
+        np.cumsum(deltas, out=values[1:])
+        values[1:] += first_value
+        self.chunk_cache[first] = values
+        if len(self.chunk_cache) > self.n_cached_chunks:
+            self.chunk_cache.popitem(last=False)
+        return values
+
+    def get_values(self, seq_lo, seq_hi):
+        '''int32 values of the samples seq_lo <= seq < seq_hi'''
+        seq_lo, seq_hi = max(seq_lo, self.first_seq), min(seq_hi, self.seq)
+        if seq_hi <= seq_lo:
+            return np.array([], dtype=np.int32)
+        hot_first = max(self.seq - self.hot_capacity, self.first_seq)
+        parts = []
+        if seq_lo < hot_first:
+            # Cold part, from the chunks that overlap [seq_lo, min(seq_hi, hot_first))
+            cold_hi = min(seq_hi, hot_first)
+            first_chunk = (seq_lo - self.chunk_seqs[0])//self.chunk_size
+            last_chunk = (cold_hi - 1 - self.chunk_seqs[0])//self.chunk_size
+            for chunk_id in range(first_chunk, last_chunk+1):
+                chunk_first = self.chunk_seqs[chunk_id]
+                values = self.get_chunk(chunk_id)
+                parts.append(values[max(seq_lo - chunk_first, 0):min(cold_hi - chunk_first, self.chunk_size)])
+            seq_lo = cold_hi
+        if seq_lo < seq_hi:
+            parts.append(self.hot[np.arange(seq_lo, seq_hi) % self.hot_capacity])
+        return np.concatenate(parts)
+
+    def get_times(self, seq_lo, seq_hi):
+        seqs = np.arange(seq_lo, seq_hi)
+        segment_ids = np.searchsorted(self.segment_seqs, seqs, side="right") - 1
+        return np.asarray(self.segment_t0s)[segment_ids] + (seqs - np.asarray(self.segment_seqs)[segment_ids])/np.asarray(self.segment_rates)[segment_ids]
+
+    def time_to_seq(self, t):
+        '''Sequence number of the first sample at or after time t (approximately, within the timebase error)'''
+        if not self.segment_seqs:
+            return self.first_seq # No samples yet
+        segment_id = max(int(np.searchsorted(self.segment_t0s, t, side="right")) - 1, 0)
+        seq = self.segment_seqs[segment_id] + int(np.floor((t - self.segment_t0s[segment_id])*self.segment_rates[segment_id]))
+        return min(max(seq, self.first_seq), self.seq)
+
+    def get_ecg_wind(self, start_time, end_time):
+        '''Values and times of the samples with start_time <= t <= end_time, like BeatTracker.get_ecg_wind'''
+        if self.seq == self.first_seq:
+            return np.array([]), np.array([])
+        # A sample either side of the estimated range covers the timebase error, the mask makes it exact
+        seq_lo = max(self.time_to_seq(start_time) - 1, self.first_seq)
+        seq_hi = min(self.time_to_seq(end_time) + 2, self.seq)
+        times = self.get_times(seq_lo, seq_hi)
+        values = self.get_values(seq_lo, seq_hi)
+        mask = (times >= start_time) & (times <= end_time)
+        return values[mask].astype(np.float64), times[mask]
+
+    def get_latest(self, n_samples):
+        '''(times, values) of the latest n samples'''
+        seq_lo = max(self.seq - n_samples, self.first_seq)
+        return self.get_times(seq_lo, self.seq), self.get_values(seq_lo, self.seq).astype(np.float64)
+
+    def get_since(self, seq, max_samples):
+        '''(times, values, next seq) of the samples from seq on, at most the latest max_samples'''
+        seq_lo = max(seq, self.seq - max_samples, self.first_seq)
+        return self.get_times(seq_lo, self.seq), self.get_values(seq_lo, self.seq).astype(np.float64), self.seq
+
+    def get_latest_time(self):
+        return self.get_times(self.seq - 1, self.seq)[0] if self.seq > self.first_seq else np.nan
+
+    def get_memory_bytes(self):
+        pyramid_bytes = self.pyramid.get_memory_bytes() if self.pyramid is not None else 0
+        return self.hot.nbytes + self.compressed_bytes + 24*len(self.segment_seqs) + sum(values.nbytes for values in self.chunk_cache.values()) + pyramid_bytes
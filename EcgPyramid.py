@@ -0,0 +1,92 @@
+import numpy as np
+
+'''
+MinMaxPyramid class
+Multi-resolution min/max summary of a signal for drawing it at any zoom level. Level k holds the min and max of
+every bin of first_bin*factor**k samples, so a window of any length is drawn from roughly one bin per pixel.
+It's updated as samples arrive: only the newly completed bins of each level are computed. Samples at the end
+that don't fill a bin yet are summarised from the finer levels (and, below the finest level, kept raw).
+Memory is about 2*4/first_bin*(1 + 1/factor + ...) bytes per sample, e.g. 0.7 bytes with the defaults
+'''
+class MinMaxPyramid:
+
+    def __init__(self, first_bin=16, factor=4, n_levels=8):
+        self.first_bin = first_bin
+        self.factor = factor
+        self.bin_sizes = [first_bin*factor**level for level in range(n_levels)]
+        self.mins = [np.empty(256, dtype=np.int32) for _ in range(n_levels)]
+        self.maxs = [np.empty(256, dtype=np.int32) for _ in range(n_levels)]
+        self.counts = [0]*n_levels # Complete bins per level
+        self.pending = np.empty(0, dtype=np.int32) # Samples after the last complete finest bin
+        self.n_samples = 0
+
+    def push(self, level, mins, maxs):
+        count = self.counts[level]
+        if count + len(mins) > len(self.mins[level]):
+            # Grow by doubling, so appending stays amortised O(1) per bin
+            size = max(2*len(self.mins[level]), count + len(mins))
+            for arrays in (self.mins, self.maxs):
+                grown = np.empty(size, dtype=np.int32)
+                grown[:count] = arrays[level][:count]
+                arrays[level] = grown
+        self.mins[level][count:count+len(mins)] = mins
+        self.maxs[level][count:count+len(maxs)] = maxs
+        self.counts[level] += len(mins)
+
+    def append(self, values):
+        values = np.asarray(values, dtype=np.int32).ravel()
+        self.n_samples += len(values)
+        data = np.concatenate([self.pending, values]) if len(self.pending) else values
+        n_bins = len(data)//self.first_bin
+        if n_bins:
+            bins = data[:n_bins*self.first_bin].reshape(n_bins, self.first_bin)
+            self.push(0, bins.min(axis=1), bins.max(axis=1))
+        self.pending = data[n_bins*self.first_bin:].copy()
+
+        for level in range(1, len(self.bin_sizes)):
+            start = self.counts[level]*self.factor
+            n_bins = (self.counts[level-1] - start)//self.factor
+            if n_bins <= 0:
+                break
+            end = start + n_bins*self.factor
+            self.push(level, self.mins[level-1][start:end].reshape(n_bins, self.factor).min(axis=1), \
+                             self.maxs[level-1][start:end].reshape(n_bins, self.factor).max(axis=1))
+
+    def select_level(self, n_samples_per_pixel):
+        '''Coarsest level with bins no bigger than a pixel, None if raw samples should be drawn'''
+        level = None
+        for k, bin_size in enumerate(self.bin_sizes):
+            if bin_size <= n_samples_per_pixel:
+                level = k
+        return level
+
+    def get_envelope(self, seq_lo, seq_hi, level):
+        '''
+        (bin starts, bin ends, mins, maxs) covering samples seq_lo <= seq < seq_hi at the given level. The end of the
+        signal not yet summarised at that level comes from finer levels, so bins can differ in size near the end
+        '''
+        seq_lo, seq_hi = max(int(seq_lo), 0), min(int(np.ceil(seq_hi)), self.n_samples)
+        parts = []
+        for k in range(level, -1, -1):
+            if seq_hi <= seq_lo:
+                break
+            bin_size = self.bin_sizes[k]
+            bin_lo = seq_lo//bin_size
+            bin_hi = min(-(-seq_hi//bin_size), self.counts[k])
+            if bin_hi > bin_lo:
+                starts = np.arange(bin_lo, bin_hi)*bin_size
+                parts.append((starts, starts + bin_size, self.mins[k][bin_lo:bin_hi], self.maxs[k][bin_lo:bin_hi]))
+                seq_lo = bin_hi*bin_size
+        if seq_hi > seq_lo:
+            # Samples that haven't completed a finest level bin yet
+            pending_start = self.n_samples - len(self.pending)
+            values = self.pending[max(seq_lo - pending_start, 0):seq_hi - pending_start]
+            starts = np.arange(seq_hi - len(values), seq_hi)
+            parts.append((starts, starts + 1, values, values))
+        if not parts:
+            empty = np.array([], dtype=np.int64)
+            return empty, empty, np.array([], dtype=np.int32), np.array([], dtype=np.int32)
+        return tuple(np.concatenate([part[i] for part in parts]) for i in range(4))
+
+    def get_memory_bytes(self):
+        return sum(mins.nbytes + maxs.nbytes for mins, maxs in zip(self.mins, self.maxs)) + self.pending.nbytes
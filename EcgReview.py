@@ -0,0 +1,235 @@
+import argparse
+import sys
+import numpy as np
+from PySide6.QtCore import Qt, QPointF, QLineF, QRectF
+from PySide6.QtGui import QPainter, QPen, QColor, QPolygonF
+from PySide6.QtWidgets import QApplication, QWidget, QVBoxLayout, QLabel, QSizePolicy
+from EcgHistory import TieredEcgHistory
+from EcgPyramid import MinMaxPyramid
+import vars
+
+'''
+EcgReviewWidget class
+Zoom and pan over a whole recorded session, from hours down to a single beat. Each repaint draws one min/max
+line per pixel column from the MinMaxPyramid level that matches the zoom, or the raw samples once there are
+fewer samples than pixels, so repaint time depends on the widget width rather than the recording length.
+
+Wheel zooms around the cursor, dragging pans, double click (or Home) shows everything.
+Trial windows are shaded and detected beats marked, if given.
+Run this module to review an ECG recording (.npz with ecg and times, or a session's part of the columnar export)
+'''
+class EcgReviewWidget(QWidget):
+
+    def __init__(self, history, parent=None):
+        super().__init__(parent)
+        self.history = history
+        self.pyramid = history.pyramid
+        self.regions = [] # (start time, end time, label)
+        self.beat_times = np.array([])
+        self.trace_pen = QPen(QColor(*vars.RED))
+        self.trace_pen.setWidthF(1.0)
+        self.view_lo = float(history.first_seq)
+        self.view_hi = float(max(history.seq, history.first_seq + 1))
+        self.drag_x = None
+        self.setMinimumSize(400, 150)
+        self.setSizePolicy(QSizePolicy.Expanding, QSizePolicy.Expanding)
+        self.setFocusPolicy(Qt.StrongFocus)
+
+    def set_markers(self, regions=None, beat_times=None):
+        self.regions = regions or []
+        self.beat_times = np.sort(np.asarray(beat_times if beat_times is not None else [], dtype=float))
+        self.update()
+
+    def show_all(self):
+        self.view_lo = float(self.history.first_seq)
+        self.view_hi = float(max(self.history.seq, self.history.first_seq + 1))
+        self.update()
+
+    def show_times(self, start_time, end_time):
+        self.view_lo = float(self.history.time_to_seq(start_time))
+        self.view_hi = float(max(self.history.time_to_seq(end_time), self.view_lo + 2))
+        self.update()
+
+    def clamp_view(self):
+        first, last = float(self.history.first_seq), float(max(self.history.seq, self.history.first_seq + 1))
+        span = min(max(self.view_hi - self.view_lo, 8.0), last - first) # Zoomed in to no less than 8 samples
+        self.view_lo = min(max(self.view_lo, first), last - span)
+        self.view_hi = self.view_lo + span
+
+    def seq_to_x(self, seqs):
+        return (np.asarray(seqs, dtype=float) - self.view_lo)/(self.view_hi - self.view_lo)*self.width()
+
+    def get_columns(self):
+        '''(x, y min, y max) for each pixel column, or (x, value, value) per sample when zoomed in'''
+        width = max(self.width(), 1)
+        n_samples_per_pixel = (self.view_hi - self.view_lo)/width
+        level = self.pyramid.select_level(n_samples_per_pixel) if self.pyramid is not None else None
+        if level is None:
+            seq_lo, seq_hi = int(np.floor(self.view_lo)), int(np.ceil(self.view_hi)) + 1
+            values = self.history.get_values(seq_lo, seq_hi)
+            seqs = np.arange(seq_lo, seq_lo + len(values))
+            return self.seq_to_x(seqs), values, values, False
+        starts, ends, mins, maxs = self.pyramid.get_envelope(self.view_lo, self.view_hi, level)
+        columns = np.clip(self.seq_to_x(starts).astype(int), 0, width - 1)
+        column_mins = np.full(width, np.iinfo(np.int32).max, dtype=np.int64)
+        column_maxs = np.full(width, np.iinfo(np.int32).min, dtype=np.int64)
+        np.minimum.at(column_mins, columns, mins)
+        np.maximum.at(column_maxs, columns, maxs)
+        filled = column_mins <= column_maxs
+        x = np.flatnonzero(filled).astype(float)
+        column_mins, column_maxs = column_mins[filled], column_maxs[filled]
+        # Join each column to the next, so steep edges between columns aren't drawn as gaps
+        column_mins[1:] = np.minimum(column_mins[1:], column_maxs[:-1])
+        column_maxs[1:] = np.maximum(column_maxs[1:], column_mins[:-1])
+        return x, column_mins, column_maxs, True
+
+    def paintEvent(self, event):
+        painter = QPainter(self)
+        painter.fillRect(self.rect(), Qt.white)
+        if self.history.seq <= self.history.first_seq:
+            painter.drawText(self.rect(), Qt.AlignCenter, "No ECG recorded yet")
+            return
+        self.clamp_view()
+        x, lows, highs, is_envelope = self.get_columns()
+        if len(x) == 0:
+            return
+        y_lo, y_hi = float(np.min(lows)), float(np.max(highs))
+        y_pad = max((y_hi - y_lo)*0.05, 1.0)
+        y_lo, y_hi = y_lo - y_pad, y_hi + y_pad
+        height = self.height() - 20 # Room for the time labels
+        to_y = lambda values: height*(1 - (np.asarray(values, dtype=float) - y_lo)/(y_hi - y_lo))
+
+        self.paint_regions(painter, height)
+        painter.setPen(self.trace_pen)
+        if is_envelope:
+            y_top, y_bottom = to_y(highs), to_y(lows)
+            painter.drawLines([QLineF(xi, yt, xi, max(yb, yt + 1)) for xi, yt, yb in zip(x, y_top, y_bottom)])
+        else:
+            painter.setRenderHint(QPainter.Antialiasing)
+            painter.drawPolyline(QPolygonF([QPointF(xi, yi) for xi, yi in zip(x, to_y(lows))]))
+        self.paint_beats(painter, height)
+        self.paint_time_axis(painter, height)
+        painter.end()
+
+    def paint_regions(self, painter, height):
+        for start_time, end_time, label in self.regions:
+            x0, x1 = self.seq_to_x([self.history.time_to_seq(start_time), self.history.time_to_seq(end_time)])
+            if x1 < 0 or x0 > self.width():
+                continue
+            painter.fillRect(QRectF(x0, 0, x1 - x0, height), QColor(*vars.BLUE, 30))
+            painter.setPen(QColor(*vars.BLUE))
+            painter.drawText(QPointF(max(x0, 0) + 4, 14), label)
+
+    def paint_beats(self, painter, height):
+        if len(self.beat_times) == 0:
+            return
+        view_times = self.history.get_times(int(self.view_lo), int(self.view_lo) + 1)[0], self.history.get_times(int(self.view_hi) - 1, int(self.view_hi))[0]
+        lo, hi = np.searchsorted(self.beat_times, view_times)
+        if hi - lo > self.width()//3:
+            return # Too dense to be useful at this zoom
+        painter.setPen(QColor(*vars.GRAY))
+        for beat_time in self.beat_times[lo:hi]:
+            x = self.seq_to_x([self.history.time_to_seq(beat_time)])[0]
+            painter.drawLine(QLineF(x, height - 8, x, height))
+
+    def paint_time_axis(self, painter, height):
+        painter.setPen(QColor(*vars.GRAY))
+        session_start = self.history.get_times(self.history.first_seq, self.history.first_seq + 1)[0]
+        n_ticks = max(self.width()//120, 2)
+        for seq in np.linspace(self.view_lo, self.view_hi - 1, n_ticks):
+            seq = int(seq)
+            t = self.history.get_times(seq, seq + 1)[0] - session_start
+            x = self.seq_to_x([seq])[0]
+            label = f"{int(t//60)}:{t%60:06.3f}" if self.view_hi - self.view_lo < 20*self.history.sampling_rate else f"{int(t//3600)}:{int(t%3600//60):02d}:{int(t%60):02d}"
+            painter.drawText(QPointF(min(max(x - 30, 0), self.width() - 70), height + 15), label)
+
+    def wheelEvent(self, event):
+        scale = 0.8 if event.angleDelta().y() > 0 else 1.25
+        anchor = self.view_lo + event.position().x()/self.width()*(self.view_hi - self.view_lo)
+        self.view_lo = anchor - (anchor - self.view_lo)*scale
+        self.view_hi = anchor + (self.view_hi - anchor)*scale
+        self.update()
+
+    def mousePressEvent(self, event):
+        self.drag_x = event.position().x()
+
+    def mouseMoveEvent(self, event):
+        if self.drag_x is None:
+            return
+        shift = (self.drag_x - event.position().x())/self.width()*(self.view_hi - self.view_lo)
+        self.view_lo += shift
+        self.view_hi += shift
+        self.drag_x = event.position().x()
+        self.update()
+
+    def mouseReleaseEvent(self, event):
+        self.drag_x = None
+
+    def mouseDoubleClickEvent(self, event):
+        self.show_all()
+
+    def keyPressEvent(self, event):
+        span = self.view_hi - self.view_lo
+        if event.key() in (Qt.Key_Plus, Qt.Key_Equal):
+            self.view_lo, self.view_hi = self.view_lo + span*0.1, self.view_hi - span*0.1
+        elif event.key() == Qt.Key_Minus:
+            self.view_lo, self.view_hi = self.view_lo - span*0.125, self.view_hi + span*0.125
+        elif event.key() == Qt.Key_Left:
+            self.view_lo, self.view_hi = self.view_lo - span*0.2, self.view_hi - span*0.2
+        elif event.key() == Qt.Key_Right:
+            self.view_lo, self.view_hi = self.view_lo + span*0.2, self.view_hi + span*0.2
+        elif event.key() == Qt.Key_Home:
+            self.show_all()
+            return
+        else:
+            super().keyPressEvent(event)
+            return
+        self.update()
+
+class EcgReviewWindow(QWidget):
+
+    def __init__(self, history, regions=None, beat_times=None, title="ECG review"):
+        super().__init__()
+        self.setWindowTitle(title)
+        self.resize(1000, 350)
+        self.review_widget = EcgReviewWidget(history)
+        self.review_widget.set_markers(regions, beat_times)
+        layout = QVBoxLayout()
+        self.setLayout(layout)
+        layout.addWidget(self.review_widget)
+        layout.addWidget(QLabel("Scroll to zoom, drag to pan, double click or Home to see everything"))
+
+def load_recording(path, session_id=None):
+    '''A TieredEcgHistory of a recording: an .npz with ecg and times (or sampling_rate), or a columnar ecg export folder'''
+    if path.endswith(".npz"):
+        with np.load(path) as data:
+            values = data["ecg"]
+            sampling_rate = float(data["sampling_rate"]) if "sampling_rate" in data.files else vars.ECG_SAMPLING_RATE
+            times = data["times"] if "times" in data.files else np.arange(len(values))/sampling_rate
+        trial_ids = None
+    else:
+        import SessionExport
+        columns = SessionExport.load_columns(path, "ecg", ["time", "ecg", "trial_id"], session_id or None)
+        times, values, trial_ids = columns["time"], columns["ecg"], columns["trial_id"]
+        sampling_rate = vars.ECG_SAMPLING_RATE
+    history = TieredEcgHistory(sampling_rate, vars.ECG_HOT_SAMPLES, vars.ECG_CHUNK_SAMPLES, vars.ECG_TIMEBASE_MAX_ERROR_S, pyramid=MinMaxPyramid())
+    order = np.argsort(times, kind="stable")
+    history.append(times[order], values[order])
+    regions = []
+    if trial_ids is not None:
+        for trial_id in np.unique(trial_ids):
+            trial_times = times[trial_ids == trial_id]
+            regions.append((trial_times.min(), trial_times.max(), f"Trial {trial_id + 1}"))
+    return history, regions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Zoom and pan over a recorded ECG")
+    parser.add_argument("path", help="Recording .npz, or the columnar export folder (e.g. data/columnar)")
+    parser.add_argument("--session", help="Session id, when reviewing the columnar export")
+    args, qt_args = parser.parse_known_args()
+
+    app = QApplication(sys.argv[:1] + qt_args)
+    history, regions = load_recording(args.path, args.session)
+    window = EcgReviewWindow(history, regions, title=f"ECG review - {args.session or args.path}")
+    window.show()
+    sys.exit(app.exec())
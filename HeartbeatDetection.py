@@ -1,20 +1,70 @@
-
 import os
 os.environ['QT_API'] = 'PySide6' # For qasync to know which binding is being used
 os.environ['QT_LOGGING_RULES'] = 'qt.pointer.dispatch=false' # Disable pointer logging
 
 import sys
+import argparse
 import asyncio
+import signal
+from PySide6.QtCore import QTimer
 from PySide6.QtWidgets import QApplication
 from qasync import QEventLoop
 from Controller import Controller
+from BeatDetectors import DETECTORS
+from Instrumentation import MetricsServer, configure_logging
+from Profiler import PROFILER
+import vars
 
 if __name__ == "__main__":
 
-    app = QApplication(sys.argv)
+    parser = argparse.ArgumentParser(description="Heartbeat detection task with a Polar H10")
+    parser.add_argument("--detector", choices=list(DETECTORS), default=vars.BEAT_DETECTOR, help="Beat detector used to count the measured beats")
+    parser.add_argument("--protocol", default=vars.PROTOCOL, help="Protocol file, or the name of one in protocols/")
+    parser.add_argument("--seed", type=int, default=vars.PROTOCOL_SEED, help="Seed for the trial order, to reproduce a session's schedule")
+    parser.add_argument("--user", default=vars.DEFAULT_USER, help="User selected at startup, created if new")
+    parser.add_argument("--ingest", choices=["thread", "loop"], default=vars.INGEST_MODE, help="Run BLE ingest on a background thread or on the GUI event loop")
+    parser.add_argument("--shared-history", default=vars.SHARED_ECG_HISTORY_NAME, metavar="NAME", help="Publish the ECG history in shared memory under this name")
+    parser.add_argument("--stream-port", type=int, default=vars.STREAM_SERVER_PORT, help="Stream live ECG and beats over TCP on this port")
+    parser.add_argument("--stream-host", default=vars.STREAM_SERVER_HOST, help="Address the stream server listens on")
+    parser.add_argument("--log-level", default=vars.LOG_LEVEL, help="Logging level, e.g. DEBUG, INFO, WARNING")
+    parser.add_argument("--metrics-port", type=int, default=vars.METRICS_PORT if vars.METRICS_ENABLED else None, help="Port of the local metrics endpoint, 0 to disable")
+    parser.add_argument("--profile", action="store_true", default=os.environ.get("INTEROCEPTION_PROFILE", "0") not in ("", "0"), \
+                        help="Profile the hot paths from startup (also INTEROCEPTION_PROFILE=1). Toggle at runtime with Ctrl+Shift+P or SIGUSR1")
+    parser.add_argument("--profile-dir", default=os.environ.get("INTEROCEPTION_PROFILE_DIR", "profiles"), help="Output folder for the collapsed stacks and latency summary")
+    args, qt_args = parser.parse_known_args()
+
+    configure_logging(args.log_level.upper())
+    vars.INGEST_MODE = args.ingest
+    vars.DEFAULT_USER = args.user
+    vars.PROTOCOL = args.protocol
+    vars.PROTOCOL_SEED = args.seed
+    vars.SHARED_ECG_HISTORY_NAME = args.shared_history
+    vars.STREAM_SERVER_PORT = args.stream_port
+    vars.STREAM_SERVER_HOST = args.stream_host
+    if args.metrics_port:
+        MetricsServer(vars.METRICS_HOST, args.metrics_port).start()
+
+    PROFILER.configure(output_dir=args.profile_dir)
+
+    app = QApplication(sys.argv[:1] + qt_args)
+    if hasattr(signal, "SIGUSR1"):
+        # Toggled from the event loop, the handler can interrupt a span holding the profiler's lock
+        signal.signal(signal.SIGUSR1, lambda signum, frame: QTimer.singleShot(0, PROFILER.toggle))
     loop = QEventLoop(app)
     asyncio.set_event_loop(loop)
     
-    controller = Controller()
+    controller = Controller(beat_detector=args.detector)
+    if args.profile:
+        PROFILER.enable()
 
-    loop.run_until_complete(controller.main())
+    try:
+        loop.run_until_complete(controller.main())
+    finally:
+        controller.model.beat_tracker.close()
+        controller.power.log_cpu_report()
+        controller.model.pipeline.log_report()
+        if controller.model.analysis_worker is not None:
+            controller.model.analysis_worker.stop() # Ends the process and unlinks the windows still in shared memory
+        if controller.model.stream_server is not None:
+            controller.model.stream_server.stop()
+        controller.model.closeSessionLog() # Syncs the trials logged so far, the log stays until the session is saved
@@ -0,0 +1,84 @@
+from collections import deque
+import numpy as np
+
+'''
+HrvMetrics class
+Rolling heart rate and heart rate variability from a stream of beat times.
+Each window keeps running sums of the RR intervals, so adding a beat is O(1) (amortised over the evicted beats)
+'''
+class RollingRRWindow:
+
+    def __init__(self, window_s):
+        self.window_s = window_s
+        self.rr = deque() # (beat time, RR interval in s)
+        self.rr_sum = 0.0
+        self.rr_sq_sum = 0.0
+        self.diffs = deque() # (beat time, successive RR difference in s)
+        self.diff_sq_sum = 0.0
+        self.nn50_count = 0
+
+    def add(self, t, rr, rr_diff):
+        self.rr.append((t, rr))
+        self.rr_sum += rr
+        self.rr_sq_sum += rr*rr
+        if rr_diff is not None:
+            self.diffs.append((t, rr_diff))
+            self.diff_sq_sum += rr_diff*rr_diff
+            self.nn50_count += abs(rr_diff) > 0.05
+        self.evict(t)
+
+    def evict(self, now):
+        while self.rr and self.rr[0][0] < now - self.window_s:
+            _, rr = self.rr.popleft()
+            self.rr_sum -= rr
+            self.rr_sq_sum -= rr*rr
+        while self.diffs and self.diffs[0][0] < now - self.window_s:
+            _, rr_diff = self.diffs.popleft()
+            self.diff_sq_sum -= rr_diff*rr_diff
+            self.nn50_count -= abs(rr_diff) > 0.05
+
+    def get_metrics(self):
+        n = len(self.rr)
+        n_diffs = len(self.diffs)
+        mean_rr = self.rr_sum/n if n else np.nan
+        # Clamp at zero, the running sums can go slightly negative through rounding
+        sdnn = np.sqrt(max(self.rr_sq_sum/n - mean_rr*mean_rr, 0.0)*n/(n-1)) if n > 1 else np.nan
+        return {"hr": 60.0/mean_rr if n else np.nan, \
+                "rmssd": 1000.0*np.sqrt(max(self.diff_sq_sum/n_diffs, 0.0)) if n_diffs else np.nan, \
+                "sdnn": 1000.0*sdnn, \
+                "pnn50": 100.0*self.nn50_count/n_diffs if n_diffs else np.nan, \
+                "beats": n}
+
+class HrvMetrics:
+    MIN_RR_S = 0.3 # 200 bpm
+    MAX_RR_S = 2.0 # 30 bpm
+
+    def __init__(self, windows_s=(10, 60)):
+        self.windows = {window_s: RollingRRWindow(window_s) for window_s in windows_s}
+        self.reset()
+
+    def reset(self):
+        self.last_beat_time = None
+        self.last_rr = None
+        for window_s in list(self.windows):
+            self.windows[window_s] = RollingRRWindow(window_s)
+
+    def add_beat(self, t):
+        '''Adds a detected beat at time t (s). Implausible RR intervals (missed or extra beats) are skipped'''
+        if self.last_beat_time is not None:
+            rr = t - self.last_beat_time
+            if self.MIN_RR_S <= rr <= self.MAX_RR_S:
+                rr_diff = rr - self.last_rr if self.last_rr is not None else None
+                for window in self.windows.values():
+                    window.add(t, rr, rr_diff)
+                self.last_rr = rr
+            else:
+                self.last_rr = None
+        self.last_beat_time = t
+
+    def get_metrics(self, window_s=None, now=None):
+        '''HR (bpm), RMSSD (ms), SDNN (ms) and pNN50 (%) over a window, by default the shortest'''
+        window = self.windows[window_s if window_s is not None else min(self.windows)]
+        if now is not None:
+            window.evict(now)
+        return window.get_metrics()
@@ -0,0 +1,71 @@
+import asyncio
+import logging
+import threading
+from PySide6.QtCore import QObject, Signal
+from PolarH10 import PolarH10
+
+'''
+IngestWorker class
+Runs the BLE client and the frame decoders on their own asyncio loop in a background thread.
+Decoded frames are emitted as arrays from a pipeline source, whose queue hands them to the GUI thread, so a
+slow repaint never delays the BLE callbacks. Qt signals are only used for low-rate events like the connection
+'''
+logger = logging.getLogger(__name__)
+
+class IngestWorker(QObject):
+    sensorConnected = Signal()
+    sensorError = Signal(str)
+
+    def __init__(self, source, sensor_clock=None):
+        super().__init__()
+        self.source = source # Pipeline.Source the frames are emitted from
+        self.sensor_clock = sensor_clock
+        self.polar_sensor = None
+        self.loop = None
+        self.thread = None
+        self.stop_event = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="ble-ingest", daemon=True)
+        self.thread.start()
+
+    def run(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.stop_event = asyncio.Event()
+        try:
+            self.loop.run_until_complete(self.ingest())
+        except Exception as e:
+            logger.exception("BLE ingest failed")
+            self.sensorError.emit(str(e))
+        finally:
+            self.loop.close()
+
+    async def ingest(self):
+        device = await PolarH10.find_device()
+        self.polar_sensor = PolarH10(device)
+        self.polar_sensor.sensor_clock = self.sensor_clock
+        self.source.attach_polar(self.polar_sensor)
+
+        # The strap going out of range or flat only shows up as a disconnection, ingest() fails on it
+        disconnected = self.loop.create_future()
+        def on_disconnected(client):
+            self.loop.call_soon_threadsafe(lambda: disconnected.done() or disconnected.set_result(None))
+        await self.polar_sensor.connect(disconnected_callback=on_disconnected)
+        await self.polar_sensor.get_device_info()
+        await self.polar_sensor.print_device_info()
+        self.sensorConnected.emit()
+
+        await self.polar_sensor.start_ecg_stream()
+        await self.polar_sensor.start_hr_stream() # Inter-beat-intervals for the "ibi" beat detector
+        stopped = asyncio.ensure_future(self.stop_event.wait())
+        await asyncio.wait([stopped, disconnected], return_when=asyncio.FIRST_COMPLETED)
+        if not self.stop_event.is_set():
+            stopped.cancel()
+            raise ConnectionError("The Polar sensor disconnected")
+        await self.polar_sensor.disconnect()
+
+    def stop(self):
+        if self.loop is not None and self.stop_event is not None:
+            self.loop.call_soon_threadsafe(self.stop_event.set)
+            self.thread.join(timeout=5)
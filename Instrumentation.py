@@ -0,0 +1,228 @@
+import logging
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+'''
+Instrumentation
+Counters, gauges and histograms for ingest and pipeline health, exposed over a local HTTP endpoint
+in the Prometheus text format, and a logfmt formatter for structured logs
+'''
+def escape_label_value(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+class Metric:
+    type_name = None
+
+    def __init__(self, name, help_text, labels=None):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels or {}
+        self.lock = threading.Lock()
+
+    def label_str(self, extra_labels=None):
+        labels = dict(self.labels, **(extra_labels or {}))
+        if not labels:
+            return ""
+        return "{" + ",".join(f'{key}="{escape_label_value(value)}"' for key, value in labels.items()) + "}"
+
+    def samples(self):
+        raise NotImplementedError
+
+class Counter(Metric):
+    type_name = "counter"
+
+    def __init__(self, name, help_text, labels=None):
+        super().__init__(name, help_text, labels)
+        self.value = 0.0
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def samples(self):
+        return [(self.name, self.label_str(), self.value)]
+
+class Gauge(Metric):
+    type_name = "gauge"
+
+    def __init__(self, name, help_text, labels=None, callback=None):
+        super().__init__(name, help_text, labels)
+        self.value = 0.0
+        self.callback = callback # Read on every scrape instead of being set
+
+    def set(self, value):
+        self.value = value
+
+    def samples(self):
+        value = self.callback() if self.callback is not None else self.value
+        return [(self.name, self.label_str(), value)]
+
+class Histogram(Metric):
+    type_name = "histogram"
+    DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+    def __init__(self, name, help_text, labels=None, buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = sorted(buckets)
+        self.counts = [0]*len(self.buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        with self.lock:
+            for i, upper in enumerate(self.buckets):
+                if value <= upper:
+                    self.counts[i] += 1
+                    break
+            self.count += 1
+            self.sum += value
+
+    def time(self):
+        return HistogramTimer(self)
+
+    def samples(self):
+        with self.lock:
+            counts, count, total = list(self.counts), self.count, self.sum
+        samples = []
+        cumulative = 0
+        for upper, bucket_count in zip(self.buckets, counts):
+            cumulative += bucket_count
+            samples.append((f"{self.name}_bucket", self.label_str({"le": repr(upper)}), cumulative))
+        samples.append((f"{self.name}_bucket", self.label_str({"le": "+Inf"}), count))
+        samples.append((f"{self.name}_sum", self.label_str(), total))
+        samples.append((f"{self.name}_count", self.label_str(), count))
+        return samples
+
+class HistogramTimer:
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start)
+        return False
+
+class Registry:
+
+    def __init__(self):
+        self.metrics = {} # (name, labels) -> metric
+        self.lock = threading.Lock()
+
+    def register(self, metric):
+        key = (metric.name, tuple(sorted(metric.labels.items())))
+        with self.lock:
+            # Re-registering returns the existing metric, so instrumented objects can be recreated
+            return self.metrics.setdefault(key, metric)
+
+    def unregister(self, metric):
+        with self.lock:
+            self.metrics.pop((metric.name, tuple(sorted(metric.labels.items()))), None)
+
+    def counter(self, name, help_text, labels=None):
+        return self.register(Counter(name, help_text, labels))
+
+    def gauge(self, name, help_text, labels=None, callback=None):
+        # An existing gauge keeps its callback, a second instance of the same object doesn't take it over
+        gauge = self.register(Gauge(name, help_text, labels, callback))
+        if gauge.callback is None:
+            gauge.callback = callback
+        return gauge
+
+    def histogram(self, name, help_text, labels=None, buckets=Histogram.DEFAULT_BUCKETS):
+        return self.register(Histogram(name, help_text, labels, buckets))
+
+    def render(self):
+        '''Prometheus text exposition format'''
+        with self.lock:
+            metrics = sorted(self.metrics.values(), key=lambda metric: metric.name)
+        lines = []
+        described = set()
+        for metric in metrics:
+            if metric.name not in described:
+                lines.append(f"# HELP {metric.name} {metric.help_text}")
+                lines.append(f"# TYPE {metric.name} {metric.type_name}")
+                described.add(metric.name)
+            try:
+                samples = metric.samples()
+            except Exception:
+                logger.exception("Failed to read metric", extra={"metric": metric.name})
+                continue
+            for name, label_str, value in samples:
+                lines.append(f"{name}{label_str} {float(value)!r}")
+        return "\n".join(lines) + "\n"
+
+REGISTRY = Registry()
+
+class MetricsServer:
+
+    def __init__(self, host="127.0.0.1", port=9108, registry=REGISTRY):
+        self.host = host
+        self.port = port
+        self.registry = registry
+        self.httpd = None
+
+    def start(self):
+        registry = self.registry
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = registry.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer((self.host, self.port), MetricsHandler)
+        self.httpd.daemon_threads = True
+        self.port = self.httpd.server_address[1]
+        threading.Thread(target=self.httpd.serve_forever, name="metrics-server", daemon=True).start()
+        logger.info("Serving metrics", extra={"url": f"http://{self.host}:{self.port}/metrics"})
+
+    def stop(self):
+        if self.httpd is not None:
+            self.httpd.shutdown()
+            self.httpd.server_close()
+            self.httpd = None
+
+class LogfmtFormatter(logging.Formatter):
+    '''Formats records as key=value pairs, including any fields passed with extra={...}'''
+    RESERVED = set(logging.LogRecord("", 0, "", 0, "", None, None).__dict__) | {"message", "asctime"}
+
+    def format(self, record):
+        fields = {"time": self.formatTime(record, "%Y-%m-%dT%H:%M:%S"), \
+                  "level": record.levelname.lower(), \
+                  "logger": record.name, \
+                  "msg": record.getMessage()}
+        fields.update({key: value for key, value in record.__dict__.items() if key not in self.RESERVED})
+        line = " ".join(f"{key}={self.quote(value)}" for key, value in fields.items())
+        if record.exc_info:
+            line += "\n" + self.formatException(record.exc_info)
+        return line
+
+    @staticmethod
+    def quote(value):
+        value = f"{value:.6g}" if isinstance(value, float) else str(value)
+        if value == "" or any(c in value for c in ' ="\\\n'):
+            return '"' + value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") + '"'
+        return value
+
+def configure_logging(level="INFO"):
+    handler = logging.StreamHandler()
+    handler.setFormatter(LogfmtFormatter())
+    root = logging.getLogger()
+    root.handlers = [handler]
+    root.setLevel(level)
+
+logger = logging.getLogger(__name__)
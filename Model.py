@@ -1,35 +1,200 @@
 import asyncio
 from PolarH10 import PolarH10
 from BeatTracker import BeatTracker
+from IngestWorker import IngestWorker
+from AnalysisWorker import AnalysisWorker
+from StreamServer import StreamServer
+from Pipeline import Pipeline, Source, BeatTrackerStage, StreamServerSink
+import SessionExport
+import Scoring
+from Resampling import ResamplingEngine
+from Progress import ProgressTracker
+from Profiles import UserProfiles
+from SensorClock import SensorClock
+from ReferenceData import ReferenceData
+import SessionLog
+from PySide6.QtCore import Qt, Slot
 from PySide6.QtCore import QObject, Signal
-from bleak import BleakScanner
 from datetime import datetime
 import json
+import logging
 import os
-import scipy.stats
+import time
 import numpy as np
-import pandas as pd
 import vars
 import seaborn as sns
+from Instrumentation import REGISTRY
+from Profiler import PROFILER
 
 import matplotlib
 matplotlib.use('Qt5Agg')
 import matplotlib.pyplot as plt
 
+logger = logging.getLogger(__name__)
+
 class Model(QObject):
     sensorConnected = Signal()
+    sensorError = Signal(str)
+    trialAnalysed = Signal()
 
     def __init__(self):
         super().__init__()
         self.polar_sensor = None
+        self.ingest_worker = None
         self.beat_tracker = BeatTracker()
-        self.session_data = SessionData()
-
-    def resetSession(self):
-        self.session_data.resetSession()
+        self.sensor_clock = SensorClock(vars.SENSOR_CLOCK_WINDOW_S, vars.SENSOR_TRANSPORT_LATENCY_S)
+        self.profiles = UserProfiles(vars.DATA_FOLDER)
+        self.progress_trackers = {} # user id -> ProgressTracker, kept so switching back to a user is instant
+        self.session_data = None
+        self.session_log = None # Write-ahead log of the current session, opened with its first trial
+        self.setUser(vars.DEFAULT_USER)
+        self.interrupted_session = self.recoverSessions() # (log path, session) that can be resumed
+        self.ecg_consumer_lag = REGISTRY.gauge("ecg_consumer_lag_seconds", "Age of the latest ECG sample when it reached the beat tracker")
+        self.ecg_samples_consumed = REGISTRY.counter("ecg_samples_consumed_total", "ECG samples moved from the sensor queue into the history")
+
+        self.stream_server = None
+        if vars.STREAM_SERVER_PORT:
+            self.stream_server = StreamServer(vars.STREAM_SERVER_HOST, vars.STREAM_SERVER_PORT, vars.STREAM_CLIENT_MAX_FRAMES)
+            self.stream_server.start()
+
+        # Sensor frames from the ingest thread (or the BLE callbacks in "loop" mode), into the BeatTracker and on to the
+        # other consumers, see Pipeline
+        self.pipeline = Pipeline("ingest")
+        self.polar_source = Source("polar")
+        self.history_stage = BeatTrackerStage(self.beat_tracker)
+        self.ingest_queue = self.pipeline.connect(self.polar_source, self.history_stage, max_batches=vars.INGEST_QUEUE_BATCHES, \
+                                                  policy=vars.INGEST_QUEUE_POLICY)
+        if self.stream_server is not None:
+            self.pipeline.connect(self.history_stage, StreamServerSink(self.stream_server))
+
+        self.ingest_period_s = vars.INGEST_POLL_PERIOD_S
+        self.ingest_wakeup = None # Cuts a long wait between polls short when the rate goes up
+
+        self.pending_trials = {} # analysis job id -> trial inputs
+        self.analysis_worker = None
+        if vars.ANALYSIS_WORKER:
+            self.analysis_worker = AnalysisWorker()
+            self.analysis_worker.analysisFinished.connect(self.trialAnalysisFinishedHandler)
+
+    def resetSession(self, beat_detector=None, schedule=None):
+        self.closeSessionLog()
+        self.pending_trials.clear()
+        self.session_data.resetSession(schedule)
+        self.setBeatDetector(beat_detector if beat_detector is not None else vars.BEAT_DETECTOR)
+
+    def setUser(self, name):
+        """Switches the user the next session is saved for, creating their profile if they're new"""
+        user_id = self.profiles.add_user(name)
+        self.closeSessionLog() # The session moves to the new user's folder under a new id
+        if self.session_data is None:
+            self.session_data = SessionData(self.profiles.get_sessions_folder(user_id), user_id)
+        else:
+            self.session_data.user_id = user_id
+            self.session_data.setDataFolder(self.profiles.get_sessions_folder(user_id))
+        self.user_id = user_id
+        self.progress = self.getProgressTracker(user_id)
+        self.profiles.touch(user_id)
+        logger.info("User selected", extra={"user_id": user_id})
+        return user_id
+
+    def getProgressTracker(self, user_id):
+        if user_id not in self.progress_trackers:
+            progress = ProgressTracker(self.profiles.get_user_folder(user_id), user_id, vars.PROGRESS_HISTORY_LENGTH, \
+                                       vars.PROGRESS_BEST_SESSIONS, vars.PROGRESS_EWMA_ALPHA)
+            progress.rebuild(self.profiles.get_sessions_folder(user_id)) # Only reads sessions not yet counted
+            if user_id == self.profiles.get_user_id(vars.DEFAULT_USER):
+                progress.rebuild(vars.DATA_FOLDER) # Sessions saved before there were user profiles
+            self.progress_trackers[user_id] = progress
+        return self.progress_trackers[user_id]
+
+    def recoverSessions(self):
+        '''
+        Rebuilds the sessions whose logs were left behind by a crash. The latest one is kept back to be resumed
+        (with RESUME_INTERRUPTED_SESSIONS) unless all its trials were done, the others are saved as they were,
+        with the trials they got to
+        '''
+        interrupted = []
+        for user_id in list(self.profiles.users):
+            for log_filepath in SessionLog.find_logs(self.profiles.get_sessions_folder(user_id)):
+                session = SessionLog.recover(log_filepath)
+                if session is None or session["saved"] or not session["trials"]:
+                    os.remove(log_filepath)
+                    continue
+                logger.warning("Interrupted session found", extra={"path": log_filepath, "session_id": session["session_id"], \
+                                                                    "trials": len(session["trials"])})
+                interrupted.append((log_filepath, session))
+        interrupted.sort(key=lambda item: item[1]["session_id"])
+        resumable = None
+        if interrupted and vars.RESUME_INTERRUPTED_SESSIONS and not SessionData.isComplete(interrupted[-1][1]):
+            resumable = interrupted.pop()
+        for log_filepath, session in interrupted:
+            self.saveRecoveredSession(log_filepath, session)
+        return resumable
+
+    def saveRecoveredSession(self, log_filepath, session):
+        user_id = session["user_id"]
+        session_data = SessionData(self.profiles.get_sessions_folder(user_id))
+        session_data.restore(session)
+        session_data.saveSessionData()
+        session_data.resampling_engine.shutdown()
+        self.profiles.record_session(user_id, session_data.session_id, session_data.session_filepath, session_data.session_summary)
+        self.getProgressTracker(user_id).add_session(session_data.session_id, session_data.session_summary)
+        os.remove(log_filepath)
+        logger.info("Interrupted session saved", extra={"path": session_data.session_filepath})
+
+    def resumeInterruptedSession(self):
+        '''Carries on with the interrupted session, if there is one. Returns its schedule and the number of trials done'''
+        if self.interrupted_session is None:
+            return None
+        log_filepath, session = self.interrupted_session
+        self.interrupted_session = None
+        self.setUser(self.profiles.users[session["user_id"]]["name"])
+        self.resetSession(session["beat_detector"], session["schedule"]) # The detector its trials were counted with
+        self.session_data.restore(session)
+        self.session_log = SessionLog.SessionLog(log_filepath, vars.SESSION_LOG_SYNC_INTERVAL_S)
+        logger.info("Session resumed", extra={"session_id": session["session_id"], "trials": len(session["trials"])})
+        return session["schedule"], len(session["trials"])
+
+    def openSessionLog(self):
+        session_data = self.session_data
+        self.session_log = SessionLog.SessionLog(SessionLog.get_log_filepath(session_data.data_folder, session_data.session_id), \
+                                                 vars.SESSION_LOG_SYNC_INTERVAL_S)
+        self.session_log.append("session_started", session_id=session_data.session_id, user_id=session_data.user_id, \
+                                schedule=session_data.schedule, beat_detector=session_data.beat_detector)
+
+    def logSessionEvent(self, record_type, **fields):
+        if not vars.SESSION_LOG:
+            return
+        if self.session_log is None:
+            self.openSessionLog()
+        self.session_log.append(record_type, **fields)
+
+    def closeSessionLog(self, remove=False):
+        if self.session_log is not None:
+            self.session_log.close(remove)
+            self.session_log = None
+
+    def getUsers(self):
+        return self.profiles.list_users()
+
+    def getUserName(self):
+        return self.profiles.users[self.user_id]["name"]
+
+    def getSensorTime(self, t_monotonic):
+        '''Sensor time (as in the ECG history) of a time.monotonic() reading'''
+        return self.sensor_clock.to_sensor_time(t_monotonic)
+
+    def getTrialWindow(self, start_time, trial_length):
+        return self.beat_tracker.get_trial_window(start_time, trial_length)
+
+    def setBeatDetector(self, name):
+        self.beat_tracker.set_detector(name)
+        self.session_data.beat_detector = name
 
     def set_polar_sensor(self, device):
         self.polar_sensor = PolarH10(device)
+        self.polar_sensor.sensor_clock = self.sensor_clock
+        self.polar_source.attach_polar(self.polar_sensor)
 
     async def connect_sensor(self):
         await self.polar_sensor.connect()
@@ -41,151 +206,368 @@ class Model(QObject):
         await self.polar_sensor.disconnect()
 
     async def connect_polar(self):
-
-        polar_device_found = False
-        print("Looking for Polar device...")
-        while not polar_device_found:
-
-            devices = await BleakScanner.discover()
-            print(f"Found {len(devices)} BLE devices")
-            for device in devices:
-                if device.name is not None and "Polar" in device.name:
-                    polar_device_found = True
-                    print(f"Found Polar device")
-                    break
-            if not polar_device_found:
-                print("Polar device not found, retrying in 1 second")
-                await asyncio.sleep(1)
-        
+        device = await PolarH10.find_device()
         self.set_polar_sensor(device)
         await self.connect_sensor()
 
     async def disconnect_polar(self):
         await self.disconnect_sensor()
 
-    async def update_ecg(self): 
+    async def update_ecg(self):
+        '''"loop" ingest: the BLE callbacks run on this loop and push their frames into the pipeline'''
         await self.polar_sensor.start_ecg_stream()
-        
+        await self.polar_sensor.start_hr_stream() # Inter-beat-intervals for the "ibi" beat detector
+        await self.pump_ingest()
+
+    def start_ingest_thread(self):
+        '''Runs BLE scanning, connection and decoding on a background thread instead of the GUI loop'''
+        self.ingest_worker = IngestWorker(self.polar_source, self.sensor_clock)
+        self.ingest_worker.sensorConnected.connect(self.sensorConnected, Qt.QueuedConnection)
+        self.ingest_worker.sensorError.connect(self.sensorError, Qt.QueuedConnection)
+        self.ingest_worker.start()
+
+    def reconnectSensor(self):
+        '''Scans and connects again on a new ingest thread, after the last one failed'''
+        if self.ingest_worker is not None and self.ingest_worker.thread.is_alive():
+            self.ingest_worker.stop()
+        self.start_ingest_thread()
+
+    async def pump_ingest(self):
         while True:
-            await asyncio.sleep(0.005)
-            while not self.polar_sensor.ecg_queue_is_empty():
-                self.beat_tracker.update_ecg_history(*self.polar_sensor.dequeue_ecg())
-
-    def calculateTrialResults(self, trial_length, start_time, end_time, count_entered, confidence):
+            await self.waitForIngestPoll()
+            self.drain_ingest()
+
+    def setIngestPollPeriod(self, period_s):
+        faster = period_s < self.ingest_period_s
+        self.ingest_period_s = period_s
+        if faster and self.ingest_wakeup is not None:
+            self.ingest_wakeup.set() # Don't wait out the rest of a long poll
+
+    async def waitForIngestPoll(self):
+        if self.ingest_period_s <= vars.INGEST_POLL_PERIOD_S:
+            await asyncio.sleep(self.ingest_period_s)
+            return
+        if self.ingest_wakeup is None:
+            self.ingest_wakeup = asyncio.Event()
+        try:
+            await asyncio.wait_for(self.ingest_wakeup.wait(), self.ingest_period_s)
+        except asyncio.TimeoutError:
+            pass
+        self.ingest_wakeup.clear()
+
+    def drain_ingest(self):
+        n_consumed = self.history_stage.n_ecg_samples
+        with PROFILER.span("drain_ecg_queue"):
+            self.pipeline.pump()
+        n_consumed = self.history_stage.n_ecg_samples - n_consumed
+        if n_consumed:
+            self.ecg_samples_consumed.inc(n_consumed)
+            self.ecg_consumer_lag.set(time.time_ns()/1.0e9 - float(self.beat_tracker.history.get_latest_time()))
+
+    def calculateTrialResults(self, trial_length, start_time, end_time, count_entered, confidence, training=False):
         count_measured = self.beat_tracker.get_beat_count_from_wind(start_time, end_time)
-        accuracy = 1 - abs(count_measured - count_entered)/(0.5*(count_measured + count_entered))
+        accuracy = SessionData.calculateAccuracy(count_measured, count_entered, self.session_data.scoring_method)
         
         trial_data = {"trial_length": int(trial_length), \
+                        "start_time": float(start_time), \
+                        "end_time": float(end_time), \
                         "count_measured": int(count_measured), \
                         "count_entered": int(count_entered), \
                         "accuracy": float(accuracy), \
-                        "confidence": float(confidence)}
+                        "confidence": float(confidence), \
+                        "training": bool(training)}
         self.session_data.append(trial_data)
+        self.logSessionEvent("trial", trial=trial_data)
+
+    def submitTrialResults(self, trial_length, start_time, end_time, count_entered, confidence, training=False):
+        '''Scores a trial in the analysis worker process, trialAnalysed is emitted once it's added to the session'''
+        detector = self.beat_tracker.detector
+        # The strap IBI history lives in this process
+        if self.analysis_worker is None or not self.analysis_worker.is_available() or detector.requires_ibi:
+            self.calculateTrialResults(trial_length, start_time, end_time, count_entered, confidence, training)
+            self.trialAnalysed.emit()
+            return
+        wind_values, wind_times = self.beat_tracker.get_detection_wind(start_time, end_time)
+        job_id = self.analysis_worker.submit(wind_times, wind_values, detector.name, vars.ECG_SAMPLING_RATE)
+        self.pending_trials[job_id] = (detector.name, wind_values, wind_times, (trial_length, start_time, end_time, count_entered, confidence, training))
+
+    @Slot(int, object, float, object)
+    def trialAnalysisFinishedHandler(self, job_id, r_peak_ids, detector_time_s, error):
+        if job_id not in self.pending_trials:
+            return # Submitted before the session was reset
+        detector_name, wind_values, wind_times, trial_inputs = self.pending_trials.pop(job_id)
+        _, start_time, end_time, _, _, _ = trial_inputs
+        if error is None and detector_name == self.beat_tracker.detector.name:
+            self.beat_tracker.store_wind_analysis(start_time, end_time, detector_name, wind_values, wind_times, r_peak_ids, detector_time_s)
+        self.calculateTrialResults(*trial_inputs) # Uses the stored analysis, or detects here if the worker failed
+        self.trialAnalysed.emit()
+
+    def getLastTrial(self):
+        return self.session_data.trials[-1] if self.session_data.trials else None
+
+    def analysisPending(self):
+        return len(self.pending_trials) > 0
+
+    def rescoreTrial(self, trial_id):
+        """Re-runs beat detection on a trial window with the current detector"""
+        trial = self.session_data.trials[trial_id]
+        self.beat_tracker.invalidate_analysis(trial["start_time"], trial["end_time"])
+        count_measured = self.beat_tracker.get_beat_count_from_wind(trial["start_time"], trial["end_time"])
+        self.session_data.rescoreTrial(trial_id, count_measured=count_measured)
+        self.logSessionEvent("trial_rescored", trial_id=trial_id, trial=self.session_data.trials[trial_id])
 
     def calculateSessionResults(self):
-        
-        average_accuracy = self.session_data.calculateAverageAccuracy()
-        accuracy_percentile = self.session_data.calculateAccuracyPercentile()
-        awareness_score, awareness_p_value = self.session_data.calculateAwareness()
-        awareness_percentile = self.session_data.calculateAwarenessPercentile()
-
-        return {"accuracy_score": average_accuracy, \
-                "accuracy_percentile": accuracy_percentile, \
-                "awareness_score": awareness_score, \
-                "awareness_p_value": awareness_p_value, \
-                "awareness_percentile": awareness_percentile}
+        return self.session_data.getSessionResults()
 
     def viewResults(self):
         
         self.session_data.plotSessionSummaryGraphs()
         self.session_data.saveSessionData()
-        
+        if self.session_log is not None:
+            # On disk before the log goes, so a crash in between doesn't save or resume the session again
+            self.session_log.append("session_saved", path=self.session_data.session_filepath)
+            self.session_log.flush()
+        self.closeSessionLog(remove=True) # The session file has everything the log had
+        self.profiles.record_session(self.user_id, self.session_data.session_id, self.session_data.session_filepath, self.session_data.session_summary)
+        self.progress.add_session(self.session_data.session_id, self.session_data.session_summary)
+        if vars.EXPORT_COLUMNAR:
+            self.session_data.exportSession(self.getTrialWindows() if vars.EXPORT_RAW_ECG else None)
+
+    def getProgress(self):
+        return self.progress.get_summary()
+
+    def getReviewMarkers(self):
+        '''Trial windows and their detected beats, to mark on the ECG review'''
+        regions, beat_times = [], []
+        for trial_id, trial in enumerate(self.session_data.trials):
+            if trial_id < self.session_data.n_recovered_trials:
+                continue # Done before the session was interrupted, their ECG wasn't kept
+            regions.append((trial["start_time"], trial["end_time"], f"Trial {trial_id+1}"))
+            beat_times.extend(self.beat_tracker.get_wind_analysis(trial["start_time"], trial["end_time"])["peak_times"])
+        return regions, beat_times
+
+    def getTrialWindows(self):
+        '''(times, values) of the ECG in each trial of the session'''
+        trial_windows = []
+        for trial_id, trial in enumerate(self.session_data.trials):
+            if trial_id < self.session_data.n_recovered_trials:
+                trial_windows.append((np.array([]), np.array([])))
+                continue
+            wind_values, wind_times = self.beat_tracker.get_ecg_wind(trial["start_time"], trial["end_time"])
+            trial_windows.append((wind_times, wind_values))
+        return trial_windows
 
 class SessionData:
 
-    def __init__(self):
+    def __init__(self, data_folder="data", user_id=None):
         
         self.reference_data = ReferenceData()
+        self.user_id = user_id
         self.trials = []
+        self.schedule = None
+        self.scoring_method = "garfinkel"
+        self.beat_detector = vars.BEAT_DETECTOR
+        self.results_cache = None
         self.average_accuracy = None
         self.awareness_score = None
         self.awareness_p_value = None
         self.accuracy_percentile = None
         self.awareness_percentile = None
-
-        data_folder = "data"
-        if not os.path.exists(data_folder):
-            os.makedirs(data_folder)
-        timestamp = datetime.now().strftime("%Y%m%d-%H%M%S")
-        filename = f"session_data_{timestamp}.json"
-        self.session_filepath = os.path.join(data_folder, filename)
-
-    def resetSession(self):
+        self.resampling = None
+        self.n_recovered_trials = 0 # Trials restored from an interrupted session's log
+        self.resampling_engine = ResamplingEngine(vars.RESAMPLING_N_BOOTSTRAP, vars.RESAMPLING_N_PERMUTATIONS, vars.RESAMPLING_CI, \
+                                                  vars.RESAMPLING_SEED, vars.RESAMPLING_WORKERS)
+
+        self.setDataFolder(data_folder)
+
+    def setDataFolder(self, data_folder):
+        self.data_folder = data_folder
+        if not os.path.exists(self.data_folder):
+            os.makedirs(self.data_folder)
+        self.newSessionId()
+
+    def newSessionId(self, session_id=None):
+        if session_id is None:
+            # The user id keeps two users' sessions saved in the same second apart in the shared columnar export and
+            # reports, the time first keeps the ids in time order
+            session_id = datetime.now().strftime("%Y%m%d-%H%M%S")
+            if self.user_id:
+                session_id = f"{session_id}-{self.user_id}"
+        self.session_id = session_id
+        filename = f"session_data_{self.session_id}.json"
+        self.session_filepath = os.path.join(self.data_folder, filename)
+
+    def resetSession(self, schedule=None):
         self.trials = []
-        self.average_accuracy = None
-        self.awareness_score = None
+        self.n_recovered_trials = 0
+        if schedule is not None:
+            self.schedule = schedule
+            self.scoring_method = schedule["scoring_method"]
+            self.resampling_engine.scoring_method = schedule["scoring_method"]
+        self.newSessionId() # Each session gets its own file rather than overwriting the previous one
+        self.invalidateResults()
+
+    def restore(self, session):
+        '''Takes over an interrupted session recovered from its log, see SessionLog.recover'''
+        self.user_id = session["user_id"]
+        self.schedule = session["schedule"]
+        if self.schedule is not None:
+            self.scoring_method = self.schedule["scoring_method"]
+            self.resampling_engine.scoring_method = self.scoring_method
+        self.beat_detector = session["beat_detector"]
+        self.newSessionId(session["session_id"])
+        self.trials = list(session["trials"])
+        self.n_recovered_trials = len(self.trials)
+        self.invalidateResults()
+
+    @staticmethod
+    def isComplete(session):
+        '''Whether a recovered session has every trial of its schedule'''
+        return session["schedule"] is None or len(session["trials"]) >= len(session["schedule"]["trials"])
 
     def append(self, trial_data):
         self.trials.append(trial_data)
+        self.invalidateResults()
+
+    def rescoreTrial(self, trial_id, count_measured=None, count_entered=None, confidence=None):
+        trial = self.trials[trial_id]
+        if count_measured is not None:
+            trial["count_measured"] = int(count_measured)
+        if count_entered is not None:
+            trial["count_entered"] = int(count_entered)
+        if confidence is not None:
+            trial["confidence"] = float(confidence)
+        trial["accuracy"] = float(SessionData.calculateAccuracy(trial["count_measured"], trial["count_entered"], self.scoring_method))
+        self.invalidateResults()
+
+    def invalidateResults(self):
+        self.results_cache = None
+        self.average_accuracy = None
+        self.awareness_score = None
+        self.awareness_p_value = None
+        self.accuracy_percentile = None
+        self.awareness_percentile = None
+        self.resampling = None
+
+    @staticmethod
+    def calculateAccuracy(count_measured, count_entered, method="garfinkel"):
+        return float(Scoring.trial_accuracy(count_measured, count_entered, method))
+
+    def getScoredTrials(self):
+        """Trials that count towards the session scores, i.e. not training trials"""
+        return [trial for trial in self.trials if not trial.get("training", False)]
+
+    def getSessionResults(self):
+        """Session statistics, computed once after each change to the trials"""
+        if self.results_cache is None:
+            self.calculateAverageAccuracy()
+            self.calculateAwareness()
+            self.calculateAccuracyPercentile()
+            self.calculateAwarenessPercentile()
+            self.calculateResampling()
+            self.results_cache = {"accuracy_score": self.average_accuracy, \
+                                  "accuracy_percentile": self.accuracy_percentile, \
+                                  "awareness_score": self.awareness_score, \
+                                  "awareness_p_value": self.awareness_p_value, \
+                                  "awareness_percentile": self.awareness_percentile, \
+                                  **self.resampling}
+        return self.results_cache
 
     def calculateAverageAccuracy(self):
-        self.average_accuracy = np.mean([trial["accuracy"] for trial in self.trials])
+        self.average_accuracy = float(Scoring.mean_accuracy([trial["accuracy"] for trial in self.getScoredTrials()]))
         return self.average_accuracy
 
     def calculateAwareness(self):
-        self.awareness_score, self.awareness_p_value = scipy.stats.pearsonr([trial["confidence"] for trial in self.trials], [trial["accuracy"] for trial in self.trials])
+        trials = self.getScoredTrials()
+        awareness_score, awareness_p_value = Scoring.pearson([trial["confidence"] for trial in trials], [trial["accuracy"] for trial in trials])
+        self.awareness_score, self.awareness_p_value = float(awareness_score), float(awareness_p_value)
         return self.awareness_score, self.awareness_p_value
     
     def calculateAccuracyPercentile(self):
         if self.average_accuracy is None:
             self.calculateAverageAccuracy()
-        self.accuracy_percentile = self.reference_data.calculateAccuracyPercentile(self.average_accuracy)
+        # The reference study scored accuracy with its own formula, other methods aren't comparable
+        self.accuracy_percentile = self.reference_data.calculateAccuracyPercentile(self.average_accuracy) \
+                                   if self.scoring_method == ReferenceData.SCORING_METHOD else np.nan
         return self.accuracy_percentile
 
     def calculateAwarenessPercentile(self):
         if self.awareness_score is None:
             self.calculateAwareness()
-        self.awareness_percentile = self.reference_data.calculateAwarenessPercentile(self.awareness_score)
+        self.awareness_percentile = self.reference_data.calculateAwarenessPercentile(self.awareness_score) \
+                                    if self.scoring_method == ReferenceData.SCORING_METHOD else np.nan
         return self.awareness_percentile
 
+    def calculateResampling(self):
+        """Bootstrap confidence intervals and permutation p-values, which don't assume normally distributed trials"""
+        trials = self.getScoredTrials()
+        if (vars.RESAMPLING_N_BOOTSTRAP <= 0 and vars.RESAMPLING_N_PERMUTATIONS <= 0) or len(trials) == 0:
+            self.resampling = {"accuracy_ci": [np.nan, np.nan], "awareness_ci": [np.nan, np.nan], \
+                               "accuracy_permutation_p": np.nan, "awareness_permutation_p": np.nan}
+            return self.resampling
+        with PROFILER.span("resampling"):
+            results = self.resampling_engine.run([trial["count_measured"] for trial in trials], \
+                                                 [trial["count_entered"] for trial in trials], \
+                                                 [trial["confidence"] for trial in trials])
+        self.resampling = {"accuracy_ci": [float(x) for x in results["accuracy_ci"]], \
+                           "awareness_ci": [float(x) for x in results["awareness_ci"]], \
+                           "accuracy_permutation_p": float(results["accuracy_permutation_p"]), \
+                           "awareness_permutation_p": float(results["awareness_permutation_p"])}
+        return self.resampling
+
     def saveSessionData(self):
-        if self.accuracy_percentile is None:
-            self.calculateAccuracyPercentile()
-        if self.awareness_percentile is None:
-            self.calculateAwarenessPercentile()
+        self.getSessionResults()
 
         self.session_summary = {"date": datetime.now().strftime("%Y-%m-%d %H:%M:%S"), \
+                                "user_id": self.user_id, \
                                 "trial_lengths": [trial["trial_length"] for trial in self.trials], \
+                                "beat_detector": self.beat_detector, \
+                                "protocol": self.schedule["protocol"] if self.schedule else None, \
+                                "protocol_seed": self.schedule["seed"] if self.schedule else None, \
+                                "scoring_method": self.scoring_method, \
+                                "training_trials": sum(trial.get("training", False) for trial in self.trials), \
+                                "recovered_trials": self.n_recovered_trials, \
                                 "average_accuracy": self.average_accuracy, \
                                 "accuracy_percentile": self.accuracy_percentile, \
                                 "awareness_score": self.awareness_score, \
                                 "awareness_p_value": self.awareness_p_value, \
-                                "awareness_percentile": self.awareness_percentile}
+                                "awareness_percentile": self.awareness_percentile, \
+                                **self.resampling}
 
-        print(f"Saving session summary data:\nself.trials: {self.session_summary}")
+        logger.info("Saving session summary data", extra=self.session_summary)
         with open(self.session_filepath, "w") as file:
-            json.dump(self.session_summary, file, indent=4)
+            json.dump({**self.session_summary, "trials": self.trials}, file, indent=4)
 
-        print(f"Data saved to {self.session_filepath}")
+        logger.info("Data saved", extra={"path": self.session_filepath})
+
+    def exportSession(self, trial_windows=None):
+        '''Appends this session's trials (and optionally the raw trial ECG) to the columnar export'''
+        export_folder = os.path.join(vars.DATA_FOLDER, "columnar") # Shared by all users, rows carry the user id
+        SessionExport.export_session(export_folder, self.session_id, self.session_summary, self.trials, trial_windows)
+        if vars.EXPORT_COMPACT_PARTS:
+            SessionExport.compact_if_needed(export_folder, vars.EXPORT_COMPACT_PARTS)
+        logger.info("Session exported", extra={"path": export_folder, "session_id": self.session_id})
 
     def plotSessionSummaryGraphs(self):
+        self.getSessionResults()
         sns.set(style="whitegrid") 
         plt.figure(figsize=(8, 4)) 
+        trials = self.getScoredTrials()
 
         plt.subplot(1, 2, 1)
-        plt.plot([trial["count_measured"] for trial in self.trials], 
-                [trial["count_entered"] for trial in self.trials], 
+        plt.plot([trial["count_measured"] for trial in trials], 
+                [trial["count_entered"] for trial in trials], 
                 "o", markersize=8, markerfacecolor='blue', markeredgewidth=2, markeredgecolor='black') 
         plt.xlabel('Measured beat count')
         plt.ylabel('Estimated beat count')
-        plt.title(f"Average accuracy: {np.mean([trial['accuracy'] for trial in self.trials]):.2f}", fontsize=14)
+        plt.title(f"Average accuracy: {self.average_accuracy:.2f}", fontsize=14)
         plt.xlim([0, 70])
         plt.ylim([0, 70])
         plt.grid(True)  
 
         plt.subplot(1, 2, 2)
-        plt.plot([trial["confidence"] for trial in self.trials], 
-                [trial["accuracy"] for trial in self.trials], 
+        plt.plot([trial["confidence"] for trial in trials], 
+                [trial["accuracy"] for trial in trials], 
                 "o", markersize=8, markerfacecolor='green', markeredgewidth=2, markeredgecolor='black')  
         plt.xlabel('Confidence')
         plt.ylabel('Accuracy')
@@ -196,93 +578,3 @@ class SessionData:
 
         plt.tight_layout() 
         plt.show()
-    
-
-class ReferenceData:
-
-    def __init__(self):
-        self.df_accuracy_awareness = None
-        self.df_accuracy_confidence = None
-        self.loadReferenceData()
-        if vars.SHOW_DEBUG_GRAPHS:
-            self.plotReferenceData()
-
-    def calculateAccuracyPercentile(self, accuracy):
-        return scipy.stats.percentileofscore(self.df_accuracy_awareness["accuracy"], accuracy)
-    
-    def calculateAwarenessPercentile(self, awareness):
-        return scipy.stats.percentileofscore(self.df_accuracy_awareness["awareness"], awareness)
-
-    def loadReferenceData(self):
-        df_acc_aw_highacc =  pd.read_csv("reference/accuracy-awareness_high-acc.csv")
-        df_acc_aw_lowacc =  pd.read_csv("reference/accuracy-awareness_low-acc.csv")
-        df_acc_aw_highacc["group"] = "high-accuracy"
-        df_acc_aw_lowacc["group"] = "low-accuracy"
-        self.df_accuracy_awareness = pd.concat([df_acc_aw_highacc, df_acc_aw_lowacc])
-
-        df_acc_con_highacc =  pd.read_csv("reference/accuracy-confidence_high-acc.csv")
-        df_acc_con_lowacc =  pd.read_csv("reference/accuracy-confidence_low-acc.csv")
-        df_acc_con_highacc["group"] = "high-accuracy"
-        df_acc_con_lowacc["group"] = "low-accuracy"
-        self.df_accuracy_confidence = pd.concat([df_acc_con_highacc, df_acc_con_lowacc])
-
-    def plotReferenceData(self):
-        plt.figure(figsize=(10, 5))
-        plt.subplot(2, 2, 1)
-        # Histogram of accuracy coloured by group
-        plt.hist([self.df_accuracy_awareness[self.df_accuracy_awareness["group"]=="high-accuracy"]["accuracy"], \
-                  self.df_accuracy_awareness[self.df_accuracy_awareness["group"]=="low-accuracy"]["accuracy"]], \
-                  bins=10, stacked=True, label=["high-accuracy", "low-accuracy"])
-        plt.xlabel('Accuracy')
-        plt.ylabel('Count')
-        plt.title("Accuracy Awareness Data")
-
-        plt.subplot(2, 2, 2)
-        plt.hist([self.df_accuracy_confidence[self.df_accuracy_confidence["group"]=="high-accuracy"]["accuracy"], \
-                  self.df_accuracy_confidence[self.df_accuracy_confidence["group"]=="low-accuracy"]["accuracy"]], \
-                  bins=10, stacked=True, label=["high-accuracy", "low-accuracy"])
-        plt.xlabel('Accuracy')
-        plt.ylabel('Count')
-        plt.title("Accuracy Confidence Data")
-        
-        plt.subplot(2, 2, 3)
-        plt.hist([self.df_accuracy_awareness[self.df_accuracy_awareness["group"]=="high-accuracy"]["awareness"], \
-                  self.df_accuracy_awareness[self.df_accuracy_awareness["group"]=="low-accuracy"]["awareness"]], \
-                  bins=10, stacked=True, label=["high-accuracy", "low-accuracy"])
-        plt.xlabel('Awareness')
-        plt.ylabel('Count')
-
-        plt.subplot(2, 2, 4)
-        plt.hist([self.df_accuracy_confidence[self.df_accuracy_confidence["group"]=="high-accuracy"]["confidence"], \
-                  self.df_accuracy_confidence[self.df_accuracy_confidence["group"]=="low-accuracy"]["confidence"]], \
-                  bins=10, stacked=True, label=["high-accuracy", "low-accuracy"])
-        plt.xlabel('Confidence')
-        plt.ylabel('Count')
-        
-        plt.show()
-
-        plt.figure(figsize=(10, 5))
-        # Plot accuracy against awareness coloured by group
-        plt.subplot(1, 2, 1)
-        plt.scatter(self.df_accuracy_awareness[self.df_accuracy_awareness["group"]=="high-accuracy"]["awareness"], \
-                    self.df_accuracy_awareness[self.df_accuracy_awareness["group"]=="high-accuracy"]["accuracy"], \
-                    c="r", label="high-accuracy")
-        plt.scatter(self.df_accuracy_awareness[self.df_accuracy_awareness["group"]=="low-accuracy"]["awareness"], \
-                    self.df_accuracy_awareness[self.df_accuracy_awareness["group"]=="low-accuracy"]["accuracy"], \
-                    c="b", label="low-accuracy")
-        plt.xlabel('Awareness')
-        plt.ylabel('Accuracy')
-        plt.legend()
-        plt.title("Accuracy Awareness Data")
-        plt.subplot(1, 2, 2)
-        plt.scatter(self.df_accuracy_confidence[self.df_accuracy_confidence["group"]=="high-accuracy"]["confidence"], \
-                    self.df_accuracy_confidence[self.df_accuracy_confidence["group"]=="high-accuracy"]["accuracy"], \
-                    c="r", label="high-accuracy")
-        plt.scatter(self.df_accuracy_confidence[self.df_accuracy_confidence["group"]=="low-accuracy"]["confidence"], \
-                    self.df_accuracy_confidence[self.df_accuracy_confidence["group"]=="low-accuracy"]["accuracy"], \
-                    c="b", label="low-accuracy")
-        plt.xlabel('Confidence')
-        plt.ylabel('Accuracy')
-        plt.legend()
-        plt.title("Accuracy Confidence Data")
-        plt.show()
@@ -0,0 +1,482 @@
+import argparse
+import logging
+import threading
+import time
+from collections import deque, namedtuple
+import numpy as np
+from BeatDetectors import StreamingDetector
+from EcgFilter import EcgFilter
+from Instrumentation import REGISTRY
+import vars
+
+'''
+Pipeline class
+Sources, stages and sinks connected into a graph that batches of samples flow through:
+    sources  Source (pushed to, e.g. by the PolarH10 frame callbacks), ReplaySource, SimulatorSource
+    stages   FilterStage, DetectStage, QualityStage, BeatTrackerStage (history, live beats and HRV)
+    sinks    StreamServerSink, RecorderSink, CallbackSink
+A Batch is a stream name ("ecg", "ibi", "ecg_filtered", "peaks", "quality"...), its sample times and values, and
+the perf_counter() time its first ancestor was emitted. A node's receive() gets a batch and returns the batches
+it passes on; every node downstream is handed the same arrays, nothing is copied.
+
+An edge either delivers straight away, on the thread that produced the batch, or through a BoundedQueue, whose
+batches are delivered by pump() on whichever thread calls it. A queue is how a batch crosses threads: the BLE
+thread pushes into one, and the GUI's ingest poll pumps all of them, so a new consumer is a new node, not a new
+polling loop. When a queue is full its policy decides what happens:
+    block        the producer waits for room, so a replay runs no faster than it's consumed. Never on the
+                 thread that pumps the queue, or on the BLE thread
+    drop_oldest  the oldest batch is dropped to make room
+    latest       only the newest batch is kept, for consumers that only want the current state
+Each node's processing time (its own, not the nodes downstream of it) and each queue's depth and drops are
+exported as metrics, see get_report()
+'''
+logger = logging.getLogger(__name__)
+
+Batch = namedtuple("Batch", ["stream", "times", "values", "created"])
+
+POLICIES = ("block", "drop_oldest", "latest")
+
+class BoundedQueue:
+
+    def __init__(self, name, max_batches=64, policy="drop_oldest", block_timeout_s=None):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown queue policy '{policy}', available policies: {', '.join(POLICIES)}")
+        self.name = name
+        self.max_batches = max_batches
+        self.policy = policy
+        self.block_timeout_s = block_timeout_s # None waits for as long as it takes
+        self.batches = deque()
+        self.condition = threading.Condition()
+        self.closed = False
+        self.n_dropped = 0
+        REGISTRY.gauge("pipeline_queue_depth", "Batches waiting in a pipeline queue", {"queue": name}, callback=self.qsize)
+        self.dropped_counter = REGISTRY.counter("pipeline_dropped_batches_total", "Batches a full pipeline queue dropped", {"queue": name})
+
+    def qsize(self):
+        return len(self.batches)
+
+    def put(self, batch):
+        '''Returns False if the batch was dropped'''
+        with self.condition:
+            if self.policy == "latest":
+                self.drop(len(self.batches))
+                self.batches.clear()
+            elif len(self.batches) >= self.max_batches:
+                if self.policy == "drop_oldest":
+                    self.batches.popleft()
+                    self.drop(1)
+                elif not self.condition.wait_for(lambda: len(self.batches) < self.max_batches or self.closed, self.block_timeout_s):
+                    self.drop(1) # Timed out, the new batch is the one lost
+                    return False
+            if self.closed:
+                self.drop(1)
+                return False
+            self.batches.append(batch)
+            return True
+
+    def drop(self, n_batches):
+        if n_batches:
+            self.n_dropped += n_batches
+            self.dropped_counter.inc(n_batches)
+
+    def get_all(self):
+        with self.condition:
+            batches = list(self.batches)
+            self.batches.clear()
+            self.condition.notify_all()
+        return batches
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+Edge = namedtuple("Edge", ["downstream", "streams", "queue"])
+
+class NodeStats:
+
+    def __init__(self, name):
+        self.batches = 0
+        self.samples = 0
+        self.total_s = 0.0
+        self.max_s = 0.0
+        self.age_s = np.nan # How long ago the latest batch's source emitted it, when it got here
+        self.histogram = REGISTRY.histogram("pipeline_node_seconds", "Time a pipeline node took per batch", {"node": name})
+
+    def add(self, duration_s, n_samples, age_s):
+        self.batches += 1
+        self.samples += n_samples
+        self.total_s += duration_s
+        self.max_s = max(self.max_s, duration_s)
+        self.age_s = age_s
+        self.histogram.observe(duration_s)
+
+class Node:
+    '''
+    A source, stage or sink. receive() returns the batches to pass on, a list which may be empty, or None for a sink.
+    streams limits the streams it's given, None takes them all
+    '''
+    streams = None
+
+    def __init__(self, name):
+        self.name = name
+        self.pipeline = None
+
+    def receive(self, batch):
+        return [batch]
+
+    def close(self):
+        pass
+
+class Pipeline:
+
+    def __init__(self, name="pipeline"):
+        self.name = name
+        self.nodes = {} # name -> node
+        self.edges = {} # upstream name -> [Edge]
+        self.queued_edges = [] # In the order they were connected, which is the order pump() delivers them
+        self.stats = {} # name -> NodeStats
+
+    def add(self, node):
+        if node.name in self.nodes:
+            if self.nodes[node.name] is node:
+                return node
+            raise ValueError(f"Pipeline '{self.name}' already has a node called '{node.name}'")
+        node.pipeline = self
+        self.nodes[node.name] = node
+        self.stats[node.name] = NodeStats(node.name)
+        return node
+
+    def connect(self, upstream, downstream, streams=None, max_batches=None, policy=None, block_timeout_s=None):
+        '''
+        Sends upstream's batches (of the given streams, or all) to downstream. With max_batches or a policy they
+        go through a BoundedQueue, which is returned, otherwise they're delivered straight away and None is returned
+        '''
+        self.add(upstream)
+        self.add(downstream)
+        queue = None
+        if max_batches is not None or policy is not None:
+            queue = BoundedQueue(f"{self.name}:{upstream.name}->{downstream.name}", max_batches or 64, policy or "drop_oldest", block_timeout_s)
+            self.queued_edges.append(Edge(downstream, streams, queue))
+        self.edges.setdefault(upstream.name, []).append(Edge(downstream, streams, queue))
+        return queue
+
+    def push(self, node, batch):
+        '''Passes a batch from node to everything downstream of it'''
+        for edge in self.edges.get(node.name, ()):
+            if edge.streams is not None and batch.stream not in edge.streams:
+                continue
+            if edge.queue is not None:
+                edge.queue.put(batch)
+            else:
+                self.deliver(edge.downstream, batch)
+
+    def deliver(self, node, batch):
+        if node.streams is not None and batch.stream not in node.streams:
+            return
+        started = time.perf_counter()
+        outputs = node.receive(batch)
+        finished = time.perf_counter()
+        self.stats[node.name].add(finished - started, len(batch.values), finished - batch.created)
+        for output in outputs or ():
+            self.push(node, output)
+
+    def pump(self):
+        '''Delivers every queued batch, on the calling thread. Returns how many there were'''
+        n_batches = 0
+        for edge in self.queued_edges:
+            for batch in edge.queue.get_all():
+                self.deliver(edge.downstream, batch)
+                n_batches += 1
+        return n_batches
+
+    def close(self):
+        '''Delivers what's still queued, then closes the queues and the nodes, sources first'''
+        self.pump()
+        for edge in self.queued_edges:
+            edge.queue.close() # Wakes any producer blocked on a full queue
+        for node in self.nodes.values():
+            node.close()
+
+    def get_report(self):
+        '''(node, batches, samples, total s, mean µs per batch, max ms, latest age ms), most time first'''
+        rows = [(name, stats.batches, stats.samples, stats.total_s, 1e6*stats.total_s/stats.batches if stats.batches else 0.0, \
+                 1e3*stats.max_s, 1e3*stats.age_s) for name, stats in self.stats.items() if stats.batches]
+        return sorted(rows, key=lambda row: row[3], reverse=True)
+
+    def log_report(self):
+        for name, batches, samples, total_s, mean_us, max_ms, age_ms in self.get_report():
+            logger.info("Pipeline node", extra={"pipeline": self.name, "node": name, "batches": batches, "samples": samples, \
+                                                "total_s": round(total_s, 3), "mean_us": round(mean_us, 1), "max_ms": round(max_ms, 2), \
+                                                "age_ms": round(age_ms, 1)})
+        for edge in self.queued_edges:
+            if edge.queue.n_dropped:
+                logger.warning("Pipeline queue dropped batches", extra={"queue": edge.queue.name, "dropped": edge.queue.n_dropped})
+
+class Source(Node):
+    '''Pushed to from outside, e.g. by the PolarH10 frame callbacks, see attach_polar()'''
+
+    def emit(self, stream, times, values, created=None):
+        self.pipeline.push(self, Batch(stream, times, values, time.perf_counter() if created is None else created))
+
+    def attach_polar(self, polar_sensor):
+        polar_sensor.ecg_frame_callback = lambda times, values: self.emit("ecg", times, values)
+        polar_sensor.ibi_frame_callback = lambda times, values: self.emit("ibi", times, values)
+
+class ThreadedSource(Source):
+    '''Emits the frames from next_frame() on its own thread, in real time or as fast as the queues take them'''
+
+    def __init__(self, name, sampling_rate=vars.ECG_SAMPLING_RATE, frame_samples=73, realtime=True):
+        super().__init__(name)
+        self.sampling_rate = sampling_rate
+        self.frame_samples = frame_samples
+        self.realtime = realtime
+        self.thread = None
+        self.stop_event = threading.Event()
+
+    def next_frame(self):
+        '''(times, values) of the next frame, None at the end'''
+        raise NotImplementedError
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name=self.name, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        started = time.perf_counter()
+        n_samples = 0
+        while not self.stop_event.is_set():
+            frame = self.next_frame()
+            if frame is None:
+                return
+            n_samples += len(frame[1])
+            if self.realtime:
+                self.stop_event.wait(max(started + n_samples/self.sampling_rate - time.perf_counter(), 0))
+            self.emit("ecg", *frame)
+
+    def is_running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def close(self):
+        self.stop_event.set()
+
+class ReplaySource(ThreadedSource):
+    '''Replays a recording, in the DetectorBenchmark .npz format or as arrays'''
+
+    def __init__(self, name, times, values, sampling_rate=vars.ECG_SAMPLING_RATE, frame_samples=73, realtime=True):
+        super().__init__(name, sampling_rate, frame_samples, realtime)
+        self.times = np.asarray(times, dtype=float)
+        self.values = np.asarray(values)
+        self.position = 0
+
+    @classmethod
+    def from_recording(cls, name, filepath, frame_samples=73, realtime=True):
+        with np.load(filepath) as data:
+            values = np.asarray(data["ecg"])
+            sampling_rate = float(data["sampling_rate"]) if "sampling_rate" in data else vars.ECG_SAMPLING_RATE
+            times = np.asarray(data["times"], dtype=float) if "times" in data else np.arange(len(values))/sampling_rate
+        return cls(name, times, values, sampling_rate, frame_samples, realtime)
+
+    def next_frame(self):
+        if self.position >= len(self.values):
+            return None
+        frame = slice(self.position, self.position + self.frame_samples)
+        self.position = frame.stop
+        return self.times[frame], self.values[frame]
+
+class SimulatorSource(ThreadedSource):
+    '''Synthetic ECG from the stress harness, for duration_s or until it's closed'''
+
+    def __init__(self, name, heart_rate=60, noise_uv=20, seed=None, duration_s=None, sampling_rate=vars.ECG_SAMPLING_RATE, \
+                 frame_samples=73, realtime=True):
+        super().__init__(name, sampling_rate, frame_samples, realtime)
+        self.duration_s = duration_s
+        from StressHarness import SyntheticEcg # Only needed here, and the harness imports more than its ECG model
+        self.ecg = SyntheticEcg(sampling_rate, heart_rate, noise_uv, np.random.default_rng(seed))
+        self.start_time = time.time_ns()/1.0e9
+
+    def next_frame(self):
+        if self.duration_s is not None and self.ecg.n_samples >= self.duration_s*self.sampling_rate:
+            return None
+        times = self.start_time + (self.ecg.n_samples + np.arange(self.frame_samples))/self.sampling_rate
+        return times, self.ecg.next(self.frame_samples)
+
+class FilterStage(Node):
+    '''"ecg" -> "ecg_filtered", see EcgFilter'''
+    streams = ("ecg",)
+
+    def __init__(self, name="filter", sampling_rate=vars.ECG_SAMPLING_RATE):
+        super().__init__(name)
+        self.ecg_filter = EcgFilter(sampling_rate, vars.ECG_FILTER_HIGHPASS_HZ, vars.ECG_FILTER_NOTCH_HZ, \
+                                    vars.ECG_FILTER_NOTCH_Q, vars.ECG_FILTER_LOWPASS_HZ)
+
+    def receive(self, batch):
+        return [batch._replace(stream="ecg_filtered", values=self.ecg_filter.process(batch.values))]
+
+class DetectStage(Node):
+    '''Beats as they happen: "ecg_filtered" (or "ecg") -> "peaks", the times of the R peaks'''
+    streams = ("ecg_filtered", "ecg")
+
+    def __init__(self, name="detect", stream="ecg_filtered", sampling_rate=vars.ECG_SAMPLING_RATE):
+        super().__init__(name)
+        self.streams = (stream,)
+        self.detector = StreamingDetector(sampling_rate)
+        self.times = deque(maxlen=int(sampling_rate)) # Times of the latest samples, for the detector lookback
+
+    def receive(self, batch):
+        peak_times = []
+        for t, x in zip(batch.times, batch.values):
+            self.times.append(float(t))
+            peak_id = self.detector.process_sample(float(x))
+            if peak_id is not None:
+                samples_ago = self.detector.sample_id - 1 - peak_id
+                if samples_ago < len(self.times):
+                    peak_times.append(self.times[-1 - samples_ago])
+        if not peak_times:
+            return []
+        return [batch._replace(stream="peaks", times=np.array(peak_times), values=np.array(peak_times))]
+
+class QualityStage(Node):
+    '''
+    "ecg" -> "quality" every window_s: the fraction of 1 s blocks whose spread is neither flat (electrodes off)
+    nor huge (movement), as one value at the window's last sample time
+    '''
+    streams = ("ecg",)
+
+    def __init__(self, name="quality", window_s=5.0, min_std_uv=20.0, max_std_uv=1000.0, sampling_rate=vars.ECG_SAMPLING_RATE):
+        super().__init__(name)
+        self.block_samples = int(sampling_rate)
+        self.window_blocks = max(1, int(window_s))
+        self.min_std_uv = min_std_uv
+        self.max_std_uv = max_std_uv
+        self.pending = np.array([])
+        self.good_blocks = []
+
+    def receive(self, batch):
+        self.pending = np.concatenate([self.pending, batch.values])
+        outputs = []
+        while len(self.pending) >= self.block_samples:
+            block, self.pending = self.pending[:self.block_samples], self.pending[self.block_samples:]
+            self.good_blocks.append(self.min_std_uv <= np.std(block) <= self.max_std_uv)
+            if len(self.good_blocks) == self.window_blocks:
+                outputs.append(batch._replace(stream="quality", times=np.array([batch.times[-1]]), values=np.array([np.mean(self.good_blocks)])))
+                self.good_blocks = []
+        return outputs
+
+class BeatTrackerStage(Node):
+    '''
+    Takes "ecg" and "ibi" into a BeatTracker's histories (which the display and the trial scoring read), passes
+    the ECG on and emits the live beats it found as "peaks"
+    '''
+    streams = ("ecg", "ibi")
+
+    def __init__(self, beat_tracker, name="history"):
+        super().__init__(name)
+        self.beat_tracker = beat_tracker
+        self.n_ecg_samples = 0
+
+    def receive(self, batch):
+        if batch.stream == "ibi":
+            for t, ibi in zip(batch.times, batch.values):
+                self.beat_tracker.update_ibi_history(t, ibi)
+            return []
+        self.beat_tracker.update_ecg_history_batch(batch.times, batch.values)
+        self.n_ecg_samples += len(batch.values)
+        peak_times = self.beat_tracker.pop_new_peak_times()
+        if not peak_times:
+            return [batch]
+        return [batch, batch._replace(stream="peaks", times=np.array(peak_times), values=np.array(peak_times))]
+
+class StreamServerSink(Node):
+    '''"ecg", "acc" and "peaks" to the remote dashboards, see StreamServer'''
+    streams = ("ecg", "acc", "peaks")
+
+    def __init__(self, stream_server, name="stream_server"):
+        super().__init__(name)
+        self.stream_server = stream_server
+
+    def receive(self, batch):
+        if batch.stream == "ecg":
+            self.stream_server.publish_ecg(batch.times, batch.values)
+        elif batch.stream == "acc":
+            self.stream_server.publish_acc(batch.times, batch.values)
+        else:
+            self.stream_server.publish_peaks(list(batch.times))
+
+class RecorderSink(Node):
+    '''
+    Records "ecg", "peaks" and "ibi" to a .npz in the DetectorBenchmark format when it's closed, the peaks as
+    the r_peaks labels, so a recording can be replayed or benchmarked
+    '''
+    streams = ("ecg", "peaks", "ibi")
+
+    def __init__(self, filepath, name="recorder", sampling_rate=vars.ECG_SAMPLING_RATE):
+        super().__init__(name)
+        self.filepath = filepath
+        self.sampling_rate = sampling_rate
+        self.batches = {stream: [] for stream in self.streams}
+
+    def receive(self, batch):
+        self.batches[batch.stream].append(batch) # The arrays are only concatenated when the recording is saved
+
+    def close(self):
+        times = np.concatenate([batch.times for batch in self.batches["ecg"]] or [np.array([])]).astype(float)
+        values = np.concatenate([batch.values for batch in self.batches["ecg"]] or [np.array([])])
+        peak_times = np.concatenate([batch.times for batch in self.batches["peaks"]] or [np.array([])])
+        ibi_times = np.concatenate([batch.times for batch in self.batches["ibi"]] or [np.array([])]).astype(float)
+        ibi = np.concatenate([batch.values for batch in self.batches["ibi"]] or [np.array([])]).astype(float)
+        r_peaks = np.clip(np.searchsorted(times, peak_times), 0, max(len(times) - 1, 0))
+        np.savez_compressed(self.filepath, ecg=values, times=times, r_peaks=r_peaks, sampling_rate=self.sampling_rate, ibi_times=ibi_times, ibi=ibi)
+        logger.info("Recording saved", extra={"path": self.filepath, "samples": len(values), "peaks": len(r_peaks)})
+
+class CallbackSink(Node):
+    '''Calls callback(batch) for each batch of the given streams'''
+
+    def __init__(self, name, callback, streams=None):
+        super().__init__(name)
+        self.callback = callback
+        self.streams = streams
+
+    def receive(self, batch):
+        self.callback(batch)
+
+def print_report(pipeline):
+    print(f"{'Node':<16}{'Batches':>9}{'Samples':>10}{'Total s':>9}{'µs/batch':>10}{'Max ms':>8}{'Age ms':>8}")
+    for name, batches, samples, total_s, mean_us, max_ms, age_ms in pipeline.get_report():
+        print(f"{name:<16}{batches:>9}{samples:>10}{total_s:>9.3f}{mean_us:>10.1f}{max_ms:>8.2f}{age_ms:>8.1f}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a recording or simulated ECG through filter, detect and quality stages and report each node's time")
+    parser.add_argument("recording", nargs="?", help="A DetectorBenchmark .npz recording, simulated ECG if not given")
+    parser.add_argument("--seconds", type=float, default=60, help="Seconds of simulated ECG")
+    parser.add_argument("--realtime", action="store_true", help="Emit at the sampling rate instead of as fast as the stages take it")
+    parser.add_argument("--policy", default="block", choices=POLICIES, help="Policy of the queue between the source and the stages")
+    parser.add_argument("--max-batches", type=int, default=16)
+    parser.add_argument("--record", help="Record the ECG and detected beats to this .npz")
+    args = parser.parse_args()
+
+    pipeline = Pipeline("replay")
+    if args.recording:
+        source = ReplaySource.from_recording("replay", args.recording, realtime=args.realtime)
+    else:
+        source = SimulatorSource("simulator", seed=0, duration_s=args.seconds, realtime=args.realtime)
+    ecg_filter = FilterStage()
+    pipeline.connect(source, ecg_filter, max_batches=args.max_batches, policy=args.policy)
+    pipeline.connect(source, QualityStage(), max_batches=args.max_batches, policy=args.policy)
+    detect = DetectStage()
+    pipeline.connect(ecg_filter, detect)
+    n_peaks = []
+    pipeline.connect(detect, CallbackSink("count", lambda batch: n_peaks.append(len(batch.times))))
+    if args.record:
+        recorder = RecorderSink(args.record)
+        pipeline.connect(source, recorder, max_batches=args.max_batches, policy=args.policy)
+        pipeline.connect(detect, recorder)
+
+    started = time.perf_counter()
+    source.start()
+    while source.is_running():
+        pipeline.pump()
+        time.sleep(0.005)
+    pipeline.close()
+    print(f"{sum(n_peaks)} beats in {time.perf_counter() - started:.2f} s")
+    print_report(pipeline)
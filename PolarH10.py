@@ -1,8 +1,13 @@
-from bleak import BleakClient
+from bleak import BleakClient, BleakScanner
 import asyncio
 import time
 import numpy as np
 import math
+import logging
+from Instrumentation import REGISTRY
+from Profiler import PROFILER
+
+logger = logging.getLogger(__name__)
 
 class CircularBuffer2D:
     def __init__(self, rows, cols):
@@ -12,24 +17,36 @@ class CircularBuffer2D:
         self.head = 0
         self.tail = 0
         self.dequeued_row = np.full((1,3), np.nan) 
+        self.name = None
+        self.overflowing = False
+        self.overwrites_counter = None
+
+    def instrument(self, name):
+        '''Exposes the queue depth and overwrite count of this buffer as metrics'''
+        self.name = name
+        REGISTRY.gauge("queue_depth", "Rows waiting in a circular buffer", {"queue": name}, callback=self.get_num_in_queue)
+        self.overwrites_counter = REGISTRY.counter("queue_overwrites_total", "Rows lost by overwriting a full circular buffer", {"queue": name})
     
     def enqueue(self, new_row):
         if len(new_row) != self.cols:
             raise ValueError("New row must have the same number of columns as the buffer")
         
         if self.is_full():
-            print("Overwriting circular buffer!")
-            print(f"Head id: {self.head}, Number of rows: {self.rows}")
+            if not self.overflowing: # Log once per overflow, the counter tracks every overwrite
+                logger.warning("Overwriting circular buffer", extra={"queue": self.name, "head": self.head, "rows": self.rows})
+                self.overflowing = True
+            if self.overwrites_counter is not None:
+                self.overwrites_counter.inc()
             self.tail = (self.tail + 1) % self.rows
+        else:
+            self.overflowing = False
         
         self.buffer[self.head] = new_row
         self.head = (self.head + 1) % self.rows
 
     def dequeue(self):
         if self.is_empty():
-            print(f"Circular buffer is empty! Head id: {self.head}")
-            print(f"value at head: {self.buffer[self.head]}")
-            print(f"value befor head: {self.buffer[self.head-1]}")
+            logger.debug("Circular buffer is empty", extra={"queue": self.name, "head": self.head})
             return None
         
         self.dequeued_row = np.array(self.buffer[self.tail]) # Returns nan without np.array()
@@ -120,7 +137,21 @@ class PolarH10:
         self.polar_to_epoch_s = 0
         self.first_acc_record = True
         self.first_ecg_record = True
+        # If set, decoded frames are handed over as arrays instead of being queued sample by sample
+        self.ecg_frame_callback = None
+        self.ibi_frame_callback = None
+        self.sensor_clock = None # SensorClock learning the offset to the monotonic clock from ECG frame arrivals
+        self.configureMetrics()
+
+    def configureMetrics(self):
+        for name, queue in {"ibi_values": self.ibi_queue_values, "ibi_times": self.ibi_queue_times, \
+                            "acc_values": self.acc_queue_values, "acc_times": self.acc_queue_times, \
+                            "ecg_values": self.ecg_queue_values, "ecg_times": self.ecg_queue_times}.items():
+            queue.instrument(name)
+        self.frames_counter = {stream: REGISTRY.counter("ble_frames_total", "BLE notifications received", {"stream": stream}) for stream in ("ecg", "acc", "hr")}
+        self.samples_counter = {stream: REGISTRY.counter("samples_decoded_total", "Samples decoded from BLE notifications", {"stream": stream}) for stream in ("ecg", "acc", "ibi")}
     
+    @PROFILER.profile("hr_data_conv")
     def hr_data_conv(self, sender, data):  
         """
         `data` is formatted according to the GATT Characteristic and Object Type 0x2A37 Heart Rate Measurement which is one of the three characteristics included in the "GATT Service 0x180D Heart Rate".
@@ -138,6 +169,7 @@ class PolarH10:
         - inter-beat-intervals (IBIs)
             One IBI is encoded by 2 consecutive bytes. Up to 18 bytes depending on presence of uint16 HR format and energy expenditure.
         """
+        self.frames_counter["hr"].inc()
         byte0 = data[0] # heart rate format
         uint8_format = (byte0 & 1) == 0
         energy_expenditure = ((byte0 >> 3) & 1) == 1
@@ -158,16 +190,25 @@ class PolarH10:
             # ee = (data[first_rr_byte + 1] << 8) | data[first_rr_byte]
             first_rr_byte += 2
 
-        for i in range(first_rr_byte, len(data), 2):
+        ibis = []
+        for i in range(first_rr_byte, len(data) - 1, 2):
             ibi = (data[i + 1] << 8) | data[i]
             # Polar H7, H9, and H10 record IBIs in 1/1024 seconds format.
             # Convert 1/1024 sec format to milliseconds.
             # TODO: move conversion to model and only convert if sensor doesn't
             # transmit data in milliseconds.
-            ibi = np.ceil(ibi / 1024 * 1000)            
+            ibis.append(np.ceil(ibi / 1024 * 1000))
+        self.samples_counter["ibi"].inc(len(ibis))
+
+        t = time.time_ns()/1.0e9
+        if self.ibi_frame_callback is not None:
+            self.ibi_frame_callback(np.full(len(ibis), t), np.array(ibis))
+            return
+        for ibi in ibis:
             self.ibi_queue_values.enqueue(np.array([ibi]))
-            self.ibi_queue_times.enqueue(np.array([time.time_ns()/1.0e9]))
+            self.ibi_queue_times.enqueue(np.array([t]))
 
+    @PROFILER.profile("acc_data_conv")
     def acc_data_conv(self, sender, data): 
     # [02 EA 54 A2 42 8B 45 52 08 01 45 FF E4 FF B5 03 45 FF E4 FF B8 03 ...]
     # 02=ACC, 
@@ -177,6 +218,7 @@ class PolarH10:
     # sample1, sample2,
 
         if data[0] == 0x02:
+            self.frames_counter["acc"].inc()
             time_step = 0.005 # 200 Hz sample rate
             timestamp = PolarH10.convert_to_unsigned_long(data, 1, 8)/1.0e9 # timestamp of the last sample in the record
             
@@ -185,6 +227,7 @@ class PolarH10:
             step = math.ceil(resolution / 8.0)
             samples = data[10:] 
             n_samples = math.floor(len(samples)/(step*3))
+            self.samples_counter["acc"].inc(n_samples)
             record_duration = (n_samples-1)*time_step # duration of the current record received in seconds
 
             if self.first_acc_record: # First record at the start of the stream
@@ -208,31 +251,47 @@ class PolarH10:
 
                 sample_timestamp += time_step
     
+    @PROFILER.profile("ecg_data_conv")
     def ecg_data_conv(self, sender, data):
     # [00 EA 1C AC CC 99 43 52 08 00 68 00 00 58 00 00 46 00 00 3D 00 00 32 00 00 26 00 00 16 00 00 04 00 00 ...]
     # 00 = ECG; EA 1C AC CC 99 43 52 08 = last sample timestamp in nanoseconds; 00 = ECG frameType, sample0 = [68 00 00] microVolts(104) , sample1, sample2, ....
         if data[0] == 0x00:
-            timestamp = PolarH10.convert_to_unsigned_long(data, 1, 8)/1.0e9
-            step = 3
-            time_step = 1.0/ self.ECG_SAMPLING_FREQ
-            samples = data[10:]
-            n_samples = math.floor(len(samples)/step)
-            offset = 0
-            recordDuration = (n_samples-1)*time_step
-
-            if self.first_ecg_record:
-                stream_start_t_epoch_s = time.time_ns()/1.0e9 - recordDuration
-                stream_start_t_polar_s = timestamp - recordDuration
-                self.polar_to_epoch_s = stream_start_t_epoch_s - stream_start_t_polar_s
-                self.first_ecg_record = False
-
-            sample_timestamp = timestamp - recordDuration + self.polar_to_epoch_s # timestamp of the first sample in the record in epoch seconds
-            while offset < len(samples):
-                ecg = PolarH10.convert_array_to_signed_int(samples, offset, step)       
-                offset += step
+            sample_times, ecg_values = self.decode_ecg_frame(data)
+            if self.ecg_frame_callback is not None:
+                self.ecg_frame_callback(sample_times, ecg_values)
+                return
+            for sample_timestamp, ecg in zip(sample_times, ecg_values):
                 self.ecg_queue_values.enqueue(np.array([ecg]))
                 self.ecg_queue_times.enqueue(np.array([sample_timestamp]))
-                sample_timestamp += time_step
+
+    def decode_ecg_frame(self, data):
+        '''Decodes a whole PMD ECG frame at once, returns the sample times in epoch seconds and the values in microvolts'''
+        arrival = time.monotonic()
+        timestamp = PolarH10.convert_to_unsigned_long(data, 1, 8)/1.0e9
+        step = 3
+        time_step = 1.0/ self.ECG_SAMPLING_FREQ
+        samples = data[10:]
+        n_samples = math.floor(len(samples)/step)
+        self.frames_counter["ecg"].inc()
+        self.samples_counter["ecg"].inc(n_samples)
+        recordDuration = (n_samples-1)*time_step
+
+        if self.first_ecg_record:
+            stream_start_t_epoch_s = time.time_ns()/1.0e9 - recordDuration
+            stream_start_t_polar_s = timestamp - recordDuration
+            self.polar_to_epoch_s = stream_start_t_epoch_s - stream_start_t_polar_s
+            self.first_ecg_record = False
+
+        sample_timestamp = timestamp - recordDuration + self.polar_to_epoch_s # timestamp of the first sample in the record in epoch seconds
+        sample_times = sample_timestamp + np.arange(n_samples)*time_step
+        if self.sensor_clock is not None and n_samples:
+            self.sensor_clock.add_frame(sample_times[-1], arrival)
+
+        # 24 bit little endian signed samples
+        raw = np.frombuffer(bytes(samples[:n_samples*step]), dtype=np.uint8).reshape(n_samples, step).astype(np.int32)
+        ecg_values = raw[:, 0] | (raw[:, 1] << 8) | (raw[:, 2] << 16)
+        ecg_values = np.where(ecg_values & 0x800000, ecg_values - 0x1000000, ecg_values)
+        return sample_times, ecg_values
 
     @staticmethod
     def convert_array_to_signed_int(data, offset, length):
@@ -245,8 +304,22 @@ class PolarH10:
             bytearray(data[offset : offset + length]), byteorder="little", signed=False,
         )
     
-    async def connect(self):
-        self.bleak_client = BleakClient(self.bleak_device)
+    @staticmethod
+    async def find_device():
+        '''Scans until a Polar device is found, returns its bleak device'''
+        logger.info("Looking for Polar device...")
+        while True:
+            devices = await BleakScanner.discover()
+            logger.info("Found BLE devices", extra={"count": len(devices)})
+            for device in devices:
+                if device.name is not None and "Polar" in device.name:
+                    logger.info("Found Polar device", extra={"device_name": device.name})
+                    return device
+            logger.info("Polar device not found, retrying in 1 second")
+            await asyncio.sleep(1)
+
+    async def connect(self, disconnected_callback=None):
+        self.bleak_client = BleakClient(self.bleak_device, disconnected_callback=disconnected_callback)
         await self.bleak_client.connect()
     
     async def disconnect(self):
@@ -276,28 +349,28 @@ class PolarH10:
     async def start_acc_stream(self):
         await self.bleak_client.write_gatt_char(PolarH10.PMD_CHAR1_UUID, PolarH10.ACC_WRITE, response=True)
         await self.bleak_client.start_notify(PolarH10.PMD_CHAR2_UUID, self.acc_data_conv)
-        print("Collecting ACC data...", flush=True)
+        logger.info("Collecting ACC data...")
 
     async def stop_acc_stream(self):
         await self.bleak_client.stop_notify(PolarH10.PMD_CHAR2_UUID)
-        print("Stopping ACC data...", flush=True)
+        logger.info("Stopping ACC data...")
 
     async def start_ecg_stream(self):
         await self.bleak_client.write_gatt_char(PolarH10.PMD_CHAR1_UUID, PolarH10.ECG_WRITE, response=True)
         await self.bleak_client.start_notify(PolarH10.PMD_CHAR2_UUID, self.ecg_data_conv)
-        print("Collecting ECG data...", flush=True)
+        logger.info("Collecting ECG data...")
 
     async def stop_ecg_stream(self):
         await self.bleak_client.stop_notify(PolarH10.PMD_CHAR2_UUID)
-        print("Stopping ECG data...", flush=True)
+        logger.info("Stopping ECG data...")
 
     async def start_hr_stream(self):
         await self.bleak_client.start_notify(PolarH10.HEART_RATE_MEASUREMENT_UUID, self.hr_data_conv)
-        print("Collecting HR data...", flush=True)
+        logger.info("Collecting HR data...")
 
     async def stop_hr_stream(self):
         await self.bleak_client.stop_notify(PolarH10.HEART_RATE_MEASUREMENT_UUID)
-        print("Stopping HR data...", flush=True)
+        logger.info("Stopping HR data...")
 
     def dequeue_acc(self):
         value_row = self.acc_queue_values.dequeue()
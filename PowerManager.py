@@ -0,0 +1,122 @@
+import logging
+import time
+from PySide6.QtCore import QObject, QTimer, Signal
+from PySide6.QtGui import QCursor
+from Instrumentation import REGISTRY
+import vars
+
+logger = logging.getLogger(__name__)
+
+'''
+PowerManager class
+Chooses how often the ECG display is redrawn and the sensor queue drained, from the session state, whether the
+window can be seen and whether anyone is using it:
+    active  a trial is being recorded: full rate
+    idle    any other state: the display at about 30 fps, the queue drained every 50 ms (frames are coalesced, not lost)
+    away    no mouse or button activity for AWAY_TIMEOUT_S outside a trial: a few redraws a second, drained every 250 ms
+    hidden  the window is minimised or hidden: no redraws, drained every 250 ms (full rate still while recording)
+powerModeChanged is emitted with the new mode, and render_period_ms (None while paused) and ingest_period_s are
+what the Controller and Model should use. Process CPU time is accounted to each (session state, power mode),
+see get_cpu_report(), and exported as metrics
+'''
+class PowerManager(QObject):
+    powerModeChanged = Signal(str)
+
+    def __init__(self, away_timeout_s=120, enabled=True):
+        super().__init__()
+        self.away_timeout_s = away_timeout_s
+        self.enabled = enabled
+        self.state = None
+        self.recording = False
+        self.visible = True
+        self.last_activity = time.monotonic()
+        self.mode = None
+        self.render_period_ms = vars.UPDATE_ECG_SERIES_PERIOD
+        self.ingest_period_s = vars.INGEST_POLL_PERIOD_S
+
+        self.usage = {} # (state, mode) -> [wall s, cpu s]
+        self.cpu_mark = time.process_time()
+        self.wall_mark = time.monotonic()
+
+        # Polls the cursor rather than filtering every application event, which would cost more than it saves
+        self.cursor_pos = QCursor.pos()
+        self.activity_timer = QTimer(self)
+        self.activity_timer.timeout.connect(self.checkActivity)
+        self.activity_timer.start(2000)
+
+    def set_state(self, state, recording=False):
+        self.account() # The time so far belongs to the previous state
+        self.state = state
+        self.recording = recording
+        self.last_activity = time.monotonic() # State changes come from the user or from a trial
+        self.update_mode(accounted=True)
+
+    def set_visible(self, visible):
+        self.visible = visible
+        self.update_mode()
+
+    def user_activity(self):
+        self.last_activity = time.monotonic()
+        if self.mode == "away":
+            self.update_mode()
+
+    def checkActivity(self):
+        cursor_pos = QCursor.pos()
+        if cursor_pos != self.cursor_pos:
+            self.cursor_pos = cursor_pos
+            self.user_activity()
+        elif self.mode == "idle" and time.monotonic() - self.last_activity > self.away_timeout_s:
+            self.update_mode()
+
+    def select_mode(self):
+        if self.recording or not self.enabled:
+            return "active"
+        if not self.visible:
+            return "hidden"
+        if time.monotonic() - self.last_activity > self.away_timeout_s:
+            return "away"
+        return "idle"
+
+    def update_mode(self, accounted=False):
+        mode = self.select_mode()
+        if mode == "active":
+            render_period_ms, ingest_period_s = vars.UPDATE_ECG_SERIES_PERIOD, vars.INGEST_POLL_PERIOD_S
+        elif mode == "idle":
+            render_period_ms, ingest_period_s = vars.UPDATE_ECG_SERIES_IDLE_PERIOD, vars.INGEST_POLL_IDLE_PERIOD_S
+        elif mode == "away":
+            render_period_ms, ingest_period_s = vars.UPDATE_ECG_SERIES_AWAY_PERIOD, vars.INGEST_POLL_AWAY_PERIOD_S
+        else:
+            render_period_ms, ingest_period_s = None, vars.INGEST_POLL_AWAY_PERIOD_S
+        if not self.visible:
+            render_period_ms = None # Even while recording, there's nothing to see
+        if (mode, render_period_ms, ingest_period_s) == (self.mode, self.render_period_ms, self.ingest_period_s):
+            return
+        if not accounted:
+            self.account()
+        self.mode, self.render_period_ms, self.ingest_period_s = mode, render_period_ms, ingest_period_s
+        logger.debug("Power mode", extra={"mode": mode, "state": self.state, "render_period_ms": render_period_ms, \
+                                          "ingest_period_s": ingest_period_s})
+        self.powerModeChanged.emit(mode)
+
+    def account(self):
+        '''Adds the CPU and wall time since the last call to the current state and mode'''
+        cpu, wall = time.process_time(), time.monotonic()
+        if self.mode is not None:
+            usage = self.usage.setdefault((self.state, self.mode), [0.0, 0.0])
+            usage[0] += wall - self.wall_mark
+            usage[1] += cpu - self.cpu_mark
+            labels = {"state": str(self.state), "power_mode": self.mode}
+            REGISTRY.counter("state_seconds_total", "Wall time spent in each session state and power mode", labels).inc(wall - self.wall_mark)
+            REGISTRY.counter("state_cpu_seconds_total", "Process CPU time used in each session state and power mode", labels).inc(cpu - self.cpu_mark)
+        self.cpu_mark, self.wall_mark = cpu, wall
+
+    def get_cpu_report(self):
+        '''(state, mode, wall s, cpu s, CPU % of one core), most time first'''
+        self.account()
+        rows = [(state, mode, wall_s, cpu_s, 100*cpu_s/wall_s if wall_s > 0 else 0.0) for (state, mode), (wall_s, cpu_s) in self.usage.items()]
+        return sorted(rows, key=lambda row: row[2], reverse=True)
+
+    def log_cpu_report(self):
+        for state, mode, wall_s, cpu_s, cpu_percent in self.get_cpu_report():
+            logger.info("CPU usage", extra={"state": state, "power_mode": mode, "wall_s": round(wall_s, 1), \
+                                            "cpu_s": round(cpu_s, 2), "cpu_percent": round(cpu_percent, 1)})
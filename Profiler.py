@@ -0,0 +1,184 @@
+import functools
+import logging
+import os
+import sys
+import threading
+import time
+from collections import defaultdict, deque
+import numpy as np
+
+'''
+Profiler class
+Opt-in profiling of the hot paths, which can be switched on and off while a session is running.
+- Timing spans around the key stages give a per-stage latency summary and span-weighted collapsed stacks
+- A sampling thread records the Python stack of the GUI thread as collapsed stacks
+Both collapsed stack files can be rendered with flamegraph.pl or speedscope
+'''
+logger = logging.getLogger(__name__)
+
+class NullSpan:
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+NULL_SPAN = NullSpan()
+
+class Span:
+    __slots__ = ("profiler", "name", "path", "start_ns", "child_ns")
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        stack = self.profiler.span_stack()
+        self.path = f"{stack[-1].path};{self.name}" if stack else self.name
+        self.child_ns = 0
+        stack.append(self)
+        self.start_ns = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc):
+        duration_ns = time.perf_counter_ns() - self.start_ns
+        stack = self.profiler.span_stack()
+        stack.pop()
+        if stack:
+            stack[-1].child_ns += duration_ns
+        self.profiler.record(self.name, self.path, duration_ns, duration_ns - self.child_ns)
+        return False
+
+class Profiler:
+    LATENCY_HISTORY = 10000 # Latest span durations kept per stage for the percentiles
+
+    def __init__(self):
+        self.enabled = False
+        self.output_dir = "profiles"
+        self.write_interval_s = 10.0
+        self.sample_interval_s = 0.005
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.target_thread_id = threading.main_thread().ident
+        self.stop_event = threading.Event()
+        self.threads = []
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.span_self_us = defaultdict(float) # span path -> self time in µs
+            self.latencies_us = defaultdict(lambda: deque(maxlen=self.LATENCY_HISTORY))
+            self.span_counts = defaultdict(int)
+            self.sampled_stacks = defaultdict(int) # python stack -> number of samples
+
+    def configure(self, output_dir=None, write_interval_s=None, sample_interval_s=None):
+        if output_dir is not None:
+            self.output_dir = output_dir
+        if write_interval_s is not None:
+            self.write_interval_s = write_interval_s
+        if sample_interval_s is not None:
+            self.sample_interval_s = sample_interval_s
+
+    def span(self, name):
+        return Span(self, name) if self.enabled else NULL_SPAN
+
+    def profile(self, name):
+        '''Decorator wrapping a function in a span, checked on every call so it can be toggled at runtime'''
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return func(*args, **kwargs)
+                with Span(self, name):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def span_stack(self):
+        stack = getattr(self.local, "stack", None)
+        if stack is None:
+            stack = self.local.stack = []
+        return stack
+
+    def record(self, name, path, duration_ns, self_ns):
+        with self.lock:
+            self.span_self_us[path] += self_ns/1000.0
+            self.latencies_us[name].append(duration_ns/1000.0)
+            self.span_counts[name] += 1
+
+    def enable(self):
+        if self.enabled:
+            return
+        self.target_thread_id = threading.get_ident()
+        self.stop_event.clear()
+        self.threads = [threading.Thread(target=self.sample_loop, name="profiler-sampler", daemon=True), \
+                        threading.Thread(target=self.write_loop, name="profiler-writer", daemon=True)]
+        for thread in self.threads:
+            thread.start()
+        self.enabled = True
+        logger.info("Profiling enabled", extra={"output_dir": self.output_dir})
+
+    def disable(self):
+        if not self.enabled:
+            return
+        self.enabled = False
+        self.stop_event.set()
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+        self.write()
+        logger.info("Profiling disabled", extra={"output_dir": self.output_dir})
+
+    def toggle(self):
+        if self.enabled:
+            self.disable()
+        else:
+            self.enable()
+
+    def sample_loop(self):
+        while not self.stop_event.wait(self.sample_interval_s):
+            frame = sys._current_frames().get(self.target_thread_id)
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                frame = frame.f_back
+            with self.lock:
+                self.sampled_stacks[";".join(reversed(stack))] += 1
+
+    def write_loop(self):
+        while not self.stop_event.wait(self.write_interval_s):
+            self.write()
+
+    def write(self):
+        '''Writes the collapsed stacks and the latency summary, overwriting the previous files'''
+        with self.lock:
+            span_self_us = dict(self.span_self_us)
+            sampled_stacks = dict(self.sampled_stacks)
+            latencies_us = {name: np.array(values) for name, values in self.latencies_us.items()}
+            span_counts = dict(self.span_counts)
+
+        os.makedirs(self.output_dir, exist_ok=True)
+        with open(os.path.join(self.output_dir, "spans.folded"), "w") as file:
+            for path, self_us in sorted(span_self_us.items()):
+                file.write(f"{path} {int(round(self_us))}\n")
+        with open(os.path.join(self.output_dir, "samples.folded"), "w") as file:
+            for stack, count in sorted(sampled_stacks.items()):
+                file.write(f"{stack} {count}\n")
+        with open(os.path.join(self.output_dir, "latency_summary.txt"), "w") as file:
+            file.write(self.format_summary(latencies_us, span_counts))
+
+    @staticmethod
+    def format_summary(latencies_us, span_counts):
+        lines = [f"{'Stage':<28}{'Calls':>10}{'Mean µs':>12}{'p50 µs':>12}{'p95 µs':>12}{'p99 µs':>12}{'Max µs':>12}"]
+        for name, values in sorted(latencies_us.items()):
+            if len(values) == 0:
+                continue
+            p50, p95, p99 = np.percentile(values, [50, 95, 99])
+            lines.append(f"{name:<28}{span_counts[name]:>10}{values.mean():>12.1f}{p50:>12.1f}{p95:>12.1f}{p99:>12.1f}{values.max():>12.1f}")
+        return "\n".join(lines) + "\n"
+
+PROFILER = Profiler()
@@ -0,0 +1,123 @@
+import json
+import logging
+import os
+import re
+from datetime import datetime
+
+'''
+UserProfiles class
+Users sharing a station, each with their own folder and an index of their sessions:
+    <data folder>/users/index.json                            user id -> name, created, sessions, last used
+    <data folder>/users/<user id>/sessions_index.json         session id -> file, date, trials and scores
+    <data folder>/users/<user id>/sessions/session_data_<session id>.json
+The indexes are loaded into dicts (a user's session index only when first needed), so finding a user or a
+session doesn't depend on how many there are, and listing a user's sessions never opens the session files
+'''
+logger = logging.getLogger(__name__)
+
+def write_json(filepath, data):
+    tmp_filepath = filepath + ".tmp"
+    with open(tmp_filepath, "w") as file:
+        json.dump(data, file, indent=1)
+    os.replace(tmp_filepath, filepath) # Never leaves a half written index behind
+
+def read_json(filepath, default):
+    if not os.path.exists(filepath):
+        return default
+    try:
+        with open(filepath) as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        logger.warning("Could not read index, starting a new one", extra={"path": filepath})
+        return default
+
+class SessionIndex:
+
+    def __init__(self, user_folder):
+        self.filepath = os.path.join(user_folder, "sessions_index.json")
+        self.sessions = read_json(self.filepath, {})
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def __contains__(self, session_id):
+        return session_id in self.sessions
+
+    def get(self, session_id):
+        return self.sessions.get(session_id)
+
+    def add(self, session_id, entry):
+        self.sessions[session_id] = entry
+        write_json(self.filepath, self.sessions)
+
+    def load_session(self, session_id):
+        '''The full saved session, including its trials'''
+        with open(self.sessions[session_id]["file"]) as file:
+            return json.load(file)
+
+class UserProfiles:
+
+    def __init__(self, data_folder):
+        self.data_folder = data_folder
+        self.users_folder = os.path.join(data_folder, "users")
+        os.makedirs(self.users_folder, exist_ok=True)
+        self.index_filepath = os.path.join(self.users_folder, "index.json")
+        self.users = read_json(self.index_filepath, {})
+        self.ids_by_name = {user["name"].lower(): user_id for user_id, user in self.users.items()}
+        self.session_indexes = {} # user id -> SessionIndex, loaded on first use
+
+    def save(self):
+        write_json(self.index_filepath, self.users)
+
+    def get_user_id(self, name):
+        return self.ids_by_name.get(name.strip().lower())
+
+    def add_user(self, name):
+        '''Returns the id of the user with this name, creating them if they're new'''
+        name = name.strip()
+        user_id = self.get_user_id(name)
+        if user_id is not None:
+            return user_id
+        base_id = re.sub(r"[^a-z0-9_-]+", "-", name.lower()).strip("-") or "user"
+        user_id, suffix = base_id, 1
+        while user_id in self.users:
+            suffix += 1
+            user_id = f"{base_id}-{suffix}"
+        self.users[user_id] = {"name": name, "created": datetime.now().strftime("%Y-%m-%d %H:%M:%S"), \
+                               "n_sessions": 0, "last_used": None}
+        self.ids_by_name[name.lower()] = user_id
+        os.makedirs(self.get_sessions_folder(user_id), exist_ok=True)
+        self.save()
+        logger.info("User added", extra={"user_id": user_id})
+        return user_id
+
+    def get_user_folder(self, user_id):
+        return os.path.join(self.users_folder, user_id)
+
+    def get_sessions_folder(self, user_id):
+        return os.path.join(self.get_user_folder(user_id), "sessions")
+
+    def get_session_index(self, user_id):
+        if user_id not in self.session_indexes:
+            self.session_indexes[user_id] = SessionIndex(self.get_user_folder(user_id))
+        return self.session_indexes[user_id]
+
+    def list_users(self):
+        '''(user id, name) pairs, most recently used first'''
+        ordered = sorted(self.users.items(), key=lambda item: item[1]["last_used"] or item[1]["created"], reverse=True)
+        return [(user_id, user["name"]) for user_id, user in ordered]
+
+    def touch(self, user_id):
+        self.users[user_id]["last_used"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        self.save()
+
+    def record_session(self, user_id, session_id, session_filepath, session_summary):
+        self.get_session_index(user_id).add(session_id, {"file": session_filepath, \
+                                                         "date": session_summary.get("date"), \
+                                                         "n_trials": len(session_summary.get("trial_lengths", [])), \
+                                                         "average_accuracy": session_summary.get("average_accuracy"), \
+                                                         "awareness_score": session_summary.get("awareness_score")})
+        user = self.users[user_id]
+        user["n_sessions"] = len(self.get_session_index(user_id))
+        user["last_used"] = session_summary.get("date")
+        self.save()
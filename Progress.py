@@ -0,0 +1,158 @@
+import glob
+import json
+import logging
+import os
+import numpy as np
+
+'''
+ProgressTracker class
+Accuracy and awareness across a user's sessions, kept as running aggregates in one small JSON file per user.
+Saving a session updates the aggregates in O(1) (plus a bounded history of recent sessions for plotting),
+so showing progress at startup reads a single file rather than every session_data_*.json.
+
+Per metric: count, mean and variance (Welford), an exponentially weighted mean, and the least squares trend
+per session from running sums of (session number, score)
+'''
+logger = logging.getLogger(__name__)
+
+METRICS = ("accuracy", "awareness")
+VERSION = 1
+
+class RunningStats:
+
+    def __init__(self, state=None):
+        state = state or {}
+        self.n = state.get("n", 0)
+        self.mean = state.get("mean", 0.0)
+        self.m2 = state.get("m2", 0.0)
+        self.ewma = state.get("ewma", None)
+        # Running sums of (session number x, score y) for the trend line
+        self.sum_x = state.get("sum_x", 0.0)
+        self.sum_xx = state.get("sum_xx", 0.0)
+        self.sum_y = state.get("sum_y", 0.0)
+        self.sum_xy = state.get("sum_xy", 0.0)
+
+    def add(self, x, y, ewma_alpha):
+        if y is None or np.isnan(y):
+            return
+        self.n += 1
+        delta = y - self.mean
+        self.mean += delta/self.n
+        self.m2 += delta*(y - self.mean)
+        self.ewma = y if self.ewma is None else ewma_alpha*y + (1 - ewma_alpha)*self.ewma
+        self.sum_x += x
+        self.sum_xx += x*x
+        self.sum_y += y
+        self.sum_xy += x*y
+
+    def get_trend(self):
+        '''Least squares slope of the score per session'''
+        denominator = self.n*self.sum_xx - self.sum_x*self.sum_x
+        if self.n < 2 or denominator == 0:
+            return np.nan
+        return (self.n*self.sum_xy - self.sum_x*self.sum_y)/denominator
+
+    def get_summary(self):
+        return {"n": self.n, \
+                "mean": self.mean if self.n else np.nan, \
+                "sd": np.sqrt(self.m2/(self.n - 1)) if self.n > 1 else np.nan, \
+                "ewma": self.ewma if self.ewma is not None else np.nan, \
+                "trend": self.get_trend()}
+
+    def to_dict(self):
+        return {"n": self.n, "mean": self.mean, "m2": self.m2, "ewma": self.ewma, \
+                "sum_x": self.sum_x, "sum_xx": self.sum_xx, "sum_y": self.sum_y, "sum_xy": self.sum_xy}
+
+class ProgressTracker:
+
+    def __init__(self, folder, user="default", history_length=200, n_best=5, ewma_alpha=0.3):
+        self.folder = folder
+        self.user = user
+        self.filepath = os.path.join(folder, f"progress_{user}.json")
+        self.history_length = history_length
+        self.n_best = n_best
+        self.ewma_alpha = ewma_alpha
+        self.load()
+
+    def load(self):
+        state = {}
+        if os.path.exists(self.filepath):
+            try:
+                with open(self.filepath) as file:
+                    state = json.load(file)
+            except (OSError, ValueError):
+                logger.warning("Could not read progress, starting again", extra={"path": self.filepath})
+                state = {}
+        self.n_sessions = state.get("n_sessions", 0)
+        self.session_ids = set(state.get("session_ids", []))
+        self.stats = {metric: RunningStats(state.get("stats", {}).get(metric)) for metric in METRICS}
+        self.best = {metric: state.get("best", {}).get(metric, []) for metric in METRICS}
+        self.history = state.get("history", [])
+
+    def save(self):
+        os.makedirs(self.folder, exist_ok=True)
+        state = {"version": VERSION, \
+                 "user": self.user, \
+                 "n_sessions": self.n_sessions, \
+                 "session_ids": sorted(self.session_ids), \
+                 "stats": {metric: self.stats[metric].to_dict() for metric in METRICS}, \
+                 "best": self.best, \
+                 "history": self.history}
+        tmp_filepath = self.filepath + ".tmp"
+        with open(tmp_filepath, "w") as file:
+            json.dump(state, file)
+        os.replace(tmp_filepath, self.filepath) # Never leaves a half written file behind
+
+    def add_session(self, session_id, session_summary, save=True):
+        '''Folds one saved session into the aggregates, returns False if it was already counted'''
+        if session_id in self.session_ids:
+            return False
+        self.session_ids.add(session_id)
+        self.n_sessions += 1
+        entry = {"session_id": session_id, \
+                 "date": session_summary.get("date"), \
+                 "session_no": self.n_sessions, \
+                 "accuracy": to_float(session_summary.get("average_accuracy")), \
+                 "awareness": to_float(session_summary.get("awareness_score")), \
+                 "accuracy_percentile": to_float(session_summary.get("accuracy_percentile")), \
+                 "awareness_percentile": to_float(session_summary.get("awareness_percentile"))}
+        for metric in METRICS:
+            value = entry[metric]
+            self.stats[metric].add(self.n_sessions, np.nan if value is None else value, self.ewma_alpha)
+            if value is not None:
+                self.best[metric] = sorted(self.best[metric] + [entry], key=lambda e: e[metric], reverse=True)[:self.n_best]
+        self.history.append(entry)
+        del self.history[:-self.history_length]
+        if save:
+            self.save()
+        return True
+
+    def rebuild(self, data_folder):
+        '''Adds any session_data_*.json not yet counted, e.g. sessions saved before progress was tracked'''
+        added = 0
+        for filepath in sorted(glob.glob(os.path.join(data_folder, "session_data_*.json"))):
+            session_id = os.path.basename(filepath)[len("session_data_"):-len(".json")]
+            if session_id in self.session_ids:
+                continue
+            try:
+                with open(filepath) as file:
+                    added += self.add_session(session_id, json.load(file), save=False)
+            except (OSError, ValueError):
+                logger.warning("Skipping unreadable session file", extra={"path": filepath})
+        if added:
+            self.save()
+            logger.info("Progress updated from session files", extra={"user": self.user, "sessions_added": added})
+        return added
+
+    def get_summary(self):
+        return {"n_sessions": self.n_sessions, \
+                **{metric: self.stats[metric].get_summary() for metric in METRICS}, \
+                "best": self.best, \
+                "history": self.history}
+
+def to_float(value):
+    '''JSON has no NaN, so missing scores are stored as None'''
+    if value is None:
+        return None
+    value = float(value)
+    return None if np.isnan(value) else value
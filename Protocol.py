@@ -0,0 +1,73 @@
+import json
+import os
+import numpy as np
+import Scoring
+
+'''
+Protocol
+Study protocols are JSON files (see protocols/) describing the trials of a session:
+    {
+        "name": "garfinkel-2015",
+        "seed": null,                   int to give every session the same order, null for a new order each session
+        "training_trials": [{"length_s": 15, "feedback": true}],
+        "blocks": [{"trial_lengths_s": [25, 30, 35, 40, 45, 50], "shuffle": true, "repeat": 1, "feedback": false}],
+        "scoring": {"method": "garfinkel"}
+    }
+A protocol is compiled into a schedule, the list of trials the Controller runs through. Compiling is
+deterministic given the seed, and the seed used is kept with each session so any schedule can be reproduced
+'''
+PROTOCOL_FOLDER = "protocols"
+
+def load_protocol(path):
+    '''Reads and checks a protocol file; a bare name is looked up in the protocols folder'''
+    if not os.path.exists(path) and not path.endswith(".json"):
+        path = os.path.join(PROTOCOL_FOLDER, f"{path}.json")
+    with open(path) as file:
+        protocol = json.load(file)
+    validate_protocol(protocol, path)
+    return protocol
+
+def validate_protocol(protocol, path="protocol"):
+    def check(condition, message):
+        if not condition:
+            raise ValueError(f"{path}: {message}")
+
+    check(isinstance(protocol.get("name"), str), "needs a name")
+    check(protocol.get("seed") is None or isinstance(protocol["seed"], int), "seed must be an integer or null")
+    for trial in protocol.get("training_trials", []):
+        check(isinstance(trial.get("length_s"), int) and trial["length_s"] > 0, "training trial lengths must be positive integers")
+    blocks = protocol.get("blocks", [])
+    check(len(blocks) > 0, "needs at least one block of trials")
+    for block in blocks:
+        lengths = block.get("trial_lengths_s", [])
+        check(len(lengths) > 0 and all(isinstance(length, int) and length > 0 for length in lengths), \
+              "block trial lengths must be a list of positive integers")
+        check(isinstance(block.get("repeat", 1), int) and block.get("repeat", 1) > 0, "block repeat must be a positive integer")
+    method = protocol.get("scoring", {}).get("method", "garfinkel")
+    check(method in Scoring.SCORING_METHODS, f"unknown scoring method '{method}', use one of {', '.join(Scoring.SCORING_METHODS)}")
+
+def compile_schedule(protocol, seed=None):
+    '''
+    Returns the schedule: a dict with the protocol name, the seed used, the scoring method and the trials in the
+    order they run. Each trial is {"length_s", "training", "feedback"}. The seed argument overrides the protocol's
+    '''
+    seed = seed if seed is not None else protocol.get("seed")
+    if seed is None:
+        seed = int(np.random.SeedSequence().entropy % 2**32) # Recorded, so this session can still be reproduced
+    rng = np.random.default_rng(seed)
+
+    trials = [{"length_s": trial["length_s"], "training": True, "feedback": trial.get("feedback", True)} \
+              for trial in protocol.get("training_trials", [])]
+    for block in protocol["blocks"]:
+        lengths = list(block["trial_lengths_s"])*block.get("repeat", 1)
+        if block.get("shuffle", True):
+            lengths = [lengths[i] for i in rng.permutation(len(lengths))]
+        trials += [{"length_s": length, "training": False, "feedback": block.get("feedback", False)} for length in lengths]
+
+    return {"protocol": protocol["name"], \
+            "seed": seed, \
+            "scoring_method": protocol.get("scoring", {}).get("method", "garfinkel"), \
+            "trials": trials}
+
+def get_scored_lengths(schedule):
+    return [trial["length_s"] for trial in schedule["trials"] if not trial["training"]]
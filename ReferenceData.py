@@ -0,0 +1,107 @@
+import numpy as np
+import pandas as pd
+import Scoring
+import vars
+
+'''
+ReferenceData class
+Accuracy, awareness and confidence of the participants in the reference study (Garfinkel et al. 2014), which
+sessions are placed against as percentiles. pyplot is only imported for the debug graphs, so reports can load
+the reference data without a GUI backend
+'''
+class ReferenceData:
+    SCORING_METHOD = "garfinkel" # How accuracy was scored in the reference study
+
+    def __init__(self):
+        self.df_accuracy_awareness = None
+        self.df_accuracy_confidence = None
+        self.loadReferenceData()
+        if vars.SHOW_DEBUG_GRAPHS:
+            self.plotReferenceData()
+
+    def calculateAccuracyPercentile(self, accuracy):
+        return Scoring.percentile_of_score(self.reference_accuracy, accuracy)[()]
+    
+    def calculateAwarenessPercentile(self, awareness):
+        return Scoring.percentile_of_score(self.reference_awareness, awareness)[()]
+
+    def scoreSessions(self, count_measured, count_entered, confidence):
+        '''Scores and percentiles of many sessions at once, see Scoring.score_sessions'''
+        return Scoring.score_sessions(count_measured, count_entered, confidence, self.reference_accuracy, self.reference_awareness)
+
+    def loadReferenceData(self):
+        df_acc_aw_highacc =  pd.read_csv("reference/accuracy-awareness_high-acc.csv")
+        df_acc_aw_lowacc =  pd.read_csv("reference/accuracy-awareness_low-acc.csv")
+        df_acc_aw_highacc["group"] = "high-accuracy"
+        df_acc_aw_lowacc["group"] = "low-accuracy"
+        self.df_accuracy_awareness = pd.concat([df_acc_aw_highacc, df_acc_aw_lowacc])
+        self.reference_accuracy = np.sort(self.df_accuracy_awareness["accuracy"].to_numpy(dtype=float))
+        self.reference_awareness = np.sort(self.df_accuracy_awareness["awareness"].to_numpy(dtype=float))
+
+        df_acc_con_highacc =  pd.read_csv("reference/accuracy-confidence_high-acc.csv")
+        df_acc_con_lowacc =  pd.read_csv("reference/accuracy-confidence_low-acc.csv")
+        df_acc_con_highacc["group"] = "high-accuracy"
+        df_acc_con_lowacc["group"] = "low-accuracy"
+        self.df_accuracy_confidence = pd.concat([df_acc_con_highacc, df_acc_con_lowacc])
+
+    def plotReferenceData(self):
+        import matplotlib.pyplot as plt
+        plt.figure(figsize=(10, 5))
+        plt.subplot(2, 2, 1)
+        # Histogram of accuracy coloured by group
+        plt.hist([self.df_accuracy_awareness[self.df_accuracy_awareness["group"]=="high-accuracy"]["accuracy"], \
+                  self.df_accuracy_awareness[self.df_accuracy_awareness["group"]=="low-accuracy"]["accuracy"]], \
+                  bins=10, stacked=True, label=["high-accuracy", "low-accuracy"])
+        plt.xlabel('Accuracy')
+        plt.ylabel('Count')
+        plt.title("Accuracy Awareness Data")
+
+        plt.subplot(2, 2, 2)
+        plt.hist([self.df_accuracy_confidence[self.df_accuracy_confidence["group"]=="high-accuracy"]["accuracy"], \
+                  self.df_accuracy_confidence[self.df_accuracy_confidence["group"]=="low-accuracy"]["accuracy"]], \
+                  bins=10, stacked=True, label=["high-accuracy", "low-accuracy"])
+        plt.xlabel('Accuracy')
+        plt.ylabel('Count')
+        plt.title("Accuracy Confidence Data")
+        
+        plt.subplot(2, 2, 3)
+        plt.hist([self.df_accuracy_awareness[self.df_accuracy_awareness["group"]=="high-accuracy"]["awareness"], \
+                  self.df_accuracy_awareness[self.df_accuracy_awareness["group"]=="low-accuracy"]["awareness"]], \
+                  bins=10, stacked=True, label=["high-accuracy", "low-accuracy"])
+        plt.xlabel('Awareness')
+        plt.ylabel('Count')
+
+        plt.subplot(2, 2, 4)
+        plt.hist([self.df_accuracy_confidence[self.df_accuracy_confidence["group"]=="high-accuracy"]["confidence"], \
+                  self.df_accuracy_confidence[self.df_accuracy_confidence["group"]=="low-accuracy"]["confidence"]], \
+                  bins=10, stacked=True, label=["high-accuracy", "low-accuracy"])
+        plt.xlabel('Confidence')
+        plt.ylabel('Count')
+        
+        plt.show()
+
+        plt.figure(figsize=(10, 5))
+        # Plot accuracy against awareness coloured by group
+        plt.subplot(1, 2, 1)
+        plt.scatter(self.df_accuracy_awareness[self.df_accuracy_awareness["group"]=="high-accuracy"]["awareness"], \
+                    self.df_accuracy_awareness[self.df_accuracy_awareness["group"]=="high-accuracy"]["accuracy"], \
+                    c="r", label="high-accuracy")
+        plt.scatter(self.df_accuracy_awareness[self.df_accuracy_awareness["group"]=="low-accuracy"]["awareness"], \
+                    self.df_accuracy_awareness[self.df_accuracy_awareness["group"]=="low-accuracy"]["accuracy"], \
+                    c="b", label="low-accuracy")
+        plt.xlabel('Awareness')
+        plt.ylabel('Accuracy')
+        plt.legend()
+        plt.title("Accuracy Awareness Data")
+        plt.subplot(1, 2, 2)
+        plt.scatter(self.df_accuracy_confidence[self.df_accuracy_confidence["group"]=="high-accuracy"]["confidence"], \
+                    self.df_accuracy_confidence[self.df_accuracy_confidence["group"]=="high-accuracy"]["accuracy"], \
+                    c="r", label="high-accuracy")
+        plt.scatter(self.df_accuracy_confidence[self.df_accuracy_confidence["group"]=="low-accuracy"]["confidence"], \
+                    self.df_accuracy_confidence[self.df_accuracy_confidence["group"]=="low-accuracy"]["accuracy"], \
+                    c="b", label="low-accuracy")
+        plt.xlabel('Confidence')
+        plt.ylabel('Accuracy')
+        plt.legend()
+        plt.title("Accuracy Confidence Data")
+        plt.show()
@@ -0,0 +1,329 @@
+import argparse
+import glob
+import html
+import json
+import logging
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from BeatDetectors import create_detector
+from EcgFilter import EcgFilter
+from ReferenceData import ReferenceData
+import vars
+
+'''
+Session reports
+Renders a report of every saved session to PNG and HTML, without a display:
+    <output>/<session id>/summary.png    measured vs. estimated counts, confidence vs. accuracy, and where the
+                                         session's scores fall among the reference study's participants
+    <output>/<session id>/trial_<n>.png  the trial's ECG and the beats detected in it, when the ECG was exported
+    <output>/<session id>/index.html
+    <output>/index.html                  every session, with its scores and a link to its report
+Sessions are the session_data_*.json files anywhere under the data folder, the trial ECG comes from the
+columnar export (EXPORT_RAW_ECG). Beats are detected again with the session's detector, on the ECG filtered as
+it was for the live detection, and that's the ECG plotted.
+
+Sessions are spread over a pool of worker processes. Each worker builds its figures once, with the reference
+histograms drawn and the layout done, and each session only replaces the data in them. The figures are drawn
+with the Agg canvas directly rather than through pyplot, so it doesn't matter which backend the app chose.
+A session's report is only rendered again once its session file changes, unless force is set.
+
+Usage:
+    python Reports.py [data] [--output reports] [--workers 8] [--dpi 100] [--force]
+'''
+logger = logging.getLogger(__name__)
+
+SESSION_PATTERN = "session_data_*.json"
+COUNT_AXIS_MIN = 70 # Beat count axes go at least this far, as in the live summary graphs
+PNG_OPTIONS = {"compress_level": 1} # Fastest zlib level, the plots compress nearly as well as at the default 6
+
+templates = None # The worker's ReportTemplates, built once by init_worker()
+detectors = {}
+
+def find_sessions(data_folder):
+    '''
+    Session files under data_folder, by session id. Session ids carry the user id, but sessions saved before they
+    did can share an id with another user's. A session id seen twice keeps the newest file, with a warning
+    '''
+    sessions = {}
+    for filepath in sorted(glob.glob(os.path.join(data_folder, "**", SESSION_PATTERN), recursive=True), key=os.path.getmtime):
+        session_id = os.path.basename(filepath)[len("session_data_"):-len(".json")]
+        if session_id in sessions:
+            logger.warning("Session id seen twice, the older file isn't reported", extra={"session_id": session_id, \
+                           "path": filepath, "older_path": sessions[session_id]})
+        sessions[session_id] = filepath
+    return dict(sorted(sessions.items()))
+
+def find_ecg_parts(columnar_folder):
+    '''The ECG part each session's trial windows are in, merged parts included, see SessionExport.compact'''
+    parts = {}
+    for filepath in sorted(glob.glob(os.path.join(columnar_folder, "ecg", "part-*.npz"))):
+        part_id = os.path.basename(filepath)[len("part-"):-len(".npz")]
+        if not part_id.startswith("merged-"):
+            parts[part_id] = filepath
+            continue
+        with np.load(filepath, allow_pickle=False) as data:
+            for session_id in np.unique(data["session_id"]):
+                parts.setdefault(str(session_id), filepath)
+    return parts
+
+def load_trial_ecg(filepath, session_id):
+    '''{trial id: (times, values)} of one session'''
+    with np.load(filepath, allow_pickle=False) as data:
+        rows = data["session_id"] == session_id
+        trial_ids, times, values = data["trial_id"][rows], data["time"][rows], data["ecg"][rows]
+    return {int(trial_id): (times[trial_ids == trial_id], values[trial_ids == trial_id].astype(float)) for trial_id in np.unique(trial_ids)}
+
+def get_detector(name):
+    '''Detectors are kept between sessions. The strap IBIs aren't saved, so "ibi" sessions use the default detector'''
+    if name is None or name not in detectors:
+        try:
+            detector = create_detector(name or vars.BEAT_DETECTOR)
+        except ValueError:
+            detector = None
+        if detector is None or detector.requires_ibi:
+            detector = create_detector(vars.BEAT_DETECTOR if vars.BEAT_DETECTOR != "ibi" else "neurokit")
+        detectors[name] = detector
+    return detectors[name]
+
+def detect_beats(times, values, detector_name):
+    '''The ECG as the detector sees it, and the indices of the beats in it'''
+    if vars.ECG_FILTER_DETECTION:
+        values = EcgFilter(vars.ECG_SAMPLING_RATE, vars.ECG_FILTER_HIGHPASS_HZ, vars.ECG_FILTER_NOTCH_HZ, \
+                           vars.ECG_FILTER_NOTCH_Q, vars.ECG_FILTER_LOWPASS_HZ).process(values)
+    if len(values) < vars.ECG_SAMPLING_RATE:
+        return values, np.array([], dtype=int)
+    return values, get_detector(detector_name).find_peaks(values, times, vars.ECG_SAMPLING_RATE)
+
+def is_number(value):
+    return value is not None and np.isfinite(value)
+
+def format_number(value, digits=2):
+    return f"{value:.{digits}f}" if is_number(value) else "-"
+
+class ReportTemplates:
+    '''
+    The report figures, built once per worker. render_summary() and render_trial() swap in a session's data,
+    everything else (axes, labels, the reference histograms, the layout) is reused
+    '''
+
+    def __init__(self, dpi=100):
+        self.dpi = dpi
+        self.reference_data = ReferenceData()
+        self.build_summary()
+        self.build_trial()
+
+    def build_summary(self):
+        self.summary = Figure(figsize=(10, 8))
+        FigureCanvasAgg(self.summary)
+        axes = self.summary.subplots(2, 2)
+        for ax in axes.flat:
+            ax.grid(True)
+
+        self.counts_ax = axes[0, 0]
+        self.counts_ax.plot([0, 1000], [0, 1000], color="grey", linewidth=1, linestyle="--")
+        self.counts_points, = self.counts_ax.plot([], [], "o", markersize=8, markerfacecolor="blue", markeredgewidth=2, markeredgecolor="black")
+        self.counts_ax.set_xlabel("Measured beat count")
+        self.counts_ax.set_ylabel("Estimated beat count")
+        self.counts_title = self.counts_ax.set_title(" ", fontsize=14)
+
+        self.confidence_ax = axes[0, 1]
+        self.confidence_points, = self.confidence_ax.plot([], [], "o", markersize=8, markerfacecolor="green", markeredgewidth=2, markeredgecolor="black")
+        self.confidence_ax.set_xlabel("Confidence")
+        self.confidence_ax.set_ylabel("Accuracy")
+        self.confidence_ax.set_xlim([0, 10])
+        self.confidence_ax.set_ylim([0, 1])
+        self.confidence_title = self.confidence_ax.set_title(" ", fontsize=14)
+
+        self.accuracy_marker, self.accuracy_title = self.build_reference(axes[1, 0], self.reference_data.reference_accuracy, "Accuracy")
+        self.awareness_marker, self.awareness_title = self.build_reference(axes[1, 1], self.reference_data.reference_awareness, "Awareness")
+        self.summary.tight_layout()
+
+    def build_reference(self, ax, reference, label):
+        ax.hist(reference, bins=20, color="lightgrey", edgecolor="grey")
+        marker = ax.axvline(reference[0], color="red", linewidth=2)
+        marker.reference_xlim = ax.get_xlim()
+        ax.set_xlabel(label)
+        ax.set_ylabel("Reference participants")
+        return marker, ax.set_title(" ", fontsize=14)
+
+    def build_trial(self):
+        self.trial = Figure(figsize=(10, 3))
+        FigureCanvasAgg(self.trial)
+        self.trial_ax = self.trial.subplots()
+        self.trial_ax.grid(True)
+        self.trial_ecg, = self.trial_ax.plot([], [], color="black", linewidth=0.8)
+        self.trial_beats, = self.trial_ax.plot([], [], "x", color="red", markersize=8, markeredgewidth=2)
+        self.trial_ax.set_xlabel("Time in trial (s)")
+        self.trial_ax.set_ylabel("ECG (µV)")
+        self.trial_title = self.trial_ax.set_title(" ")
+        self.trial.tight_layout()
+
+    def render_summary(self, session, filepath):
+        trials = [trial for trial in session["trials"] if not trial.get("training", False)]
+        count_measured = [trial["count_measured"] for trial in trials]
+        count_entered = [trial["count_entered"] for trial in trials]
+        count_limit = max([COUNT_AXIS_MIN] + [1.1*count for count in count_measured + count_entered])
+        self.counts_points.set_data(count_measured, count_entered)
+        self.counts_ax.set_xlim([0, count_limit])
+        self.counts_ax.set_ylim([0, count_limit])
+        self.counts_title.set_text(f"Average accuracy: {format_number(session.get('average_accuracy'))}")
+
+        self.confidence_points.set_data([trial["confidence"] for trial in trials], [trial["accuracy"] for trial in trials])
+        self.confidence_title.set_text(f"Awareness: {format_number(session.get('awareness_score'))}")
+
+        self.place_reference(self.accuracy_marker, self.accuracy_title, session.get("average_accuracy"), session.get("accuracy_percentile"))
+        self.place_reference(self.awareness_marker, self.awareness_title, session.get("awareness_score"), session.get("awareness_percentile"))
+        self.summary.savefig(filepath, dpi=self.dpi, pil_kwargs=PNG_OPTIONS)
+
+    def place_reference(self, marker, title, score, percentile):
+        # Percentiles are only given when the session was scored the way the reference study was
+        marker.set_visible(is_number(score) and is_number(percentile))
+        if marker.get_visible():
+            marker.set_xdata([score, score])
+            low, high = marker.reference_xlim
+            marker.axes.set_xlim([min(low, score), max(high, score)]) # A score beyond every participant still shows
+        title.set_text(f"Percentile: {format_number(percentile, 0)}")
+
+    def render_trial(self, trial_id, trial, times, values, beat_ids, filepath):
+        start_time = times[0] if len(times) else trial["start_time"]
+        self.trial_ecg.set_data(times - start_time, values)
+        self.trial_beats.set_data(times[beat_ids] - start_time, values[beat_ids])
+        self.trial_ax.set_xlim([0, max(trial["trial_length"], times[-1] - start_time if len(times) else 0)])
+        if len(values):
+            low, high = values.min(), values.max() # Not percentiles, R peaks are under 1% of the samples
+            padding = 0.05*(high - low) + 1
+            self.trial_ax.set_ylim([low - padding, high + padding])
+        self.trial_title.set_text(f"Trial {trial_id+1}{' (training)' if trial.get('training', False) else ''}, {trial['trial_length']} s: " \
+                                  f"{len(beat_ids)} beats detected, {trial['count_measured']} counted in the session, {trial['count_entered']} entered")
+        self.trial.savefig(filepath, dpi=self.dpi, pil_kwargs=PNG_OPTIONS)
+
+def init_worker(dpi):
+    global templates
+    templates = ReportTemplates(dpi)
+
+def write_session_html(folder, session, trial_images):
+    rows = [("User", session.get("user_id")), ("Date", session.get("date")), ("Protocol", session.get("protocol")), \
+            ("Beat detector", session.get("beat_detector")), ("Scoring method", session.get("scoring_method")), \
+            ("Trials", len(session["trials"])), ("Average accuracy", format_number(session.get("average_accuracy"))), \
+            ("Accuracy percentile", format_number(session.get("accuracy_percentile"), 0)), \
+            ("Awareness", format_number(session.get("awareness_score"))), \
+            ("Awareness p-value", format_number(session.get("awareness_p_value"), 3)), \
+            ("Awareness percentile", format_number(session.get("awareness_percentile"), 0))]
+    table = "\n".join(f"<tr><th>{html.escape(name)}</th><td>{html.escape(str(value))}</td></tr>" for name, value in rows)
+    images = "\n".join(f'<p><img src="{html.escape(image)}"></p>' for image in ["summary.png"] + trial_images)
+    with open(os.path.join(folder, "index.html"), "w") as file:
+        file.write(f"<!DOCTYPE html>\n<html><head><meta charset=\"utf-8\"><title>Session {html.escape(session['session_id'])}</title></head>\n" \
+                   f"<body>\n<h1>Session {html.escape(session['session_id'])}</h1>\n<p><a href=\"../index.html\">All sessions</a></p>\n" \
+                   f"<table>\n{table}\n</table>\n{images}\n</body></html>\n")
+
+def render_session(job):
+    '''
+    Renders one session's report, in a worker. job is (session id, session file, ECG part or None, output folder, force).
+    Returns the session's row for the index, with "error" set if it couldn't be rendered
+    '''
+    session_id, session_filepath, ecg_filepath, output_folder, force = job
+    folder = os.path.join(output_folder, session_id)
+    row_filepath = os.path.join(folder, "report.json")
+    if not force and os.path.exists(row_filepath) and os.path.getmtime(row_filepath) >= os.path.getmtime(session_filepath):
+        with open(row_filepath) as file:
+            return dict(json.load(file), skipped=True)
+
+    started = time.perf_counter()
+    try:
+        with open(session_filepath) as file:
+            session = dict(json.load(file), session_id=session_id)
+        os.makedirs(folder, exist_ok=True)
+        templates.render_summary(session, os.path.join(folder, "summary.png"))
+
+        trial_images = []
+        trial_ecg = load_trial_ecg(ecg_filepath, session_id) if ecg_filepath is not None else {}
+        for trial_id, trial in enumerate(session["trials"]):
+            times, values = trial_ecg.get(trial_id, (np.array([]), np.array([])))
+            if len(values) == 0:
+                continue # Recovered after a crash, or the ECG wasn't exported
+            values, beat_ids = detect_beats(times, values, session.get("beat_detector"))
+            trial_images.append(f"trial_{trial_id+1}.png")
+            templates.render_trial(trial_id, trial, times, values, beat_ids, os.path.join(folder, trial_images[-1]))
+        write_session_html(folder, session, trial_images)
+    except Exception as e:
+        logger.warning("Could not render session report", extra={"path": session_filepath, "error": repr(e)})
+        return {"session_id": session_id, "error": repr(e)}
+
+    row = {"session_id": session_id, "user_id": session.get("user_id"), "date": session.get("date"), "n_trials": len(session["trials"]), \
+           "n_ecg_trials": len(trial_images), "average_accuracy": session.get("average_accuracy"), \
+           "accuracy_percentile": session.get("accuracy_percentile"), "awareness_score": session.get("awareness_score"), \
+           "awareness_percentile": session.get("awareness_percentile"), "render_s": time.perf_counter() - started}
+    with open(row_filepath, "w") as file:
+        json.dump(row, file)
+    return row
+
+def write_index(output_folder, rows):
+    lines = []
+    for row in rows:
+        link = f'<a href="{html.escape(row["session_id"])}/index.html">{html.escape(row["session_id"])}</a>'
+        if "error" in row:
+            lines.append(f"<tr><td>{html.escape(row['session_id'])}</td><td colspan=\"6\">{html.escape(row['error'])}</td></tr>")
+            continue
+        cells = [link, html.escape(str(row.get("user_id"))), html.escape(str(row.get("date"))), str(row["n_trials"]), \
+                 format_number(row.get("average_accuracy")), format_number(row.get("accuracy_percentile"), 0), \
+                 format_number(row.get("awareness_score")), format_number(row.get("awareness_percentile"), 0)]
+        lines.append("<tr>" + "".join(f"<td>{cell}</td>" for cell in cells) + "</tr>")
+    header = "".join(f"<th>{name}</th>" for name in ("Session", "User", "Date", "Trials", "Accuracy", "Percentile", "Awareness", "Percentile"))
+    with open(os.path.join(output_folder, "index.html"), "w") as file:
+        file.write("<!DOCTYPE html>\n<html><head><meta charset=\"utf-8\"><title>Sessions</title></head>\n" \
+                   f"<body>\n<h1>Sessions</h1>\n<table>\n<tr>{header}</tr>\n" + "\n".join(lines) + "\n</table>\n</body></html>\n")
+
+def generate_reports(data_folder, output_folder, n_workers=None, dpi=100, force=False, progress=None):
+    '''Renders the report of every session under data_folder and the index of them all, returns the index rows'''
+    n_workers = n_workers or os.cpu_count() or 1
+    sessions = find_sessions(data_folder)
+    ecg_parts = find_ecg_parts(os.path.join(data_folder, "columnar"))
+    os.makedirs(output_folder, exist_ok=True)
+    jobs = [(session_id, filepath, ecg_parts.get(session_id), output_folder, force) for session_id, filepath in sessions.items()]
+
+    rows = []
+    executor = None
+    if n_workers == 1 or len(jobs) <= 1:
+        init_worker(dpi)
+        results = map(render_session, jobs)
+    else:
+        # Spawned, never forked from a process that may have Qt running. Chunks keep the workers busy without
+        # one worker being left with a long tail
+        executor = ProcessPoolExecutor(min(n_workers, len(jobs)), mp_context=multiprocessing.get_context("spawn"), \
+                                       initializer=init_worker, initargs=(dpi,))
+        results = executor.map(render_session, jobs, chunksize=max(1, len(jobs)//(4*n_workers)))
+    try:
+        for row in results:
+            rows.append(row)
+            if progress is not None:
+                progress(len(rows), len(jobs), row)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    write_index(output_folder, rows)
+    return rows
+
+def print_progress(n_done, n_total, row):
+    status = "failed: " + row["error"] if "error" in row else "up to date" if row.get("skipped") else f"{row['render_s']:.2f} s"
+    print(f"[{n_done}/{n_total}] {row['session_id']} {status}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Render a PNG and HTML report of every saved session")
+    parser.add_argument("data", nargs="?", default=vars.DATA_FOLDER, help="Folder the sessions were saved in")
+    parser.add_argument("--output", default=vars.REPORT_FOLDER, help="Folder to write the reports to")
+    parser.add_argument("--workers", type=int, default=vars.REPORT_WORKERS, help="Worker processes, defaults to one per core")
+    parser.add_argument("--dpi", type=int, default=vars.REPORT_DPI)
+    parser.add_argument("--force", action="store_true", help="Render every report again, even if its session hasn't changed")
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    rows = generate_reports(args.data, args.output, args.workers, args.dpi, args.force, print_progress)
+    n_failed = sum("error" in row for row in rows)
+    n_skipped = sum(bool(row.get("skipped")) for row in rows)
+    print(f"{len(rows)} sessions in {time.perf_counter() - started:.1f} s: {len(rows) - n_failed - n_skipped} rendered, " \
+          f"{n_skipped} up to date, {n_failed} failed. Index: {os.path.join(args.output, 'index.html')}")
@@ -0,0 +1,119 @@
+import multiprocessing
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import Scoring
+
+'''
+ResamplingEngine class
+Bootstrap confidence intervals and permutation p-values for accuracy and awareness.
+Resamples are vectorised in chunks; chunks can be spread over a process pool. Each chunk draws from its own
+child of one SeedSequence, so with a fixed seed the results are identical whatever the number of workers
+'''
+CHUNK_SIZE = 1000
+
+def bootstrap_chunk(accuracy, confidence, n_resamples, seed):
+    rng = np.random.default_rng(seed)
+    resampled_accuracy, resampled_confidence = Scoring.resample_trials(accuracy, confidence, n_resamples, rng)
+    awareness, _ = Scoring.pearson(resampled_confidence, resampled_accuracy)
+    return Scoring.mean_accuracy(resampled_accuracy), awareness
+
+def permutation_chunk(count_measured, count_entered, confidence, method, n_resamples, seed):
+    '''
+    Null distributions for (sessions x resamples):
+    - awareness: confidence ratings shuffled across the session's trials
+    - accuracy: entered counts shuffled across the session's trials, breaking their link to the measured counts
+    '''
+    rng = np.random.default_rng(seed)
+    n_sessions, n_trials = count_measured.shape
+    # Valid trials first in each row, the padding last
+    valid = ~(np.isnan(count_measured) | np.isnan(count_entered) | np.isnan(confidence))
+    order = np.argsort(~valid, axis=-1, kind="stable")
+    count_measured = np.take_along_axis(count_measured, order, axis=-1)
+    count_entered = np.take_along_axis(count_entered, order, axis=-1)
+    confidence = np.take_along_axis(confidence, order, axis=-1)
+    valid = (np.arange(n_trials)[None, :] < valid.sum(axis=-1)[:, None])[:, None, :]
+
+    # Random keys with the padding sorted last give an independent permutation of the valid trials per resample
+    keys = np.where(valid, rng.random((n_sessions, n_resamples, n_trials)), np.inf)
+    permutations = np.argsort(keys, axis=-1)
+    session_ids = np.arange(n_sessions)[:, None, None]
+
+    accuracy = np.where(valid, Scoring.trial_accuracy(count_measured, count_entered, method)[:, None, :], np.nan)
+    permuted_confidence = np.where(valid, confidence[session_ids, permutations], np.nan)
+    awareness, _ = Scoring.pearson(permuted_confidence, np.broadcast_to(accuracy, permuted_confidence.shape))
+
+    permuted_accuracy = np.where(valid, Scoring.trial_accuracy(count_measured[:, None, :], count_entered[session_ids, permutations], method), np.nan)
+    return Scoring.mean_accuracy(permuted_accuracy), awareness
+
+def quantile_interval(resamples, alpha):
+    if resamples.shape[-1] == 0:
+        return np.full(resamples.shape[:-1] + (2,), np.nan)
+    return np.moveaxis(np.nanquantile(resamples, [alpha, 1 - alpha], axis=-1), 0, -1)
+
+class ResamplingEngine:
+
+    def __init__(self, n_bootstrap=2000, n_permutations=5000, ci=0.95, seed=None, n_workers=1, scoring_method="garfinkel"):
+        self.n_bootstrap = n_bootstrap
+        self.n_permutations = n_permutations
+        self.ci = ci
+        self.seed = seed # None draws fresh entropy each run, an int makes the results reproducible
+        self.n_workers = n_workers
+        self.scoring_method = scoring_method
+        self.executor = None
+
+    def get_executor(self):
+        if self.executor is None and self.n_workers > 1:
+            self.executor = ProcessPoolExecutor(self.n_workers, mp_context=multiprocessing.get_context("spawn"))
+        return self.executor
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+    def run_chunks(self, chunk_fn, arrays, n_resamples, seed_sequence):
+        if n_resamples <= 0:
+            # Both chunk functions return (accuracy, awareness) per session, no resamples leaves their statistics NaN
+            return [np.empty(np.shape(arrays[0])[:-1] + (0,)) for _ in range(2)]
+        chunk_sizes = [min(CHUNK_SIZE, n_resamples - start) for start in range(0, n_resamples, CHUNK_SIZE)]
+        seeds = seed_sequence.spawn(len(chunk_sizes))
+        executor = self.get_executor()
+        if executor is None or len(chunk_sizes) == 1:
+            results = [chunk_fn(*arrays, size, seed) for size, seed in zip(chunk_sizes, seeds)]
+        else:
+            futures = [executor.submit(chunk_fn, *arrays, size, seed) for size, seed in zip(chunk_sizes, seeds)]
+            results = [future.result() for future in futures]
+        return [np.concatenate([result[i] for result in results], axis=-1) for i in range(len(results[0]))]
+
+    def run(self, count_measured, count_entered, confidence):
+        '''
+        count_measured, count_entered, confidence: (trials,) for one session or NaN-padded (sessions x trials).
+        Returns bootstrap CIs ([..., 2]) and permutation p-values with one value per session
+        '''
+        single_session = np.ndim(count_measured) == 1
+        count_measured = np.atleast_2d(np.asarray(count_measured, dtype=float))
+        count_entered = np.atleast_2d(np.asarray(count_entered, dtype=float))
+        confidence = np.atleast_2d(np.asarray(confidence, dtype=float))
+        bootstrap_seed, permutation_seed = np.random.SeedSequence(self.seed).spawn(2)
+
+        observed = Scoring.score_sessions(count_measured, count_entered, confidence, method=self.scoring_method)
+        accuracy = observed["trial_accuracy"]
+        boot_accuracy, boot_awareness = self.run_chunks(bootstrap_chunk, (accuracy, confidence), self.n_bootstrap, bootstrap_seed)
+        null_accuracy, null_awareness = self.run_chunks(permutation_chunk, (count_measured, count_entered, confidence, self.scoring_method), self.n_permutations, permutation_seed)
+
+        alpha = (1 - self.ci)/2
+        with np.errstate(invalid="ignore"), warnings.catch_warnings():
+            warnings.simplefilter("ignore", RuntimeWarning) # All-NaN resamples give a NaN interval
+            # One-sided for accuracy (better than chance pairing), two-sided for awareness
+            n_null_accuracy = (~np.isnan(null_accuracy)).sum(axis=-1)
+            accuracy_p = np.where(n_null_accuracy == 0, np.nan, (1 + (null_accuracy >= observed["accuracy_score"][:, None]).sum(axis=-1))/(1 + n_null_accuracy))
+            n_null_awareness = (~np.isnan(null_awareness)).sum(axis=-1)
+            awareness_p = (1 + (np.abs(null_awareness) >= np.abs(observed["awareness_score"])[:, None]).sum(axis=-1))/(1 + n_null_awareness)
+            results = {"accuracy_ci": quantile_interval(boot_accuracy, alpha), \
+                       "awareness_ci": quantile_interval(boot_awareness, alpha), \
+                       "accuracy_permutation_p": accuracy_p, \
+                       "awareness_permutation_p": np.where(np.isnan(observed["awareness_score"]) | (n_null_awareness == 0), np.nan, awareness_p)}
+        if single_session:
+            results = {key: value[0] for key, value in results.items()}
+        return results
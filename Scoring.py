@@ -0,0 +1,125 @@
+import numpy as np
+import scipy.special
+
+'''
+Scoring
+NumPy implementations of the heartbeat detection task scores, working on arrays of trials and sessions at once.
+Sessions are rows of 2D (sessions x trials) arrays; sessions with fewer trials are padded with NaN, which
+every function ignores. 1D arrays are treated as a single session
+'''
+SCORING_METHODS = ("garfinkel", "schandry")
+
+def trial_accuracy(count_measured, count_entered, method="garfinkel"):
+    '''
+    Element-wise accuracy of the entered counts:
+    - garfinkel: 1 - |measured - entered| / mean(measured, entered)
+    - schandry: 1 - |measured - entered| / measured
+    '''
+    count_measured = np.asarray(count_measured, dtype=float)
+    count_entered = np.asarray(count_entered, dtype=float)
+    if method == "garfinkel":
+        reference = 0.5*(count_measured + count_entered)
+    elif method == "schandry":
+        reference = count_measured
+    else:
+        raise ValueError(f"Unknown scoring method '{method}', use one of {', '.join(SCORING_METHODS)}")
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return 1 - np.abs(count_measured - count_entered)/reference
+
+def mean_accuracy(accuracy):
+    accuracy = np.asarray(accuracy, dtype=float)
+    valid = ~np.isnan(accuracy)
+    n = valid.sum(axis=-1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(n > 0, np.where(valid, accuracy, 0.0).sum(axis=-1)/n, np.nan)
+
+def pearson(x, y):
+    '''Pearson r and two-sided p-value along the last axis, ignoring pairs with a NaN (matches scipy.stats.pearsonr)'''
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    valid = ~(np.isnan(x) | np.isnan(y))
+    n = valid.sum(axis=-1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        x_mean = np.where(valid, x, 0.0).sum(axis=-1, keepdims=True)/n[..., None]
+        y_mean = np.where(valid, y, 0.0).sum(axis=-1, keepdims=True)/n[..., None]
+        dx = np.where(valid, x - x_mean, 0.0)
+        dy = np.where(valid, y - y_mean, 0.0)
+        r = (dx*dy).sum(axis=-1)/np.sqrt((dx*dx).sum(axis=-1)*(dy*dy).sum(axis=-1))
+        r = np.clip(r, -1.0, 1.0)
+        # Under H0, (r + 1)/2 follows Beta(n/2 - 1, n/2 - 1)
+        ab = n/2.0 - 1
+        p = 2*scipy.special.btdtr(ab, ab, 0.5*(1 - np.abs(r)))
+    r = np.where(n >= 2, r, np.nan)
+    p = np.where(n > 2, p, np.where(n == 2, 1.0, np.nan))
+    return r, np.where(np.isnan(r), np.nan, p)
+
+def percentile_of_score(reference, scores):
+    '''Percentile rank of each score within the reference values (matches scipy.stats.percentileofscore, kind="rank")'''
+    reference = np.sort(np.asarray(reference, dtype=float))
+    reference = reference[~np.isnan(reference)]
+    scores = np.asarray(scores, dtype=float)
+    left = np.searchsorted(reference, scores, side="left")
+    right = np.searchsorted(reference, scores, side="right")
+    percentile = (left + right + (right > left))*50.0/len(reference)
+    return np.where(np.isnan(scores), np.nan, percentile)
+
+def bootstrap_ci(accuracy, confidence, n_resamples=2000, ci=0.95, rng=None):
+    '''
+    Percentile bootstrap confidence intervals of the mean accuracy and the awareness, resampling trials
+    within each session. Returns {"accuracy_ci": (..., 2), "awareness_ci": (..., 2)}, (2,) for a single session
+    '''
+    rng = np.random.default_rng(rng)
+    single_session = np.ndim(accuracy) == 1
+    accuracy = np.atleast_2d(np.asarray(accuracy, dtype=float))
+    confidence = np.atleast_2d(np.asarray(confidence, dtype=float))
+    resampled_accuracy, resampled_confidence = resample_trials(accuracy, confidence, n_resamples, rng)
+    accuracy_samples = mean_accuracy(resampled_accuracy)
+    awareness_samples, _ = pearson(resampled_confidence, resampled_accuracy)
+    alpha = (1 - ci)/2
+    results = {"accuracy_ci": np.moveaxis(np.nanquantile(accuracy_samples, [alpha, 1 - alpha], axis=-1), 0, -1), \
+               "awareness_ci": np.moveaxis(np.nanquantile(awareness_samples, [alpha, 1 - alpha], axis=-1), 0, -1)}
+    if single_session:
+        results = {key: value[0] for key, value in results.items()}
+    return results
+
+def resample_trials(accuracy, confidence, n_resamples, rng):
+    '''(sessions x resamples x trials) arrays of trials drawn with replacement from each session's valid trials'''
+    n_sessions, n_trials = accuracy.shape
+    n_valid = (~np.isnan(accuracy)).sum(axis=-1)
+    # Valid trials first in each row, so drawing from [0, n_valid) ignores the padding
+    order = np.argsort(np.isnan(accuracy), axis=-1, kind="stable")
+    accuracy = np.take_along_axis(accuracy, order, axis=-1)
+    confidence = np.take_along_axis(confidence, order, axis=-1)
+    draws = (rng.random((n_sessions, n_resamples, n_trials))*n_valid[:, None, None]).astype(int)
+    draws = np.minimum(draws, np.maximum(n_valid[:, None, None] - 1, 0))
+    padding = np.arange(n_trials)[None, None, :] >= n_valid[:, None, None]
+    session_ids = np.arange(n_sessions)[:, None, None]
+    resampled_accuracy = np.where(padding, np.nan, accuracy[session_ids, draws])
+    resampled_confidence = np.where(padding, np.nan, confidence[session_ids, draws])
+    return resampled_accuracy, resampled_confidence
+
+def score_sessions(count_measured, count_entered, confidence, reference_accuracy=None, reference_awareness=None, method="garfinkel"):
+    '''
+    Accuracy and awareness of many sessions at once, and their percentiles if reference values are given.
+    Returns a dict of arrays with one value per session (or scalars for 1D input)
+    '''
+    accuracy = trial_accuracy(count_measured, count_entered, method)
+    confidence = np.asarray(confidence, dtype=float)
+    awareness_score, awareness_p_value = pearson(confidence, accuracy)
+    results = {"trial_accuracy": accuracy, \
+               "accuracy_score": mean_accuracy(accuracy), \
+               "awareness_score": awareness_score, \
+               "awareness_p_value": awareness_p_value}
+    if reference_accuracy is not None:
+        results["accuracy_percentile"] = percentile_of_score(reference_accuracy, results["accuracy_score"])
+    if reference_awareness is not None:
+        results["awareness_percentile"] = percentile_of_score(reference_awareness, awareness_score)
+    return results
+
+def pad_sessions(sessions):
+    '''Stacks per-session lists of trial values into a NaN-padded (sessions x trials) array'''
+    n_trials = max((len(session) for session in sessions), default=0)
+    padded = np.full((len(sessions), n_trials), np.nan)
+    for i, session in enumerate(sessions):
+        padded[i, :len(session)] = session
+    return padded
@@ -0,0 +1,45 @@
+from collections import deque
+import time
+import numpy as np
+
+'''
+SensorClock class
+Maps the host's monotonic clock into the sensor timebase, i.e. the sample times in the ECG history.
+Every ECG frame is stamped with time.monotonic() as it arrives. arrival - (time of the frame's last sample) is the
+clock offset plus that frame's transport delay, so the smallest of these over the last window_s is the offset
+plus the minimum delay. Taking it over a sliding window follows the slow drift between the two clocks, and
+frames that were held up (BLE retries, a busy event loop) never count. transport_latency_s, the minimum
+delay from the last sample being measured to its frame arriving, is added back.
+It's written from the thread that decodes the frames and read from the GUI thread, each update replaces
+self.offset in one assignment
+'''
+class SensorClock:
+
+    def __init__(self, window_s=30.0, transport_latency_s=0.0):
+        self.window_s = window_s
+        self.transport_latency_s = transport_latency_s
+        self.frames = deque() # (arrival, arrival - last sample time)
+        self.offset = None
+
+    def add_frame(self, last_sample_time, arrival=None):
+        arrival = time.monotonic() if arrival is None else arrival
+        self.frames.append((arrival, arrival - float(last_sample_time)))
+        while self.frames[0][0] < arrival - self.window_s:
+            self.frames.popleft()
+        self.offset = min(offset for _, offset in self.frames) - self.transport_latency_s
+
+    def is_synchronised(self):
+        return self.offset is not None
+
+    def to_sensor_time(self, t_monotonic):
+        '''Sensor time of a monotonic clock reading. Before the first frame it falls back on the wall clock'''
+        if self.offset is None:
+            return time.time_ns()/1.0e9 - (time.monotonic() - t_monotonic)
+        return t_monotonic - self.offset
+
+    def get_jitter_s(self):
+        '''Median delay of the frames beyond the quickest one, how late a typical frame is'''
+        if not self.frames:
+            return np.nan
+        offsets = np.array([offset for _, offset in self.frames])
+        return float(np.median(offsets) - offsets.min())
@@ -0,0 +1,146 @@
+import argparse
+import glob
+import os
+import numpy as np
+import pandas as pd
+
+'''
+SessionExport
+Columnar export of sessions, trials and (optionally) the raw trial ECG for analysis.
+
+Each table is a folder of compressed NumPy column files, one part per session, written in a single batch
+when the session is saved:
+    <folder>/sessions/part-<session id>.npz
+    <folder>/trials/part-<session id>.npz
+    <folder>/ecg/part-<session id>.npz
+load_table() reads every part of a table (or one session's rows) into a DataFrame, compact() merges the parts
+into one file,
+    <folder>/<table>/part-merged-<first session id>-<last session id>.npz
+Saving a session merges the single session parts once there are more than EXPORT_COMPACT_PARTS of them, and
+python SessionExport.py [folder] merges everything
+'''
+TABLES = ("sessions", "trials", "ecg")
+
+SESSION_COLUMNS = {"session_id": "U32", "user_id": "U64", "date": "datetime64[s]", "beat_detector": "U32", "protocol": "U64", \
+                   "protocol_seed": np.int64, "scoring_method": "U16", "n_trials": np.int32, \
+                   "average_accuracy": np.float64, "accuracy_percentile": np.float64, "awareness_score": np.float64, \
+                   "awareness_p_value": np.float64, "awareness_percentile": np.float64, \
+                   "accuracy_permutation_p": np.float64, "awareness_permutation_p": np.float64}
+TRIAL_COLUMNS = {"session_id": "U32", "user_id": "U64", "trial_id": np.int32, "trial_length": np.int32, "start_time": np.float64, "end_time": np.float64, \
+                 "count_measured": np.int32, "count_entered": np.int32, "accuracy": np.float64, "confidence": np.float64, "training": np.bool_}
+ECG_COLUMNS = {"session_id": "U32", "trial_id": np.int32, "time": np.float64, "ecg": np.int32}
+
+def to_columns(rows, columns):
+    return {name: np.array([row.get(name, np.nan if np.issubdtype(np.dtype(dtype), np.floating) else "") for row in rows], dtype=dtype) \
+            for name, dtype in columns.items()}
+
+def write_part(folder, table, session_id, columns):
+    table_folder = os.path.join(folder, table)
+    os.makedirs(table_folder, exist_ok=True)
+    filepath = os.path.join(table_folder, f"part-{session_id}.npz")
+    tmp_filepath = os.path.join(table_folder, f".tmp-{session_id}.npz") # Hidden, so it isn't globbed as a part
+    np.savez_compressed(tmp_filepath, **columns)
+    os.replace(tmp_filepath, filepath) # Readers never see a partly written part
+    return filepath
+
+def export_session(folder, session_id, session_summary, trials, trial_windows=None):
+    '''
+    Writes one session's parts. trial_windows is an optional list of (times, values) per trial for the raw ECG
+    '''
+    session_row = dict(session_summary, session_id=session_id, n_trials=len(trials))
+    session_row["user_id"] = session_summary.get("user_id") or ""
+    session_row["protocol"] = session_summary.get("protocol") or ""
+    session_row["protocol_seed"] = session_summary.get("protocol_seed") or 0
+    session_row["date"] = np.datetime64(session_summary["date"].replace(" ", "T"), "s")
+    write_part(folder, "sessions", session_id, to_columns([session_row], SESSION_COLUMNS))
+
+    trial_rows = [dict(trial, session_id=session_id, user_id=session_row.get("user_id") or "", trial_id=trial_id) for trial_id, trial in enumerate(trials)]
+    write_part(folder, "trials", session_id, to_columns(trial_rows, TRIAL_COLUMNS))
+
+    if trial_windows is not None:
+        lengths = [len(values) for _, values in trial_windows]
+        ecg_columns = {"session_id": np.full(sum(lengths), session_id, dtype=ECG_COLUMNS["session_id"]), \
+                       "trial_id": np.repeat(np.arange(len(trial_windows), dtype=np.int32), lengths), \
+                       "time": np.concatenate([times for times, _ in trial_windows] or [np.array([])]).astype(np.float64), \
+                       "ecg": np.round(np.concatenate([values for _, values in trial_windows] or [np.array([])])).astype(np.int32)}
+        write_part(folder, "ecg", session_id, ecg_columns)
+
+def part_session_ids(filepath):
+    '''First and last session id in a part. Session ids can contain '-', so a merged part's are read rather than split from its name'''
+    part_id = os.path.basename(filepath)[len("part-"):-len(".npz")]
+    if not part_id.startswith("merged-"):
+        return part_id, part_id
+    with np.load(filepath, allow_pickle=False) as data:
+        session_ids = np.sort(data["session_id"])
+    if len(session_ids) == 0:
+        return part_id, part_id
+    return str(session_ids[0]), str(session_ids[-1])
+
+def is_merged(filepath):
+    return os.path.basename(filepath).startswith("part-merged-")
+
+def find_parts(folder, table, session_id=None):
+    '''
+    Parts of a table in session order, so the rows load in the order the sessions were recorded.
+    With a session_id, only the parts that can hold its rows
+    '''
+    parts = [(part_session_ids(part), part) for part in glob.glob(os.path.join(folder, table, "part-*.npz"))]
+    if session_id is not None:
+        parts = [(session_ids, part) for session_ids, part in parts if session_ids[0] <= session_id <= session_ids[1]]
+    return [part for _, part in sorted(parts)]
+
+def load_parts(parts, columns=None, session_id=None):
+    loaded = {}
+    for part in parts:
+        with np.load(part, allow_pickle=False) as data:
+            rows = data["session_id"] == session_id if session_id is not None else slice(None)
+            for name in (columns or data.files):
+                loaded.setdefault(name, []).append(data[name][rows])
+    if columns is not None:
+        return {name: np.concatenate(loaded[name]) if name in loaded else np.array([]) for name in columns}
+    return {name: np.concatenate(arrays) for name, arrays in loaded.items()}
+
+def load_columns(folder, table, columns=None, session_id=None):
+    '''Concatenated columns of every part of a table, or of one session's rows, as a dict of arrays'''
+    return load_parts(find_parts(folder, table, session_id), columns, session_id)
+
+def load_table(folder, table, columns=None, session_id=None):
+    return pd.DataFrame(load_columns(folder, table, columns, session_id))
+
+def compact(folder, table, include_merged=True):
+    '''
+    Merges the parts of a table into a single part, so loading months of data opens one file.
+    include_merged=False only merges the single session parts, leaving earlier merges as they are
+    '''
+    parts = find_parts(folder, table)
+    if not include_merged:
+        parts = [part for part in parts if not is_merged(part)]
+    if len(parts) < 2:
+        return
+    # Named after the sessions it holds, not the merged parts it replaces, so merging again doesn't nest the names
+    session_ids = [part_session_ids(part) for part in parts]
+    merged_id = f"merged-{min(first for first, _ in session_ids)}-{max(last for _, last in session_ids)}"
+    merged_filepath = os.path.join(folder, table, f"part-{merged_id}.npz")
+    if os.path.exists(merged_filepath) and merged_filepath not in parts:
+        parts = sorted(parts + [merged_filepath], key=part_session_ids) # Same sessions as an earlier merge, kept in the new one
+    write_part(folder, table, merged_id, load_parts(parts))
+    for part in parts:
+        if part != merged_filepath:
+            os.remove(part)
+
+def compact_if_needed(folder, max_parts):
+    '''Merges each table's single session parts once there are more than max_parts of them'''
+    for table in TABLES:
+        parts = glob.glob(os.path.join(folder, table, "part-*.npz"))
+        if sum(not is_merged(part) for part in parts) > max_parts:
+            compact(folder, table, include_merged=False)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Merge the parts of a columnar export")
+    parser.add_argument("folder", nargs="?", default=os.path.join("data", "columnar"), help="Columnar export folder")
+    parser.add_argument("--tables", nargs="+", choices=TABLES, default=TABLES, help="Tables to compact")
+    args = parser.parse_args()
+    for table in args.tables:
+        n_parts = len(find_parts(args.folder, table))
+        compact(args.folder, table)
+        print(f"{table}: {n_parts} parts -> {len(find_parts(args.folder, table))}")
@@ -0,0 +1,130 @@
+import glob
+import json
+import logging
+import os
+import queue
+import threading
+import time
+import zlib
+
+'''
+SessionLog class
+Append-only write-ahead log of a session, so a crash or a hung sensor doesn't lose the trials done so far:
+    <sessions folder>/session_log_<session id>.wal
+Each line is "<crc32 of the record> <record as JSON>". Records are:
+    session_started   session id, user id, schedule and beat detector
+    trial             a scored trial, as added to SessionData.trials
+    trial_rescored    the whole trial after rescoring
+    session_saved     the session file was written, the log is then removed
+append() only queues the record. A writer thread writes it, and fsyncs at most every sync_interval_s, so
+records that arrive together share one fsync and a state change never waits for the disk.
+
+recover() replays a log into the session it describes. A record torn by a crash fails its checksum, and
+replay stops there
+'''
+logger = logging.getLogger(__name__)
+
+LOG_PATTERN = "session_log_*.wal"
+
+def get_log_filepath(folder, session_id):
+    return os.path.join(folder, f"session_log_{session_id}.wal")
+
+def find_logs(folder):
+    return sorted(glob.glob(os.path.join(folder, LOG_PATTERN)))
+
+def read_log(filepath):
+    records = []
+    with open(filepath, "rb") as file:
+        for line in file:
+            checksum, _, payload = line.rstrip(b"\n").partition(b" ")
+            try:
+                if int(checksum, 16) != zlib.crc32(payload):
+                    raise ValueError("checksum mismatch")
+                records.append(json.loads(payload))
+            except ValueError:
+                logger.warning("Session log ends in a damaged record", extra={"path": filepath, "records": len(records)})
+                break
+    return records
+
+def recover(filepath):
+    '''The session a log describes: session id, user id, schedule, beat detector, trials, and whether it was saved'''
+    session = None
+    for record in read_log(filepath):
+        if record["type"] == "session_started":
+            session = {"session_id": record["session_id"], "user_id": record["user_id"], "schedule": record["schedule"], \
+                       "beat_detector": record["beat_detector"], "trials": [], "saved": False}
+        elif session is None:
+            break # No header, nothing to attach the records to
+        elif record["type"] == "trial":
+            session["trials"].append(record["trial"])
+        elif record["type"] == "trial_rescored" and record["trial_id"] < len(session["trials"]):
+            session["trials"][record["trial_id"]] = record["trial"]
+        elif record["type"] == "session_saved":
+            session["saved"] = True
+    return session
+
+class SessionLog:
+
+    def __init__(self, filepath, sync_interval_s=0.2):
+        self.filepath = filepath
+        self.sync_interval_s = sync_interval_s
+        self.queue = queue.SimpleQueue() # ("record", line) | ("flush", event) | ("close", event)
+        self.file = open(filepath, "ab")
+        self.closed = False
+        self.thread = threading.Thread(target=self.run, name="session-log", daemon=True)
+        self.thread.start()
+
+    def append(self, record_type, **fields):
+        '''Queues a record, returns straight away'''
+        if self.closed:
+            raise ValueError("Session log is closed")
+        payload = json.dumps({"type": record_type, "time": time.time(), **fields}).encode()
+        self.queue.put(("record", b"%08x %s\n" % (zlib.crc32(payload), payload)))
+
+    def run(self):
+        sync_deadline = None # Set while there are written records not yet synced
+        while True:
+            try:
+                timeout = max(sync_deadline - time.monotonic(), 0) if sync_deadline is not None else None
+                kind, item = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                self.sync()
+                sync_deadline = None
+                continue
+            if kind == "record":
+                self.file.write(item)
+                if sync_deadline is None:
+                    sync_deadline = time.monotonic() + self.sync_interval_s
+                continue
+            self.sync()
+            sync_deadline = None
+            if kind == "close":
+                self.file.close()
+                item.set()
+                return
+            item.set()
+
+    def sync(self):
+        try:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+        except OSError:
+            logger.exception("Could not sync the session log", extra={"path": self.filepath})
+
+    def flush(self, timeout=5.0):
+        '''Waits until everything appended so far is on disk'''
+        if self.closed:
+            return True
+        done = threading.Event()
+        self.queue.put(("flush", done))
+        return done.wait(timeout)
+
+    def close(self, remove=False, timeout=5.0):
+        '''Syncs and closes the log. remove=True deletes it too, once the session it protects is saved'''
+        if not self.closed:
+            self.closed = True
+            done = threading.Event()
+            self.queue.put(("close", done))
+            done.wait(timeout)
+        if remove and os.path.exists(self.filepath):
+            os.remove(self.filepath)
@@ -0,0 +1,146 @@
+import argparse
+import time
+from multiprocessing import resource_tracker, shared_memory
+import numpy as np
+
+'''
+Shared ECG history
+A ring buffer of ECG sample times and values in shared memory, written by BeatTracker and read zero-copy
+by other processes (recorders, dashboards, analysis).
+
+Layout: an int64 header [sequence, write count, capacity, magic] followed by the times and values as float64.
+The writer makes the sequence odd while it writes and even again when done (a seqlock), so readers retry
+any read that overlapped a write instead of ever taking a lock on the ingest path
+'''
+MAGIC = 0x45434748 # "ECGH"
+HEADER_LEN = 4
+SEQUENCE, WRITE_COUNT, CAPACITY, MAGIC_ID = range(HEADER_LEN)
+
+def buffer_size(capacity):
+    return 8*HEADER_LEN + 2*8*capacity
+
+def map_arrays(buf, capacity):
+    header = np.ndarray((HEADER_LEN,), dtype=np.int64, buffer=buf)
+    times = np.ndarray((capacity,), dtype=np.float64, buffer=buf, offset=8*HEADER_LEN)
+    values = np.ndarray((capacity,), dtype=np.float64, buffer=buf, offset=8*HEADER_LEN + 8*capacity)
+    return header, times, values
+
+class SharedEcgHistoryWriter:
+
+    def __init__(self, name, capacity):
+        try:
+            self.shm = shared_memory.SharedMemory(name=name, create=True, size=buffer_size(capacity))
+        except FileExistsError: # Left behind by a previous run that didn't exit cleanly
+            stale = shared_memory.SharedMemory(name=name)
+            stale.close()
+            stale.unlink()
+            self.shm = shared_memory.SharedMemory(name=name, create=True, size=buffer_size(capacity))
+        self.name = name
+        self.capacity = capacity
+        self.header, self.times, self.values = map_arrays(self.shm.buf, capacity)
+        self.header[:] = [0, 0, capacity, MAGIC]
+
+    def write(self, times, values):
+        times = np.atleast_1d(times).ravel()
+        values = np.atleast_1d(values).ravel()
+        n = len(values)
+        if n > self.capacity:
+            times, values = times[-self.capacity:], values[-self.capacity:]
+            skipped, n = n - self.capacity, self.capacity
+        else:
+            skipped = 0
+        start = int(self.header[WRITE_COUNT] + skipped) % self.capacity
+        first = min(n, self.capacity - start)
+
+        self.header[SEQUENCE] += 1 # Odd: write in progress
+        self.times[start:start+first] = times[:first]
+        self.values[start:start+first] = values[:first]
+        self.times[:n-first] = times[first:]
+        self.values[:n-first] = values[first:]
+        self.header[WRITE_COUNT] += n + skipped
+        self.header[SEQUENCE] += 1 # Even: consistent
+
+    def close(self, unlink=True):
+        del self.header, self.times, self.values
+        self.shm.close()
+        if unlink:
+            self.shm.unlink()
+
+class SharedEcgHistoryReader:
+    MAX_RETRIES = 1000
+
+    def __init__(self, name):
+        self.shm = shared_memory.SharedMemory(name=name)
+        # Only the writer owns the segment, stop this process's resource tracker unlinking it on exit
+        resource_tracker.unregister(self.shm._name, "shared_memory")
+        header = np.ndarray((HEADER_LEN,), dtype=np.int64, buffer=self.shm.buf)
+        if header[MAGIC_ID] != MAGIC:
+            raise ValueError(f"Shared memory '{name}' is not an ECG history")
+        self.capacity = int(header[CAPACITY])
+        self.header, self.times, self.values = map_arrays(self.shm.buf, self.capacity)
+
+    def read(self, copy_fn):
+        '''Runs copy_fn(write_count) until it completes without a concurrent write, returns its result'''
+        for _ in range(self.MAX_RETRIES):
+            sequence = int(self.header[SEQUENCE])
+            if sequence % 2:
+                time.sleep(0)
+                continue
+            result = copy_fn(int(self.header[WRITE_COUNT]))
+            if int(self.header[SEQUENCE]) == sequence:
+                return result
+        raise TimeoutError("Could not get a consistent read of the shared ECG history")
+
+    def ordered_slices(self, write_count):
+        '''The two physical slices holding the buffered samples, oldest first'''
+        n = min(write_count, self.capacity)
+        start = (write_count - n) % self.capacity
+        if start + n <= self.capacity:
+            return [slice(start, start+n)]
+        return [slice(start, self.capacity), slice(0, (start + n) % self.capacity)]
+
+    def get_latest(self, n_samples):
+        '''Copies of the latest n samples, returns (times, values)'''
+        def copy_latest(write_count):
+            n = min(n_samples, write_count, self.capacity)
+            ids = (write_count - n + np.arange(n)) % self.capacity
+            return self.times[ids], self.values[ids]
+        return self.read(copy_latest)
+
+    def get_ecg_wind(self, start_time, end_time):
+        '''Copies of the samples with start_time <= t <= end_time, returns (values, times) like BeatTracker.get_ecg_wind'''
+        def copy_wind(write_count):
+            wind_times, wind_values = [], []
+            for part in self.ordered_slices(write_count):
+                times = self.times[part]
+                lo = np.searchsorted(times, start_time, side="left")
+                hi = np.searchsorted(times, end_time, side="right")
+                wind_times.append(np.array(times[lo:hi]))
+                wind_values.append(np.array(self.values[part][lo:hi]))
+            if not wind_times:
+                return np.array([]), np.array([])
+            return np.concatenate(wind_values), np.concatenate(wind_times)
+        return self.read(copy_wind)
+
+    def write_count(self):
+        return int(self.header[WRITE_COUNT])
+
+    def close(self):
+        del self.header, self.times, self.values
+        self.shm.close()
+
+if __name__ == "__main__":
+    # Example consumer: prints the sample rate and latest value seen in another process's ECG history
+    parser = argparse.ArgumentParser(description="Attach to a shared ECG history and follow it")
+    parser.add_argument("name", help="Shared memory name, as set with --shared-history")
+    args = parser.parse_args()
+
+    reader = SharedEcgHistoryReader(args.name)
+    last_count = reader.write_count()
+    while True:
+        time.sleep(1)
+        times, values = reader.get_latest(1)
+        count = reader.write_count()
+        if len(values):
+            print(f"{count - last_count} samples/s, latest {values[-1]:.0f} µV at {times[-1]:.3f}")
+        last_count = count
@@ -0,0 +1,186 @@
+import argparse
+import asyncio
+import logging
+import socket
+import struct
+import threading
+from collections import deque
+import numpy as np
+from Instrumentation import REGISTRY
+
+'''
+StreamServer class
+Publishes live ECG, ACC and R-peak events to any number of TCP subscribers, e.g. a supervisor's dashboard.
+
+Each frame is a 16 byte header followed by columnar little-endian arrays:
+    header: magic b"IO", version (uint8), message type (uint8), sample count n (uint32), frame sequence (uint64)
+    ECG:  n float64 times (epoch s), n float32 values (µV)
+    ACC:  n float64 times (epoch s), 3n float32 values (x, y, z interleaved)
+    PEAK: n float64 times (epoch s)
+
+The server runs its own asyncio loop on a background thread. publish() only packs the frame and hands it over,
+so it never blocks the ingest path. Each client has a bounded frame buffer; when a slow client's buffer
+overflows it is dropped down to the latest frame
+'''
+logger = logging.getLogger(__name__)
+
+HEADER = struct.Struct("<2sBBIQ")
+MAGIC = b"IO"
+VERSION = 1
+MSG_ECG = 1
+MSG_ACC = 2
+MSG_PEAK = 3
+
+def pack_frame(msg_type, seq, times, values=None):
+    times = np.ascontiguousarray(times, dtype="<f8").ravel()
+    payload = times.tobytes()
+    if values is not None:
+        payload += np.ascontiguousarray(values, dtype="<f4").ravel().tobytes()
+    return HEADER.pack(MAGIC, VERSION, msg_type, len(times), seq) + payload
+
+def unpack_payload(msg_type, n, payload):
+    times = np.frombuffer(payload, dtype="<f8", count=n)
+    if msg_type == MSG_PEAK:
+        return times, None
+    values = np.frombuffer(payload, dtype="<f4", offset=8*n)
+    return times, values.reshape(n, 3) if msg_type == MSG_ACC else values
+
+def payload_size(msg_type, n):
+    return {MSG_ECG: 12*n, MSG_ACC: 20*n, MSG_PEAK: 8*n}[msg_type]
+
+class ClientConnection:
+
+    def __init__(self, writer, max_frames):
+        self.writer = writer
+        self.frames = deque()
+        self.max_frames = max_frames
+        self.frames_ready = asyncio.Event()
+        self.dropped = 0
+
+    def push(self, frame):
+        if len(self.frames) >= self.max_frames:
+            # Slow client: skip to the latest data rather than falling further behind
+            self.dropped += len(self.frames)
+            self.frames.clear()
+        self.frames.append(frame)
+        self.frames_ready.set()
+
+    async def send_loop(self):
+        while True:
+            await self.frames_ready.wait()
+            self.frames_ready.clear()
+            batch = b"".join(self.frames)
+            self.frames.clear()
+            self.writer.write(batch)
+            await self.writer.drain()
+
+class StreamServer:
+
+    def __init__(self, host="127.0.0.1", port=9109, max_client_frames=64):
+        self.host = host
+        self.port = port
+        self.max_client_frames = max_client_frames
+        self.clients = set()
+        self.loop = None
+        self.server = None
+        self.started = threading.Event()
+        self.seq = 0
+        self.frames_published = REGISTRY.counter("stream_frames_published_total", "Frames published to the stream server")
+        self.frames_dropped = REGISTRY.counter("stream_frames_dropped_total", "Frames dropped for slow stream clients")
+        REGISTRY.gauge("stream_clients", "Connected stream clients", callback=lambda: len(self.clients))
+
+    def start(self):
+        threading.Thread(target=self.run, name="stream-server", daemon=True).start()
+        self.started.wait()
+
+    def run(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.server = self.loop.run_until_complete(asyncio.start_server(self.handle_client, self.host, self.port))
+        self.port = self.server.sockets[0].getsockname()[1]
+        logger.info("Streaming ECG", extra={"address": f"{self.host}:{self.port}"})
+        self.started.set()
+        self.loop.run_forever()
+
+    def stop(self):
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.server.close)
+            self.loop.call_soon_threadsafe(self.loop.stop)
+
+    async def handle_client(self, reader, writer):
+        client = ClientConnection(writer, self.max_client_frames)
+        self.clients.add(client)
+        peer = writer.get_extra_info("peername")
+        logger.info("Stream client connected", extra={"peer": peer})
+        sender = asyncio.ensure_future(client.send_loop())
+        try:
+            await reader.read() # Clients don't send anything, returns when they disconnect
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            sender.cancel()
+            self.clients.discard(client)
+            self.frames_dropped.inc(client.dropped)
+            writer.close()
+            logger.info("Stream client disconnected", extra={"peer": peer, "dropped_frames": client.dropped})
+
+    def publish(self, msg_type, times, values=None):
+        '''Thread-safe and non-blocking, the frame is packed here and fanned out on the server thread'''
+        if self.loop is None or not self.clients:
+            return
+        frame = pack_frame(msg_type, self.seq, times, values)
+        self.seq += 1
+        self.frames_published.inc()
+        self.loop.call_soon_threadsafe(self.fan_out, frame)
+
+    def fan_out(self, frame):
+        for client in self.clients:
+            client.push(frame)
+
+    def publish_ecg(self, times, values):
+        self.publish(MSG_ECG, times, values)
+
+    def publish_acc(self, times, values):
+        self.publish(MSG_ACC, times, values)
+
+    def publish_peaks(self, times):
+        self.publish(MSG_PEAK, times)
+
+class StreamClient:
+    '''Blocking client, e.g. for an operator dashboard or tests against a local server'''
+
+    def __init__(self, host="127.0.0.1", port=9109, timeout=None):
+        self.sock = socket.create_connection((host, port), timeout=timeout)
+
+    def read_exactly(self, n):
+        data = bytearray()
+        while len(data) < n:
+            chunk = self.sock.recv(n - len(data))
+            if not chunk:
+                raise ConnectionError("Stream closed")
+            data += chunk
+        return bytes(data)
+
+    def read_frame(self):
+        '''Returns (message type, frame sequence, times, values)'''
+        magic, version, msg_type, n, seq = HEADER.unpack(self.read_exactly(HEADER.size))
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("Not an ECG stream frame")
+        times, values = unpack_payload(msg_type, n, self.read_exactly(payload_size(msg_type, n)))
+        return msg_type, seq, times, values
+
+    def close(self):
+        self.sock.close()
+
+if __name__ == "__main__":
+    # Example subscriber: prints a line per frame received from a station
+    parser = argparse.ArgumentParser(description="Subscribe to a station's live ECG stream")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9109)
+    args = parser.parse_args()
+
+    client = StreamClient(args.host, args.port)
+    names = {MSG_ECG: "ECG", MSG_ACC: "ACC", MSG_PEAK: "PEAK"}
+    while True:
+        msg_type, seq, times, values = client.read_frame()
+        print(f"#{seq} {names.get(msg_type, msg_type)}: {len(times)} samples, last at {times[-1]:.3f}" if len(times) else f"#{seq} empty")
@@ -0,0 +1,317 @@
+import os
+os.environ['QT_API'] = 'PySide6'
+
+import argparse
+import heapq
+import logging
+import tempfile
+import threading
+import time
+import numpy as np
+from PolarH10 import PolarH10
+from Instrumentation import REGISTRY
+from Pipeline import Node
+import vars
+
+'''
+Stress harness
+Finds how many straps one station can handle. A fleet of N virtual Polar H10s produce correctly formatted
+notifications: PMD ECG (130 Hz, 73 samples a frame), optionally PMD ACC (200 Hz, 16 bit) and 0x2A37 heart rate
+with RR intervals, from synthetic ECG with a configurable heart rate and noise. Each strap runs on its own
+drifting clock, and its notifications arrive on BLE connection events with jitter, occasional bursts (the link
+stalls, then delivers the backlog back to back) and dropped packets.
+
+The notifications go through the real PolarH10 decode callbacks, on one ingest thread as in IngestWorker, and
+each strap's frames are consumed by its own Model through Model.drain_ingest every 5 ms, as in the app.
+N is doubled each step until a step breaches the SLOs (frame latency p99, ingest queue overflow, ACC buffer
+overwrites), then bisected, and the largest N that met them is reported as the knee.
+
+Latency is from when a frame was due to arrive to when its samples reached the BeatTracker, so it includes
+the ingest thread falling behind schedule as well as the consumer.
+Run from the repository folder (the Model loads the reference data from there).
+
+Usage:
+    python StressHarness.py [--max-devices 256] [--step-s 10] [--slo-p99-ms 100] [--acc] [--drop 0.002]
+'''
+POLAR_EPOCH_NS = 599_616_000_000_000_000 # The H10 counts ns from 2000-01-01, roughly where its clock starts
+ECG_FRAME_SAMPLES = 73
+ACC_FRAME_SAMPLES = 36
+ACC_SAMPLING_RATE = 200
+
+class SyntheticEcg:
+    '''PQRST beats as sums of Gaussians in µV, with beat to beat variability, baseline wander and noise'''
+
+    WAVES = ((-0.2, 0.025, 150), (-0.05, 0.01, -100), (0.0, 0.01, 1200), (0.04, 0.012, -250), (0.25, 0.04, 300)) # (offset s, width s, µV)
+
+    def __init__(self, sampling_rate, heart_rate, noise_uv, rng):
+        self.sampling_rate = sampling_rate
+        self.mean_rr = 60.0/heart_rate
+        self.noise_uv = noise_uv
+        self.rng = rng
+        self.beat_times = [0.3]
+        self.n_samples = 0
+
+    def next(self, n_samples):
+        t = (self.n_samples + np.arange(n_samples))/self.sampling_rate
+        self.n_samples += n_samples
+        while self.beat_times[-1] < t[-1] + 1.0:
+            self.beat_times.append(self.beat_times[-1] + self.mean_rr*(1 + 0.05*self.rng.standard_normal()))
+        # Beats more than 1.5 s before the block can't reach it. The strap's once a second RR report has taken them by then
+        while self.beat_times[0] < t[0] - 1.5:
+            del self.beat_times[0]
+        values = 200*np.sin(2*np.pi*0.2*t) + self.noise_uv*self.rng.standard_normal(n_samples)
+        for beat_time in self.beat_times:
+            if t[0] - 1.5 <= beat_time <= t[-1] + 1.5:
+                for offset, width, amplitude in self.WAVES:
+                    values += amplitude*np.exp(-0.5*((t - beat_time - offset)/width)**2)
+        return np.rint(values).astype(np.int32)
+
+    def pop_rr_intervals(self, until):
+        '''RR intervals (s) of the beats up to until, as the strap reports them once a second'''
+        done = [beat_time for beat_time in self.beat_times if beat_time <= until]
+        rr_intervals = np.diff(done)
+        self.beat_times = self.beat_times[max(len(done) - 1, 0):]
+        return rr_intervals
+
+class VirtualPolar:
+    '''One strap's notifications, each with the (simulated true) time it arrives at the host'''
+
+    def __init__(self, device_id, rng, heart_rate=70, noise_uv=20, drift_ppm=30, connection_interval_s=0.03, \
+                 jitter_s=0.005, burst_prob=0.01, burst_s=0.5, drop_prob=0.002, acc=False):
+        self.device_id = device_id
+        self.rng = rng
+        self.drift = drift_ppm*1e-6*rng.uniform(-1, 1)
+        self.clock_offset_ns = POLAR_EPOCH_NS + int(rng.integers(0, 10**12))
+        self.connection_interval_s = connection_interval_s
+        self.connection_phase_s = rng.uniform(0, connection_interval_s)
+        self.jitter_s = jitter_s
+        self.burst_prob = burst_prob
+        self.burst_s = burst_s
+        self.drop_prob = drop_prob
+        self.acc = acc
+        self.start_s = rng.uniform(0, 1.0) # Straps don't all connect at once, so their frames aren't all due together
+        self.ecg = SyntheticEcg(PolarH10.ECG_SAMPLING_FREQ, heart_rate, noise_uv, rng)
+        self.ecg_seq = 0
+        self.acc_seq = 0
+        self.next_hr_time = self.start_s + 1.0
+        self.stall_until = -1.0
+        self.n_dropped = 0
+
+    def sensor_ns(self, true_s):
+        return self.clock_offset_ns + int(round(true_s*(1 + self.drift)*1e9))
+
+    def true_time(self, stream_s):
+        '''Host time of a time since the start of the stream on the strap's clock'''
+        return self.start_s + stream_s/(1 + self.drift)
+
+    def arrival(self, ready_s):
+        '''Next connection event after the data is ready, plus jitter, held back while the link is stalled'''
+        if ready_s > self.stall_until and self.rng.random() < self.burst_prob:
+            self.stall_until = ready_s + self.rng.uniform(0.2, 1.0)*self.burst_s
+        ready_s = max(ready_s, self.stall_until)
+        n_intervals = np.ceil((ready_s - self.connection_phase_s)/self.connection_interval_s)
+        return self.connection_phase_s + n_intervals*self.connection_interval_s + self.rng.exponential(self.jitter_s)
+
+    def notifications(self, until_s):
+        '''(arrival s, stream, data) of the notifications whose data is ready by until_s'''
+        notifications = []
+        while self.true_time((self.ecg_seq + ECG_FRAME_SAMPLES)/PolarH10.ECG_SAMPLING_FREQ) <= until_s:
+            last_s = self.true_time((self.ecg_seq + ECG_FRAME_SAMPLES - 1)/PolarH10.ECG_SAMPLING_FREQ)
+            values = self.ecg.next(ECG_FRAME_SAMPLES)
+            self.ecg_seq += ECG_FRAME_SAMPLES
+            data = bytearray([0x00]) + self.sensor_ns(last_s).to_bytes(8, "little") + bytearray([0x00]) + \
+                   (values.astype("<i4").view(np.uint8).reshape(-1, 4)[:, :3]).tobytes() # 24 bit little endian
+            notifications.append((self.arrival(last_s), "ecg", data))
+        while self.acc and self.true_time((self.acc_seq + ACC_FRAME_SAMPLES)/ACC_SAMPLING_RATE) <= until_s:
+            last_s = self.true_time((self.acc_seq + ACC_FRAME_SAMPLES - 1)/ACC_SAMPLING_RATE)
+            t = (self.acc_seq + np.arange(ACC_FRAME_SAMPLES))/ACC_SAMPLING_RATE
+            self.acc_seq += ACC_FRAME_SAMPLES
+            xyz = np.stack([-180 + 20*np.sin(2*np.pi*0.3*t), -30 + 5*self.rng.standard_normal(len(t)), 950 + 10*np.cos(2*np.pi*0.2*t)], axis=1)
+            data = bytearray([0x02]) + self.sensor_ns(last_s).to_bytes(8, "little") + bytearray([0x01]) + np.rint(xyz).astype("<i2").tobytes()
+            notifications.append((self.arrival(last_s), "acc", data))
+        while self.next_hr_time <= until_s:
+            rr_intervals = self.ecg.pop_rr_intervals(self.next_hr_time - self.start_s)
+            heart_rate = int(round(60/np.mean(rr_intervals))) if len(rr_intervals) else 0
+            data = bytearray([0x10, min(heart_rate, 255)]) + np.rint(rr_intervals*1024).astype("<u2").tobytes() # Flags: uint8 HR, RR present
+            notifications.append((self.arrival(self.next_hr_time), "hr", data))
+            self.next_hr_time += 1.0
+
+        kept = []
+        for notification in notifications:
+            if self.rng.random() < self.drop_prob:
+                self.n_dropped += 1
+            else:
+                kept.append(notification)
+        return kept
+
+class VirtualIngest(Node):
+    '''
+    Stands in for IngestWorker: emits one strap's decoded frames into its Model's pipeline, stamped with when they
+    were due to arrive, and, as a sink after the BeatTracker, records how late they got there
+    '''
+    streams = ("ecg",)
+
+    def __init__(self, model, max_frames):
+        super().__init__("latency")
+        self.model = model
+        self.model.ingest_queue.max_batches = max_frames
+        self.model.pipeline.connect(self.model.history_stage, self)
+        self.due_time = None # Set by the ingest thread before each notification is decoded
+        self.latencies = []
+        self.measure_after = None
+
+    def put(self, stream, times, values):
+        self.model.polar_source.emit(stream, times, values, created=self.due_time)
+
+    def receive(self, batch):
+        if batch.created >= self.measure_after:
+            self.latencies.append(time.perf_counter() - batch.created)
+
+def create_fleet(n_devices, args, rng):
+    from Model import Model # Imported here, after the data folder is pointed at a temporary one
+    fleet = []
+    for device_id in range(n_devices):
+        model = Model()
+        polar_sensor = PolarH10(None)
+        ingest = VirtualIngest(model, args.max_queue_frames)
+        polar_sensor.ecg_frame_callback = lambda times, values, ingest=ingest: ingest.put("ecg", times, values)
+        polar_sensor.ibi_frame_callback = lambda times, values, ingest=ingest: ingest.put("ibi", times, values)
+        polar_sensor.sensor_clock = model.sensor_clock
+        device = VirtualPolar(device_id, np.random.default_rng(rng.integers(2**32)), rng.uniform(*args.heart_rate), args.noise, \
+                              args.drift_ppm, args.connection_interval, args.jitter, args.burst_prob, args.burst_s, args.drop, args.acc)
+        fleet.append((device, polar_sensor, ingest, model))
+    return fleet
+
+def schedule_notifications(fleet, duration_s):
+    '''All the fleet's notifications for a step, in order of arrival'''
+    streams = []
+    for device, polar_sensor, ingest, _ in fleet:
+        handlers = {"ecg": polar_sensor.ecg_data_conv, "acc": polar_sensor.acc_data_conv, "hr": polar_sensor.hr_data_conv}
+        streams.append(sorted((arrival, stream, data, handlers[stream], ingest) for arrival, stream, data in device.notifications(duration_s)))
+    return list(heapq.merge(*streams, key=lambda notification: notification[0]))
+
+def ingest_thread(notifications, t0, lateness):
+    '''Delivers the notifications at their arrival times, decoding each on this thread like the BLE callbacks'''
+    for arrival, _, data, handler, ingest in notifications:
+        due_time = t0 + arrival
+        wait = due_time - time.perf_counter()
+        if wait > 0:
+            time.sleep(wait)
+        lateness.append(time.perf_counter() - due_time)
+        ingest.due_time = due_time
+        handler(None, data)
+
+def acc_overwrites():
+    return sum(metric.value for key, metric in REGISTRY.metrics.items() if key[0] == "queue_overwrites_total" and ("queue", "acc_values") in key[1])
+
+def run_step(n_devices, args, rng):
+    fleet = create_fleet(n_devices, args, rng)
+    notifications = schedule_notifications(fleet, args.step_s)
+    overwrites_before = acc_overwrites()
+    lateness = []
+    t0 = time.perf_counter() + 0.1
+    for _, _, ingest, _ in fleet:
+        ingest.measure_after = t0 + args.warmup_s
+    producer = threading.Thread(target=ingest_thread, args=(notifications, t0, lateness), name="virtual-ble-ingest", daemon=True)
+    cpu0 = time.process_time()
+    producer.start()
+
+    # The consumers, as Model.pump_ingest with the ACC buffers drained alongside
+    max_depth = 0
+    while producer.is_alive() or any(model.ingest_queue.qsize() for _, _, _, model in fleet):
+        time.sleep(0.005)
+        max_depth = max(max_depth, max(model.ingest_queue.qsize() for _, _, _, model in fleet))
+        for _, polar_sensor, _, model in fleet:
+            model.drain_ingest()
+            while not polar_sensor.acc_queue_is_empty():
+                polar_sensor.dequeue_acc()
+    elapsed = time.perf_counter() - t0
+    cpu = (time.process_time() - cpu0)/elapsed
+
+    latencies = np.concatenate([ingest.latencies for _, _, ingest, _ in fleet] or [np.array([])])
+    result = {"n_devices": n_devices, \
+              "notifications_per_s": len(notifications)/args.step_s, \
+              "latency_p50_ms": 1e3*np.percentile(latencies, 50) if len(latencies) else np.nan, \
+              "latency_p99_ms": 1e3*np.percentile(latencies, 99) if len(latencies) else np.nan, \
+              "ingest_late_p99_ms": 1e3*np.percentile(lateness, 99) if lateness else np.nan, \
+              "max_queue_frames": max_depth, \
+              "overflowed_frames": sum(model.ingest_queue.n_dropped for _, _, _, model in fleet), \
+              "acc_overwrites": acc_overwrites() - overwrites_before, \
+              "dropped_notifications": sum(device.n_dropped for device, _, _, _ in fleet), \
+              "cpu": cpu}
+    result["ok"] = bool(result["latency_p99_ms"] <= args.slo_p99_ms and result["overflowed_frames"] == 0 and result["acc_overwrites"] == 0)
+    for _, _, _, model in fleet:
+        model.beat_tracker.close()
+    return result
+
+def find_knee(args):
+    '''Doubles N until a step fails the SLOs, then bisects between the last pass and the first failure'''
+    rng = np.random.default_rng(args.seed)
+    results = {}
+    def step(n_devices):
+        results[n_devices] = run_step(n_devices, args, rng)
+        print_result(results[n_devices])
+        return results[n_devices]["ok"]
+
+    passed, failed = 0, None
+    n_devices = args.start
+    while n_devices <= args.max_devices:
+        if step(n_devices):
+            passed, n_devices = n_devices, 2*n_devices
+        else:
+            failed = n_devices
+            break
+    while failed is not None and failed - passed > max(1, passed//args.resolution):
+        n_devices = (passed + failed)//2
+        if step(n_devices):
+            passed = n_devices
+        else:
+            failed = n_devices
+    return passed, failed, results
+
+def print_header():
+    print(f"{'Straps':>7}{'Notif/s':>9}{'p50 ms':>9}{'p99 ms':>9}{'Late p99':>10}{'Max queue':>11}{'Overflow':>10}{'ACC lost':>10}{'Dropped':>9}{'CPU':>7}  SLO")
+
+def print_result(result):
+    print(f"{result['n_devices']:>7}{result['notifications_per_s']:>9.0f}{result['latency_p50_ms']:>9.1f}{result['latency_p99_ms']:>9.1f}" \
+          f"{result['ingest_late_p99_ms']:>10.1f}{result['max_queue_frames']:>11}{result['overflowed_frames']:>10}{result['acc_overwrites']:>10.0f}" \
+          f"{result['dropped_notifications']:>9}{result['cpu']:>7.0%}  {'ok' if result['ok'] else 'BREACHED'}", flush=True)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Ramp a fleet of virtual Polar H10s to find how many one station can handle")
+    parser.add_argument("--start", type=int, default=1, help="Straps in the first step")
+    parser.add_argument("--max-devices", type=int, default=256, help="Stop ramping here even if the SLOs still hold")
+    parser.add_argument("--resolution", type=int, default=8, help="Bisect until the knee is known to within 1/resolution")
+    parser.add_argument("--step-s", type=float, default=10, help="Seconds of streaming per step")
+    parser.add_argument("--warmup-s", type=float, default=1, help="Latencies in the first seconds of a step aren't counted")
+    parser.add_argument("--slo-p99-ms", type=float, default=100, help="Largest acceptable 99th percentile frame latency")
+    parser.add_argument("--max-queue-frames", type=int, default=64, help="Frames a strap's ingest queue holds before frames are lost")
+    parser.add_argument("--heart-rate", type=float, nargs=2, default=(55, 95), metavar=("MIN", "MAX"), help="Range the straps' heart rates are drawn from")
+    parser.add_argument("--noise", type=float, default=20, help="ECG noise in µV rms")
+    parser.add_argument("--drift-ppm", type=float, default=30, help="Largest strap clock drift")
+    parser.add_argument("--connection-interval", type=float, default=0.03, help="BLE connection interval in seconds")
+    parser.add_argument("--jitter", type=float, default=0.005, help="Mean extra notification delay in seconds")
+    parser.add_argument("--burst-prob", type=float, default=0.01, help="Chance a notification starts a link stall")
+    parser.add_argument("--burst-s", type=float, default=0.5, help="Longest link stall, its backlog then arrives back to back")
+    parser.add_argument("--drop", type=float, default=0.002, help="Chance a notification is lost")
+    parser.add_argument("--acc", action="store_true", help="Stream accelerometer frames too")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.ERROR) # Dropped frames and overwrites are expected here, they're counted instead
+    vars.DATA_FOLDER = tempfile.mkdtemp(prefix="stress-") # The fleet's Models mustn't touch the real user data
+    vars.ANALYSIS_WORKER = False
+    vars.SESSION_LOG = False
+    vars.SHARED_ECG_HISTORY_NAME = None
+    vars.STREAM_SERVER_PORT = None
+
+    print_header()
+    passed, failed, results = find_knee(args)
+    if failed is None:
+        print(f"SLOs held up to {passed} straps, the most tried (--max-devices)")
+    elif passed == 0:
+        print(f"SLOs breached with {failed} strap(s)")
+    else:
+        knee = results[passed]
+        print(f"Knee: {passed} straps ({knee['notifications_per_s']:.0f} notifications/s, p99 {knee['latency_p99_ms']:.1f} ms, CPU {knee['cpu']:.0%}), " \
+              f"SLOs breached at {failed}")
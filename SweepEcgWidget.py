@@ -0,0 +1,142 @@
+from collections import deque
+from PySide6.QtCore import Qt, QPointF, QRect
+from PySide6.QtGui import QPainter, QPixmap, QPen, QColor, QPolygonF
+from PySide6.QtWidgets import QWidget, QSizePolicy
+
+'''
+SweepEcgWidget class
+Bedside monitor style ECG trace. The trace is drawn into a persistent pixmap: each frame paints only the line
+through the samples that arrived since the last frame and erases a short gap ahead of it, then repaints just that
+strip of the widget. Drawing cost scales with the new samples, not with the length of the window.
+The whole window is only redrawn (from the buffered samples) when the widget is resized or the y range changes
+'''
+class SweepEcgWidget(QWidget):
+
+    def __init__(self, time_range_s, y_min, y_max, colour, line_width=1.5, antialiasing=True, gap_s=0.25, max_sample_gap_s=0.5, parent=None):
+        super().__init__(parent)
+        self.time_range_s = time_range_s
+        self.y_min = y_min
+        self.y_max = y_max
+        self.pen = QPen(QColor(colour))
+        self.pen.setWidthF(line_width)
+        self.antialiasing = antialiasing
+        self.gap_s = gap_s
+        self.max_sample_gap_s = max_sample_gap_s # Longer gaps in the data aren't joined up
+        self.background = QColor(Qt.transparent)
+
+        self.samples = deque() # (time, value) of the current window, for redraws
+        self.t_origin = None
+        self.last_point = None # (time, x, y) of the last sample drawn
+        self.pixmap = None
+        self.setAttribute(Qt.WA_OpaquePaintEvent, False)
+        self.setSizePolicy(QSizePolicy.Expanding, QSizePolicy.Expanding)
+
+    def set_antialiasing(self, antialiasing):
+        self.antialiasing = antialiasing
+        self.redraw()
+
+    def set_y_range(self, y_min, y_max):
+        if (y_min, y_max) != (self.y_min, self.y_max):
+            self.y_min, self.y_max = y_min, y_max
+            self.redraw()
+
+    def clear(self):
+        self.samples.clear()
+        self.t_origin = None
+        self.last_point = None
+        self.redraw()
+
+    def to_x(self, t):
+        return ((t - self.t_origin) % self.time_range_s)/self.time_range_s*self.width()
+
+    def to_y(self, value):
+        return self.height()*(1 - (value - self.y_min)/(self.y_max - self.y_min))
+
+    def add_samples(self, times, values):
+        if len(times) == 0:
+            return
+        if self.t_origin is None:
+            self.t_origin = float(times[0])
+        for t, value in zip(times, values):
+            self.samples.append((float(t), float(value)))
+        while self.samples and self.samples[0][0] < self.samples[-1][0] - self.time_range_s:
+            self.samples.popleft()
+        if self.pixmap is None:
+            return
+        x_start = self.last_point[1] if self.last_point is not None else self.to_x(float(times[0]))
+        self.draw_samples(times, values)
+        self.update_strip(x_start, self.last_point[1])
+
+    def draw_samples(self, times, values):
+        painter = QPainter(self.pixmap)
+        painter.setRenderHint(QPainter.Antialiasing, self.antialiasing)
+        painter.setPen(self.pen)
+        painter.setCompositionMode(QPainter.CompositionMode_Source)
+
+        # Erase from the last point to a gap ahead of the newest one, wrapping round the right edge
+        x_start = self.last_point[1] if self.last_point is not None else self.to_x(float(times[0]))
+        x_end = self.to_x(float(times[-1])) + self.gap_s/self.time_range_s*self.width()
+        if float(times[-1]) - (self.last_point[0] if self.last_point is not None else float(times[0])) >= self.time_range_s:
+            x_start, x_end = 0, self.width() # A whole sweep of new data
+        self.erase(painter, x_start + self.pen.widthF(), x_end)
+
+        polyline = [QPointF(self.last_point[1], self.last_point[2])] if self.last_point is not None else []
+        last_t = self.last_point[0] if self.last_point is not None else None
+        last_x = self.last_point[1] if self.last_point is not None else None
+        for t, value in zip(times, values):
+            t = float(t)
+            x, y = self.to_x(t), self.to_y(float(value))
+            if last_t is not None and (x < last_x or t - last_t > self.max_sample_gap_s):
+                # Wrapped round, or missing data: start a new line
+                if len(polyline) > 1:
+                    painter.drawPolyline(QPolygonF(polyline))
+                polyline = []
+            polyline.append(QPointF(x, y))
+            last_t, last_x = t, x
+        if len(polyline) > 1:
+            painter.drawPolyline(QPolygonF(polyline))
+        painter.end()
+        self.last_point = (last_t, last_x, self.to_y(float(values[-1])))
+
+    def erase(self, painter, x_start, x_end):
+        width = self.width()
+        if x_end - x_start >= width:
+            painter.fillRect(QRect(0, 0, width, self.height()), self.background)
+            return
+        for lo, hi in ((x_start, x_end), (x_start - width, x_end - width), (x_start + width, x_end + width)):
+            lo, hi = max(lo, 0), min(hi, width)
+            if hi > lo:
+                painter.fillRect(QRect(int(lo), 0, int(hi - lo) + 1, self.height()), self.background)
+
+    def update_strip(self, x_start, x_end):
+        '''Repaints only the columns that changed'''
+        margin = int(self.pen.widthF()) + 2
+        gap = self.gap_s/self.time_range_s*self.width()
+        if x_end >= x_start:
+            self.update(QRect(int(x_start) - margin, 0, int(x_end - x_start + gap) + 2*margin, self.height()))
+        else:
+            self.update(QRect(int(x_start) - margin, 0, self.width() - int(x_start) + margin, self.height()))
+            self.update(QRect(0, 0, int(x_end + gap) + margin, self.height()))
+
+    def redraw(self):
+        '''Full redraw of the buffered window, only needed when the geometry or scale changes'''
+        if self.width() <= 0 or self.height() <= 0:
+            return
+        self.pixmap = QPixmap(self.size())
+        self.pixmap.fill(self.background)
+        self.last_point = None
+        if self.samples:
+            times, values = zip(*self.samples)
+            self.draw_samples(times, values)
+        self.update()
+
+    def resizeEvent(self, event):
+        super().resizeEvent(event)
+        self.redraw()
+
+    def paintEvent(self, event):
+        if self.pixmap is None:
+            return
+        painter = QPainter(self)
+        painter.drawPixmap(event.rect(), self.pixmap, event.rect())
+        painter.end()
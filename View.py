@@ -1,18 +1,23 @@
 
-from PySide6.QtCore import Qt, QPointF, QFile
-from PySide6.QtWidgets import QVBoxLayout, QHBoxLayout, QLabel, QSpinBox, QPushButton, QWidget, QSlider, QSizePolicy, QStackedWidget, QSpacerItem 
+from PySide6.QtCore import Qt, QPointF, QFile, QEvent, Signal
+from PySide6.QtWidgets import QVBoxLayout, QHBoxLayout, QGridLayout, QLabel, QSpinBox, QPushButton, QWidget, QSlider, QSizePolicy, QStackedWidget, QSpacerItem, QComboBox
 from PySide6.QtCharts import QChartView
-from PySide6.QtGui import QPainter, QColor
+from PySide6.QtGui import QPainter, QColor, QKeySequence, QShortcut
 import numpy as np
 from ChartUtils import ChartUtils
+from SweepEcgWidget import SweepEcgWidget
 import vars
 
 class View(QChartView):
+    visibilityChanged = Signal(bool) # False when the window is minimised or hidden
 
     def __init__(self, parent=None):
         super().__init__(parent)
 
         self.controls_widget = ControlsWidget()
+        self.progress_widget = ProgressWidget()
+        self.profiler_shortcut = QShortcut(QKeySequence("Ctrl+Shift+P"), self) # Toggles profiling at runtime
+        self.review_shortcut = QShortcut(QKeySequence("Ctrl+Shift+R"), self) # Opens the session's ECG for review
 
         # self.configureStylesheet()
         self.configureCharts()
@@ -36,32 +41,92 @@ class View(QChartView):
         self.chart_ecg.addAxis(self.axis_y, Qt.AlignRight)
         self.series_ecg.attachAxis(self.axis_x)
         self.series_ecg.attachAxis(self.axis_y)
+
+        self.sweep_ecg = None
+        if vars.ECG_DISPLAY == "sweep":
+            self.sweep_ecg = SweepEcgWidget(vars.ECG_TIME_RANGE, self.axis_y.min(), self.axis_y.max(), QColor(*vars.RED), vars.LINEWIDTH, \
+                                            vars.ECG_SWEEP_ANTIALIASING, vars.ECG_SWEEP_GAP_S)
+            size_policy = self.sweep_ecg.sizePolicy()
+            size_policy.setRetainSizeWhenHidden(True) # Hiding the trace during a trial mustn't move the controls
+            self.sweep_ecg.setSizePolicy(size_policy)
         
     def configureLayout(self):
         layout = QVBoxLayout()
 
-        ecg_widget = QChartView(self.chart_ecg)
-        ecg_widget.setStyleSheet("background-color: transparent;")
-        ecg_widget.setRenderHint(QPainter.Antialiasing)
+        if self.sweep_ecg is not None:
+            ecg_widget = self.sweep_ecg
+        else:
+            ecg_widget = QChartView(self.chart_ecg)
+            ecg_widget.setStyleSheet("background-color: transparent;")
+            ecg_widget.setRenderHint(QPainter.Antialiasing)
         
         layout.addWidget(ecg_widget, stretch=1)
+        layout.addWidget(self.progress_widget, stretch=1)
         layout.addWidget(self.controls_widget, stretch=3)
         layout.setContentsMargins(0, 0, 0, 0)
         self.setLayout(layout)
-        self.chart_ecg.setVisible(True)
-
-    def control_session_intro(self, trial_lengths_s):
-        self.chart_ecg.setVisible(True)
-        self.controls_widget.message_box.setText(f"There will be {len(trial_lengths_s)} sessions of random lengths between {min(trial_lengths_s)} s and {max(trial_lengths_s)} s\n\n"
+        self.setEcgVisible(True)
+        self.progress_widget.setVisible(False)
+
+    def isShown(self):
+        return self.isVisible() and not self.isMinimized()
+
+    def showEvent(self, event):
+        super().showEvent(event)
+        self.visibilityChanged.emit(self.isShown())
+
+    def hideEvent(self, event):
+        super().hideEvent(event)
+        self.visibilityChanged.emit(False)
+
+    def changeEvent(self, event):
+        super().changeEvent(event)
+        if event.type() == QEvent.WindowStateChange:
+            self.visibilityChanged.emit(self.isShown())
+
+    def setEcgVisible(self, visible):
+        if self.sweep_ecg is not None:
+            self.sweep_ecg.setVisible(visible)
+        else:
+            self.chart_ecg.setVisible(visible)
+
+    def control_session_intro(self, trial_lengths_s, users=None, user_name=None, n_training=0):
+        self.setEcgVisible(True)
+        if users is not None:
+            self.controls_widget.user_selector.setUsers(users, user_name)
+        self.controls_widget.user_selector.setVisible(users is not None)
+        self.progress_widget.setVisible(self.progress_widget.has_history())
+        training_text = f"You will start with {n_training} practice trial{'s' if n_training > 1 else ''}, which won't be scored\n" if n_training else ""
+        self.controls_widget.message_box.setText(f"{training_text}There will be {len(trial_lengths_s)} sessions of random lengths between {min(trial_lengths_s)} s and {max(trial_lengths_s)} s\n\n"
                                                  "During each you will count your heart beats (without taking your pulse)\n\n"
                                                  "At the end, enter the total count and the confidence in your estimate")
         self.controls_widget.message_box.updateColour("green")
         self.controls_widget.start_button.setText("Continue")
         self.controls_widget.start_button.setStyleSheet("background-color: white; color: black; border: 1px solid black;")
 
-    def control_ready_to_start(self, trial_no, trials_per_session):
-        self.chart_ecg.setVisible(True)
-        self.controls_widget.message_box.setText(f"Ready to start trial {trial_no} of {trials_per_session}\n\nBegin counting your heartbeats as soon as you press start")
+    def control_scanning(self):
+        self.setEcgVisible(True)
+        self.controls_widget.user_selector.setVisible(False)
+        self.controls_widget.message_box.setText("Scanning for Polar H10 Heart rate monitors...")
+        self.controls_widget.message_box.updateColour("yellow")
+        self.controls_widget.start_button.setStyleSheet("background-color: white; color: white; border: 1px solid white;")
+        self.controls_widget.setInputWidgetState("blank")
+
+    def control_sensor_error(self, message):
+        self.setEcgVisible(True)
+        self.controls_widget.user_selector.setVisible(False)
+        self.controls_widget.message_box.setText(f"Lost the connection to the heart rate monitor\n\n{message}\n\n"
+                                                 "Check the strap is on and charged, then press Reconnect")
+        self.controls_widget.message_box.updateColour("red")
+        self.controls_widget.start_button.setText("Reconnect")
+        self.controls_widget.start_button.setStyleSheet("background-color: white; color: black; border: 1px solid black;")
+        self.controls_widget.setInputWidgetState("blank")
+
+    def control_ready_to_start(self, trial_no, trials_per_session, training=False):
+        self.setEcgVisible(True)
+        self.controls_widget.user_selector.setVisible(False)
+        self.progress_widget.setVisible(False)
+        self.controls_widget.message_box.setText(f"Ready to start {'practice ' if training else ''}trial {trial_no} of {trials_per_session}\n\nBegin counting your heartbeats as soon as you press start")
         self.controls_widget.message_box.updateColour("green")
         self.controls_widget.start_button.setText("Start")
         self.controls_widget.start_button.setStyleSheet("background-color: white; color: black; border: 1px solid black;")
@@ -69,7 +134,7 @@ class View(QChartView):
         self.controls_widget.setInputWidgetState("blank")
     
     def control_recording_beats(self):
-        self.chart_ecg.setVisible(False)
+        self.setEcgVisible(False)
         self.controls_widget.message_box.setText("Count your heart beats\nWithout checking your pulse")
         self.controls_widget.message_box.updateColour("red")
         self.controls_widget.beat_count_input.setStyleSheet("background-color: white; color: grey; border: 1px solid grey;")
@@ -77,7 +142,7 @@ class View(QChartView):
         self.controls_widget.setInputWidgetState("blank")
 
     def control_recording_input(self):
-        self.chart_ecg.setVisible(True)
+        self.setEcgVisible(True)
         self.controls_widget.beat_count_input.setStyleSheet("background-color: white; color: black; border: 1px solid black;")
         self.controls_widget.message_box.setText("Enter the number of heart beats you counted")
         self.controls_widget.message_box.updateColour("green")
@@ -86,7 +151,7 @@ class View(QChartView):
         self.controls_widget.setInputWidgetState("beat_count_input")
 
     def control_recording_confidence(self):
-        self.chart_ecg.setVisible(True)
+        self.setEcgVisible(True)
         self.controls_widget.message_box.setText("On the scale below indicate how confident you are in your heartbeat count")
         self.controls_widget.message_box.updateColour("yellow")
         self.controls_widget.start_button.setText("Submit")
@@ -94,10 +159,31 @@ class View(QChartView):
         self.controls_widget.beat_count_input.setStyleSheet("background-color: white; color: grey; border: 1px solid grey;")
         self.controls_widget.setInputWidgetState("confidence_scale")
 
-    def control_results(self, accuracy_score, accuracy_percentile, awareness_score, awareness_percentile, awareness_p_value):
-        self.chart_ecg.setVisible(True)
-        self.controls_widget.message_box.setText(f"Your average accuracy was: {accuracy_score:.2f}.\nYour accuracy is in the {ordinal_suffix(np.round(accuracy_percentile,0) if not np.isnan(accuracy_percentile) else np.nan)} percentile.\n\n" \
-                                                 f"Your awareness score is: {awareness_score:.2f} (p-value = {awareness_p_value:.2f}).\nYour score is in the {ordinal_suffix(np.round(awareness_percentile,0) if not np.isnan(awareness_percentile) else np.nan)} percentile")
+    def control_scoring(self):
+        self.setEcgVisible(True)
+        self.controls_widget.message_box.setText("Calculating your results...")
+        self.controls_widget.message_box.updateColour("yellow")
+        self.controls_widget.start_button.setStyleSheet("background-color: white; color: white; border: 1px solid white;")
+        self.controls_widget.setInputWidgetState("blank")
+
+    def control_feedback(self, count_measured, count_entered, accuracy, last_trial=False):
+        self.setEcgVisible(True)
+        self.controls_widget.message_box.setText(f"You counted {count_entered} beats, your heart beat {count_measured} times\n\n" \
+                                                 f"Accuracy for this trial: {accuracy:.2f}")
+        self.controls_widget.message_box.updateColour("blue")
+        self.controls_widget.start_button.setText("See results" if last_trial else "Continue")
+        self.controls_widget.start_button.setStyleSheet("background-color: white; color: black; border: 1px solid black;")
+        self.controls_widget.setInputWidgetState("blank")
+
+    def control_results(self, accuracy_score, accuracy_percentile, awareness_score, awareness_percentile, awareness_p_value, \
+                        accuracy_ci=(np.nan, np.nan), awareness_ci=(np.nan, np.nan), awareness_permutation_p=np.nan):
+        self.setEcgVisible(True)
+        self.progress_widget.setVisible(self.progress_widget.has_history())
+        accuracy_ci_text = f" ({vars.RESAMPLING_CI:.0%} CI {accuracy_ci[0]:.2f} to {accuracy_ci[1]:.2f})" if not np.isnan(accuracy_ci[0]) else ""
+        awareness_ci_text = f", {vars.RESAMPLING_CI:.0%} CI {awareness_ci[0]:.2f} to {awareness_ci[1]:.2f}" if not np.isnan(awareness_ci[0]) else ""
+        permutation_text = f", permutation p-value = {awareness_permutation_p:.3f}" if not np.isnan(awareness_permutation_p) else ""
+        self.controls_widget.message_box.setText(f"Your average accuracy was: {accuracy_score:.2f}{accuracy_ci_text}.\nYour accuracy is in the {ordinal_suffix(np.round(accuracy_percentile,0) if not np.isnan(accuracy_percentile) else np.nan)} percentile.\n\n" \
+                                                 f"Your awareness score is: {awareness_score:.2f} (p-value = {awareness_p_value:.2f}{permutation_text}{awareness_ci_text}).\nYour score is in the {ordinal_suffix(np.round(awareness_percentile,0) if not np.isnan(awareness_percentile) else np.nan)} percentile")
         self.controls_widget.message_box.updateColour("green")
         self.controls_widget.start_button.setText("Start again")
         self.controls_widget.start_button.setStyleSheet("background-color: white; color: black; border: 1px solid black;")
@@ -111,6 +197,81 @@ class View(QChartView):
                 series_ecg_new.append(QPointF(value, ecg_hist[i]))
         self.series_ecg.replace(series_ecg_new)
 
+    def append_ecg_samples(self, ecg_times, ecg_values):
+        '''Sweep display: only the samples received since the last call are drawn'''
+        self.sweep_ecg.add_samples(ecg_times, ecg_values)
+
+    def set_ecg_y_range(self, y_min, y_max):
+        self.axis_y.setRange(y_min, y_max)
+        if self.sweep_ecg is not None:
+            self.sweep_ecg.set_y_range(y_min, y_max)
+
+    def update_progress(self, progress_summary, show=False):
+        self.progress_widget.update_progress(progress_summary)
+        if show:
+            self.progress_widget.setVisible(self.progress_widget.has_history())
+
+class ProgressWidget(QWidget):
+    """Accuracy and awareness over previous sessions, drawn from the ProgressTracker aggregates"""
+
+    def __init__(self):
+        super().__init__()
+        self.n_points = 0
+        self.initUI()
+
+    def initUI(self):
+        layout = QHBoxLayout()
+        self.setLayout(layout)
+        layout.setContentsMargins(0, 0, 0, 0)
+
+        self.chart = ChartUtils.create_chart(title='', showTitle=False, showLegend=True)
+        self.series_accuracy = ChartUtils.create_line_series(QColor(*vars.BLUE), vars.LINEWIDTH)
+        self.series_accuracy.setName("Accuracy")
+        self.series_awareness = ChartUtils.create_line_series(QColor(*vars.GOLD), vars.LINEWIDTH)
+        self.series_awareness.setName("Awareness")
+        self.axis_x = ChartUtils.create_axis(title="Session", tickCount=2, rangeMin=1, rangeMax=2, labelSize=8)
+        self.axis_x.setLabelFormat("%d")
+        self.axis_y = ChartUtils.create_axis(title=None, tickCount=5, rangeMin=-1, rangeMax=1, labelSize=8)
+
+        self.chart.addAxis(self.axis_x, Qt.AlignBottom)
+        self.chart.addAxis(self.axis_y, Qt.AlignLeft)
+        for series in (self.series_accuracy, self.series_awareness):
+            self.chart.addSeries(series)
+            series.attachAxis(self.axis_x)
+            series.attachAxis(self.axis_y)
+
+        chart_view = QChartView(self.chart)
+        chart_view.setRenderHint(QPainter.Antialiasing)
+        self.summary_label = QLabel("")
+        self.summary_label.setMinimumWidth(220)
+        layout.addWidget(chart_view, stretch=3)
+        layout.addWidget(self.summary_label, stretch=1)
+
+    def has_history(self):
+        return self.n_points > 0
+
+    def update_progress(self, progress_summary):
+        history = progress_summary["history"]
+        self.n_points = len(history)
+        self.series_accuracy.replace([QPointF(entry["session_no"], entry["accuracy"]) for entry in history if entry["accuracy"] is not None])
+        self.series_awareness.replace([QPointF(entry["session_no"], entry["awareness"]) for entry in history if entry["awareness"] is not None])
+        if history:
+            self.axis_x.setRange(history[0]["session_no"], max(history[-1]["session_no"], history[0]["session_no"] + 1))
+            self.axis_x.setTickCount(min(len(history), 10) if len(history) > 1 else 2)
+
+        lines = [f"Sessions: {progress_summary['n_sessions']}"]
+        for metric, name in (("accuracy", "Accuracy"), ("awareness", "Awareness")):
+            stats = progress_summary[metric]
+            if stats["n"] == 0:
+                continue
+            best = progress_summary["best"][metric]
+            lines.append(f"{name}: mean {stats['mean']:.2f}, recent {stats['ewma']:.2f}")
+            if not np.isnan(stats["trend"]):
+                lines.append(f"    trend {stats['trend']:+.3f} per session")
+            if best:
+                lines.append(f"    best {best[0][metric]:.2f} ({best[0]['date'] or best[0]['session_id']})")
+        self.summary_label.setText("\n".join(lines))
+
 class MessageBox(QLabel):
 
     def __init__(self):
@@ -151,11 +312,14 @@ class ControlsWidget(QWidget):
     def initUI(self):
 
         self.message_box = MessageBox()
+        self.user_selector = UserSelector()
+        self.user_selector.setVisible(False)
         self.configureStartButton()
         self.configureInputWidget()
 
         controls_layout = QVBoxLayout()
         self.setLayout(controls_layout)
+        controls_layout.addWidget(self.user_selector, alignment=Qt.AlignCenter)
         controls_layout.addWidget(self.message_box, alignment=Qt.AlignCenter)
         controls_layout.addWidget(self.input_widget, alignment=Qt.AlignCenter)
         controls_layout.addWidget(self.start_button, alignment=Qt.AlignCenter)
@@ -187,6 +351,37 @@ class ControlsWidget(QWidget):
         self.input_widget.addWidget(self.blank_widget)
         self.setInputWidgetState("blank")
 
+class UserSelector(QWidget):
+    """Pick who is doing the session, typing a new name adds a user"""
+    userSelected = Signal(str)
+
+    def __init__(self):
+        super().__init__()
+        self.initUI()
+
+    def initUI(self):
+        layout = QHBoxLayout()
+        self.setLayout(layout)
+        self.combo_box = QComboBox()
+        self.combo_box.setEditable(True)
+        self.combo_box.setInsertPolicy(QComboBox.NoInsert) # Added once the model has created the user
+        self.combo_box.setMinimumWidth(200)
+        self.combo_box.setStyleSheet("background-color: white; color: black; border: 1px solid black;")
+        self.combo_box.textActivated.connect(self.textActivatedHandler)
+        layout.addWidget(QLabel("User:"))
+        layout.addWidget(self.combo_box)
+
+    def setUsers(self, users, user_name):
+        self.combo_box.blockSignals(True)
+        self.combo_box.clear()
+        self.combo_box.addItems([name for _, name in users])
+        self.combo_box.setCurrentText(user_name)
+        self.combo_box.blockSignals(False)
+
+    def textActivatedHandler(self, text):
+        if text.strip():
+            self.userSelected.emit(text.strip())
+
 class BeatCountInput(QWidget):
 
     def __init__(self):
@@ -276,6 +471,45 @@ class ConfidenceScale(QWidget):
     def value(self):
         return self.slider.value()
     
+class OperatorPanel(QWidget):
+    """Live heart rate and HRV for the operator, kept out of the participant's window"""
+
+    METRICS = [("hr", "HR", "bpm", "{:.0f}"), ("rmssd", "RMSSD", "ms", "{:.0f}"), ("sdnn", "SDNN", "ms", "{:.0f}"), ("pnn50", "pNN50", "%", "{:.0f}")]
+
+    def __init__(self, windows_s):
+        super().__init__()
+        self.windows_s = windows_s
+        self.setWindowTitle("Operator panel")
+        self.initUI()
+
+    def initUI(self):
+        layout = QGridLayout()
+        self.setLayout(layout)
+
+        self.state_label = QLabel("State: -")
+        layout.addWidget(self.state_label, 0, 0, 1, len(self.windows_s)+1)
+        for col, window_s in enumerate(self.windows_s):
+            layout.addWidget(QLabel(f"{window_s} s"), 1, col+1, alignment=Qt.AlignRight)
+
+        self.value_labels = {}
+        for row, (key, name, unit, _) in enumerate(self.METRICS):
+            layout.addWidget(QLabel(f"{name} ({unit})"), row+2, 0)
+            for col, window_s in enumerate(self.windows_s):
+                label = QLabel("-")
+                label.setMinimumWidth(60)
+                label.setAlignment(Qt.AlignRight | Qt.AlignVCenter)
+                layout.addWidget(label, row+2, col+1)
+                self.value_labels[(key, window_s)] = label
+
+    def update_state(self, state_name):
+        self.state_label.setText(f"State: {state_name}")
+
+    def update_metrics(self, metrics_by_window):
+        for window_s, metrics in metrics_by_window.items():
+            for key, _, _, fmt in self.METRICS:
+                value = metrics[key]
+                self.value_labels[(key, window_s)].setText("-" if np.isnan(value) else fmt.format(value))
+
 
 def ordinal_suffix(value):
     # Special case for 11th to 13th
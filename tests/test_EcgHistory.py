@@ -0,0 +1,30 @@
+import numpy as np
+from EcgHistory import TieredEcgHistory
+
+RATE = 130
+
+def make_history(n_samples=0, t0=100.0):
+    history = TieredEcgHistory(RATE, hot_capacity=512, chunk_size=128)
+    if n_samples:
+        history.append(t0 + np.arange(n_samples)/RATE, np.arange(n_samples))
+    return history
+
+def test_empty_history():
+    history = make_history()
+    assert len(history) == 0
+    assert history.time_to_seq(0.0) == history.first_seq
+    assert history.time_to_seq(1e9) == history.first_seq
+    values, times = history.get_ecg_wind(0.0, 10.0)
+    assert len(values) == 0 and len(times) == 0
+    assert np.isnan(history.get_latest_time())
+
+def test_single_segment():
+    history = make_history(1000) # Sealed chunks and the hot ring, one timebase segment
+    assert len(history.segment_seqs) == 1
+    assert history.time_to_seq(0.0) == 0 # Before the first sample
+    assert history.time_to_seq(100.0) == 0
+    assert abs(history.time_to_seq(100.0 + 500/RATE) - 500) <= 1 # Within the timebase error
+    assert history.time_to_seq(1e9) == 1000 # After the last sample
+    values, times = history.get_ecg_wind(100.0 + 200/RATE, 100.0 + 299/RATE)
+    np.testing.assert_array_equal(values, np.arange(200, 300))
+    np.testing.assert_allclose(times, 100.0 + np.arange(200, 300)/RATE)
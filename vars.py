@@ -1,5 +1,5 @@
-TRIAL_LENGTHS_S = [25, 30, 35, 40, 45, 50]
-# TRIAL_LENGTHS_S = [2, 1]
+PROTOCOL = "protocols/garfinkel.json" # Trials, order, feedback and scoring of a session, see Protocol
+PROTOCOL_SEED = None # Overrides the protocol's seed, an int repeats the exact same schedule every session
 
 RED = [200, 30, 45]
 YELLOW = [254, 191, 0]
@@ -12,6 +12,75 @@ LINEWIDTH = 1.5
 DOTSIZE_SMALL = 4
 DOTSIZE_LARGE = 5
 UPDATE_ECG_SERIES_PERIOD = 1 # ms
+UPDATE_ECG_SERIES_IDLE_PERIOD = 33 # ms, outside trials, see PowerManager
+UPDATE_ECG_SERIES_AWAY_PERIOD = 250 # ms, when nobody has used the app for AWAY_TIMEOUT_S
+POWER_SAVING = True # Slow the display and sensor polling down outside trials and when the window is hidden
+AWAY_TIMEOUT_S = 120
 ECG_TIME_RANGE = 20 # s
+ECG_DISPLAY = "sweep" # "sweep": monitor style trace that only draws new samples, "chart": QtCharts line series
+ECG_SWEEP_ANTIALIASING = True
+ECG_SWEEP_GAP_S = 0.25 # Blank gap ahead of the sweep
+ECG_SAMPLING_RATE = 130 # Hz
+ECG_HOT_SAMPLES = 8192 # Latest samples kept uncompressed, about a minute
+ECG_CHUNK_SAMPLES = 4096 # Samples per compressed chunk of the older history
+ECG_TIMEBASE_MAX_ERROR_S = 0.001 # Largest difference between a stored sample time and the received one
+ECG_HISTORY_MAX_S = 12*3600 # Older ECG is dropped, None keeps everything
+ECG_FILTER_HIGHPASS_HZ = 0.5 # Removes baseline wander, None to turn off
+ECG_FILTER_NOTCH_HZ = 50 # Mains frequency, 60 in the Americas, None to turn off
+ECG_FILTER_NOTCH_Q = 30
+ECG_FILTER_LOWPASS_HZ = None # e.g. 40 to smooth muscle noise
+ECG_FILTER_DETECTION = True # Beat detectors see the filtered ECG, the raw ECG is still saved and exported
+ECG_AUTORANGE = True # Scale the live display's y axis to the recent ECG
+ECG_AUTORANGE_WINDOW_S = 10 # Seconds of ECG the range is taken from
+SENSOR_CLOCK_WINDOW_S = 30 # ECG frames the sensor to monotonic clock offset is taken from, see SensorClock
+SENSOR_TRANSPORT_LATENCY_S = 0.0075 # Least delay from a sample being measured to its frame arriving, one BLE connection interval
+DISPLAY_LATENCY_S = 0.02 # From a cue being painted to it being on the screen, about a frame at 60 Hz plus the panel
+
+BEAT_DETECTOR = "neurokit" # One of BeatDetectors.DETECTORS
+HRV_WINDOWS_S = (10, 60) # Rolling windows for the live HR and HRV metrics
+LIVE_PEAKS_MAX = 64 # Live beats kept until they're streamed, older ones are dropped when nothing takes them
+SHOW_OPERATOR_PANEL = True # Live HR and HRV in a separate window for the operator
+UPDATE_OPERATOR_PANEL_PERIOD = 1000 # ms
+
+INGEST_MODE = "thread" # "thread": BLE and decoding on a background thread, "loop": everything on the GUI event loop
+INGEST_POLL_PERIOD_S = 0.005 # How often decoded ECG is taken into the beat tracker during a trial
+INGEST_POLL_IDLE_PERIOD_S = 0.05
+INGEST_POLL_AWAY_PERIOD_S = 0.25 # Well within what the ingest queue holds
+INGEST_QUEUE_BATCHES = 1024 # Frames the ingest queue holds for the GUI thread, minutes of ECG
+INGEST_QUEUE_POLICY = "drop_oldest" # When it's full, see Pipeline.POLICIES. "block" would stall the BLE thread, or deadlock the "loop" mode
+ANALYSIS_WORKER = True # Score trials in a separate process instead of on the GUI thread
+SHARED_ECG_HISTORY_NAME = None # Shared memory name to publish the ECG history under, e.g. "interoception_ecg"
+STREAM_SERVER_PORT = None # TCP port to stream live ECG and beats to remote dashboards, e.g. 9109
+STREAM_SERVER_HOST = "127.0.0.1" # "0.0.0.0" to accept other machines
+STREAM_CLIENT_MAX_FRAMES = 64 # Frames buffered per client before a slow client skips to the latest
+
+EXPORT_COLUMNAR = True # Append sessions and trials to data/columnar for analysis, see SessionExport
+EXPORT_RAW_ECG = True # Include the raw ECG of each trial window
+EXPORT_COMPACT_PARTS = 50 # Sessions exported one part each before they're merged into one, 0 to never merge
+SESSION_LOG = True # Log each trial as it's scored, so a crash doesn't lose the session, see SessionLog
+SESSION_LOG_SYNC_INTERVAL_S = 0.2 # Records written within this long of each other share one fsync
+RESUME_INTERRUPTED_SESSIONS = True # Carry on with a session a crash interrupted, otherwise it's saved as it was
+REPORT_FOLDER = "reports" # Where Reports.py writes the session reports
+REPORT_WORKERS = None # Processes to render the reports with, None for one per core
+REPORT_DPI = 100
+
+RESAMPLING_N_BOOTSTRAP = 2000 # Bootstrap resamples for the confidence intervals of accuracy and awareness, 0 to skip them
+RESAMPLING_N_PERMUTATIONS = 5000 # Permutations for the p-values, 0 to skip them
+RESAMPLING_CI = 0.95
+RESAMPLING_SEED = None # An int makes the intervals and p-values reproducible
+RESAMPLING_WORKERS = 1 # Processes to spread the resamples over, for scoring many sessions at once
+
+DATA_FOLDER = "data"
+DEFAULT_USER = "default" # Selected at startup, other users are picked or added on the intro screen
+
+SHOW_PROGRESS = True # Accuracy and awareness over previous sessions, on the intro and results screens
+PROGRESS_HISTORY_LENGTH = 200 # Most recent sessions kept for plotting, the running aggregates cover all sessions
+PROGRESS_BEST_SESSIONS = 5
+PROGRESS_EWMA_ALPHA = 0.3 # Weight of the latest session in the "recent" score
+
+LOG_LEVEL = "INFO"
+METRICS_ENABLED = True # Prometheus text format at http://METRICS_HOST:METRICS_PORT/metrics
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = 9108
 
 SHOW_DEBUG_GRAPHS = False
\ No newline at end of file